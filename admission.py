@@ -0,0 +1,137 @@
+# admission.py - Connection caps and token-bucket rate limits for the relay server
+
+# Limits applied unless configured otherwise; None disables a limit
+DEFAULT_LIMITS = {
+    'max_connections': 10000,  # Connections open at once on this node
+    'max_connections_per_ip': 256,
+    'registration_timeout': 10.0,  # Seconds to register (or resume) after connecting
+    'user_rate': 100.0,  # Frames per second of one user, sustained
+    'user_burst': 200,  # Frames a user may send at once above that rate
+    'ip_rate': 1000.0,  # Frames per second shared by every connection of one IP
+    'ip_burst': 2000,
+    'max_frame_size': 1 << 20,  # Bytes a connection may buffer for one incoming frame
+}
+
+# Seconds between sweeps of the buckets of gone IPs and users
+SWEEP_INTERVAL = 30.0
+
+# Load tests and benchmarks: every client comes from loopback and sends as fast as it can
+UNTHROTTLED = {'max_connections_per_ip': None, 'user_rate': None, 'ip_rate': None}
+
+class TokenBucket:
+    """Allows rate frames per second on average, and bursts of up to burst
+
+    Taking never refuses: the balance may go negative, and delay() tells
+    how long until it is back to zero. The server stops reading from a
+    client for that long, so a sender over its limit is slowed down to it
+    (TCP pushes back on the client) instead of losing messages.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now, amount=1):
+        """Take amount tokens; False if the bucket is now in debt"""
+        tokens = self.tokens + (now - self.updated) * self.rate
+        self.tokens = (tokens if tokens < self.burst else self.burst) - amount
+        self.updated = now
+        return self.tokens >= 0
+
+    def delay(self):
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def full_at(self):
+        """When the bucket is back to burst tokens if nothing more is taken"""
+        return self.updated + (self.burst - self.tokens) / self.rate
+
+class AdmissionControl:
+    """Decides which connections are accepted and how fast they may send
+
+    Every check is a couple of dict lookups or float operations: the
+    buckets a connection is charged per frame are resolved once, when it
+    connects and when it registers. Limits are per node; in a cluster each
+    node applies them to the connections it accepted.
+
+    The buckets of an IP or user outlive their connections until they are
+    full again (then they are no different from new ones), so disconnecting
+    and reconnecting never refills them. sweep() evicts them afterwards.
+    """
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        unknown = set(self.limits) - set(DEFAULT_LIMITS)
+        if unknown:
+            raise ValueError(f"Límites desconocidos: {', '.join(sorted(unknown))}")
+        self.max_connections = self.limits['max_connections']
+        self.max_connections_per_ip = self.limits['max_connections_per_ip']
+        self.registration_timeout = self.limits['registration_timeout']
+        self.user_rate = self.limits['user_rate']
+        self.user_burst = self.limits['user_burst']
+        self.ip_rate = self.limits['ip_rate']
+        self.ip_burst = self.limits['ip_burst']
+        self.max_frame_size = self.limits['max_frame_size']
+        self.connections = 0
+        self.addresses = {}  # {ip: [open connections, TokenBucket or None]}
+        self.users = {}  # {username: TokenBucket}, shared by the user's connections
+        self.idle_users = set()  # Users without a connection, whose bucket is kept until full
+        self.next_sweep = 0.0
+
+    def admit(self, ip, now):
+        """Count a new connection from ip; False (and not counted) if it is over a cap"""
+        if now >= self.next_sweep:
+            self.sweep(now)
+        if self.max_connections is not None and self.connections >= self.max_connections:
+            return False
+        state = self.addresses.get(ip)
+        if state is None:
+            bucket = TokenBucket(self.ip_rate, self.ip_burst, now) if self.ip_rate else None
+            state = self.addresses[ip] = [0, bucket]
+        elif self.max_connections_per_ip is not None and state[0] >= self.max_connections_per_ip:
+            return False
+        state[0] += 1
+        self.connections += 1
+        return True
+
+    def ip_bucket(self, ip):
+        """The bucket shared by the connections of an admitted ip (None without an IP rate)"""
+        return self.addresses[ip][1]
+
+    def release(self, ip):
+        """Forget an admitted connection; the IP's bucket stays until sweep() finds it full"""
+        state = self.addresses.get(ip)
+        if state is None:
+            return
+        self.connections -= 1
+        state[0] -= 1
+        if state[0] == 0 and state[1] is None:
+            del self.addresses[ip]
+
+    def user_bucket(self, username, now):
+        """The bucket shared by the connections of username (None without a user rate)"""
+        if not self.user_rate:
+            return None
+        self.idle_users.discard(username)
+        bucket = self.users.get(username)
+        if bucket is None:
+            bucket = self.users[username] = TokenBucket(self.user_rate, self.user_burst, now)
+        return bucket
+
+    def forget_user(self, username):
+        """The user's last connection is gone; its bucket stays until sweep() finds it full"""
+        if username in self.users:
+            self.idle_users.add(username)
+
+    def sweep(self, now):
+        """Evict the buckets of IPs and users without connections that are full again"""
+        self.next_sweep = now + SWEEP_INTERVAL
+        for ip, state in list(self.addresses.items()):
+            if state[0] == 0 and (state[1] is None or state[1].full_at() <= now):
+                del self.addresses[ip]
+        for username in list(self.idle_users):
+            if self.users[username].full_at() <= now:
+                del self.users[username]
+                self.idle_users.discard(username)
@@ -0,0 +1,490 @@
+# benchmarks.py - Micro-benchmarks for the chat components
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from admission import UNTHROTTLED
+from client import SecureChatClient
+import crypto_utils
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+from crypto_utils import CryptoManager
+from history_store import HistoryStore
+from cipher_suites import SUITE_RSA, SUITES
+from key_pool import KeyPool
+from metrics import registry
+from protocol import FrameDecoder, MESSAGE_TYPES, encode_message
+from receive_pipeline import ReceivePipeline
+from server import SecureChatServer
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def start_server(**options):
+    """Run a relay server in a background thread and wait until it accepts"""
+    port = free_port()
+    options.setdefault('limits', UNTHROTTLED)
+    server = SecureChatServer(port=port, **options)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            break
+        except OSError:
+            time.sleep(0.01)
+    return server, port
+
+def summarize(samples):
+    """Summary statistics in milliseconds"""
+    ordered = sorted(samples)
+    return {
+        'runs': len(ordered),
+        'mean_ms': statistics.mean(ordered) * 1000,
+        'min_ms': ordered[0] * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+def timed_connect(client, port):
+    """Time from connect() until the server confirms the registration"""
+    async def connect():
+        start = time.perf_counter()
+        await client.connect(port=port)
+        elapsed = time.perf_counter() - start
+        await client.disconnect()
+        return elapsed
+    return asyncio.run(connect())
+
+def bench_connect(rounds=5):
+    """Cold connect (RSA generation) vs warm connect (identity on disk, key pool)"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        server, port = start_server()
+        pool = KeyPool(size=rounds)
+        pool.start()
+        results = {}
+
+        with tempfile.TemporaryDirectory() as key_dir:
+            cold = []
+            for i in range(rounds):
+                client = SecureChatClient(f"cold{i}", key_dir=key_dir, ephemeral=True, suite=SUITE_RSA)
+                cold.append(timed_connect(client, port))
+            results['cold_keygen'] = summarize(cold)
+
+            # Identities are created up front; the timed connect only loads them
+            # (no local history: it would be written under ./history)
+            warm = []
+            for i in range(rounds):
+                SecureChatClient(f"warm{i}", key_dir=key_dir, suite=SUITE_RSA,
+                                 history_dir=None).load_keys()
+            for i in range(rounds):
+                client = SecureChatClient(f"warm{i}", key_dir=key_dir, suite=SUITE_RSA,
+                                          history_dir=None)
+                warm.append(timed_connect(client, port))
+            results['warm_identity'] = summarize(warm)
+
+            encrypted = []
+            for i in range(rounds):
+                SecureChatClient(f"locked{i}", key_dir=key_dir, passphrase='benchmark',
+                                 suite=SUITE_RSA, history_dir=None).load_keys()
+            for i in range(rounds):
+                client = SecureChatClient(f"locked{i}", key_dir=key_dir, passphrase='benchmark',
+                                          suite=SUITE_RSA, history_dir=None)
+                encrypted.append(timed_connect(client, port))
+            results['warm_identity_passphrase'] = summarize(encrypted)
+
+            # Wait for the worker to fill the pool before timing it
+            deadline = time.monotonic() + 60
+            while pool.available() < rounds and time.monotonic() < deadline:
+                time.sleep(0.1)
+            pooled = []
+            for i in range(rounds):
+                client = SecureChatClient(f"pool{i}", key_dir=key_dir, key_pool=pool, ephemeral=True,
+                                          suite=SUITE_RSA)
+                pooled.append(timed_connect(client, port))
+            results['warm_key_pool'] = summarize(pooled)
+
+        pool.stop()
+    return results
+
+def make_inbound_messages(receiver, count, senders, size=64):
+    """Encrypted, signed messages from several senders to one receiver"""
+    receiver_pem = receiver.crypto.get_public_key_pem()
+    peers = []
+    for i in range(senders):
+        peer = CryptoManager()
+        peer.generate_keypair(receiver.crypto.suite.name)
+        peer.add_peer_public_key(receiver.username, receiver_pem)
+        receiver.crypto.add_peer_public_key(f"sender{i}", peer.get_public_key_pem())
+        peers.append(peer)
+
+    messages = []
+    text = 'x' * size
+    for i in range(count):
+        sender = i % senders
+        message = peers[sender].encrypt_session_message(text, [receiver.username], 'bench')
+        message.update({
+            'type': 'encrypted_message',
+            'from': f"sender{sender}",
+            'to': receiver.username,
+            'signature': peers[sender].sign_message(text),
+            'timestamp': time.time(),
+        })
+        messages.append(message)
+    return messages
+
+def bench_receive(count=2000, senders=8):
+    """Inbound messages/second: inline decryption vs the parallel receive pipeline"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        receiver = SecureChatClient('receiver', receive_workers=0)
+        receiver.crypto.generate_keypair(SUITE_RSA)
+        messages = make_inbound_messages(receiver, count, senders)
+
+    def deliver(message, opened):
+        if opened[2] is not None:
+            receiver.crypto.accept_counter(*opened[2])
+
+    results = {}
+    receiver.crypto.peer_session_keys = {}
+    start = time.perf_counter()
+    for message in messages:
+        deliver(message, receiver.open_message(message))
+    results['inline'] = {'messages_per_second': count / (time.perf_counter() - start)}
+
+    async def run_pipeline(workers):
+        delivered = []
+        finished = asyncio.Event()
+
+        def counting_deliver(message, opened):
+            deliver(message, opened)
+            delivered.append(message)
+            if len(delivered) == count:
+                finished.set()
+
+        pipeline = ReceivePipeline(receiver.open_message, counting_deliver,
+                                   receiver.handle_received_message, workers=workers)
+        start = time.perf_counter()
+        # Roughly what one socket read yields under a burst
+        for i in range(0, count, 64):
+            pipeline.submit_batch(messages[i:i + 64])
+        await finished.wait()
+        elapsed = time.perf_counter() - start
+        pipeline.close()
+        return elapsed
+
+    worker_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    for workers in worker_counts:
+        receiver.crypto.peer_session_keys = {}
+        elapsed = asyncio.run(run_pipeline(workers))
+        results[f"pipeline_{workers}_workers"] = {'messages_per_second': count / elapsed}
+    return results
+
+def bench_sessions(sessions=100, messages=20, room_size=5):
+    """Many client sessions in one process and on one event loop, in rooms of room_size"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        server, port = start_server()
+
+    async def run(key_dir):
+        clients = [SecureChatClient(f"session{i}", key_dir=key_dir, ephemeral=True) for i in range(sessions)]
+        start = time.perf_counter()
+        await asyncio.gather(*(client.connect(port=port) for client in clients))
+        connect_elapsed = time.perf_counter() - start
+
+        rooms = {}
+        for i, client in enumerate(clients):
+            rooms.setdefault(f"room{i // room_size}", []).append(client)
+        for room, members in rooms.items():
+            for client in members:
+                await client.join_room(room)
+        # Timed once every member knows every other member's key
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and any(len(client.rooms.get(room, ())) < len(members) - 1
+                                                  for room, members in rooms.items() for client in members):
+            await asyncio.sleep(0.01)
+
+        expected = messages * sum(len(members) * (len(members) - 1) for members in rooms.values())
+        received = 0
+        finished = asyncio.Event()
+
+        async def consume(events):
+            nonlocal received
+            async for event in events:
+                if event['type'] == 'message':
+                    received += 1
+                    if received == expected:
+                        finished.set()
+
+        async def send_all(client):
+            for n in range(messages):
+                await client.send(f"mensaje {n}", room=client.active_room)
+
+        consumers = [asyncio.create_task(consume(client.messages())) for client in clients]
+        start = time.perf_counter()
+        await asyncio.gather(*(send_all(client) for client in clients))
+        await asyncio.wait_for(finished.wait(), 60)
+        elapsed = time.perf_counter() - start
+        for client in clients:
+            await client.disconnect()
+        await asyncio.gather(*consumers)
+        return {
+            'sessions': sessions,
+            'connect_all_ms': connect_elapsed * 1000,
+            'messages_per_second': sessions * messages / elapsed,
+            'deliveries_per_second': expected / elapsed,
+            'threads': threading.active_count(),
+        }
+
+    with tempfile.TemporaryDirectory() as key_dir, contextlib.redirect_stdout(io.StringIO()):
+        return asyncio.run(run(key_dir))
+
+def raw_client(port, username, room):
+    """A socket registered and joined to a room, without any crypto"""
+    sock = socket.create_connection(('localhost', port))
+    sock.sendall(encode_message({'type': 'register', 'username': username, 'public_key': 'x'}))
+    sock.sendall(encode_message({'type': 'join_room', 'room': room}))
+    return sock
+
+def count_frames(sock, frame_type, expected, done):
+    decoder = FrameDecoder()
+    seen = 0
+    while seen < expected and decoder.recv_from(sock):
+        seen += sum(1 for msg_type, body in decoder.frames() if msg_type == frame_type)
+    done.release()
+
+def bench_relay(messages=20000, receivers=8, size=256):
+    """Relay throughput for a burst into a room: per-frame writes vs coalesced writes"""
+    configurations = {
+        'write_per_frame': {'flush_threshold': 0},
+        'coalesced': {},
+        'coalesced_2ms': {'flush_interval': 0.002},
+        # Rate limits checked on every frame, but too high to ever throttle
+        'coalesced_rate_limited': {'limits': {'user_rate': 1e9, 'user_burst': 1e9,
+                                              'ip_rate': 1e9, 'ip_burst': 1e9}},
+    }
+    frame_type = MESSAGE_TYPES['encrypted_message']
+    bursts = messages // 64
+    messages = bursts * 64
+    results = {}
+    for name, options in configurations.items():
+        with contextlib.redirect_stdout(io.StringIO()):
+            server, port = start_server(**options)
+        sender = raw_client(port, 'sender', 'bench')
+        sockets = [raw_client(port, f"receiver{i}", 'bench') for i in range(receivers)]
+        time.sleep(0.5)
+        # Skip the join notifications before timing
+        for sock in sockets:
+            sock.settimeout(0.2)
+            try:
+                while sock.recv(65536):
+                    pass
+            except socket.timeout:
+                pass
+            sock.settimeout(None)
+
+        frame = encode_message({'type': 'encrypted_message', 'room': 'bench', 'encrypted_content': b'x' * size})
+        done = threading.Semaphore(0)
+        for sock in sockets:
+            threading.Thread(target=count_frames, args=(sock, frame_type, messages, done), daemon=True).start()
+        registry.reset()
+        start = time.perf_counter()
+        burst = frame * 64
+        for _ in range(bursts):
+            sender.sendall(burst)
+        for _ in sockets:
+            done.acquire()
+        elapsed = time.perf_counter() - start
+        writes = registry.counter('server.writes').value
+        for sock in [sender] + sockets:
+            sock.close()
+        results[name] = {
+            'messages_per_second': messages / elapsed,
+            'deliveries_per_second': messages * receivers / elapsed,
+            'frames_per_write': messages * receivers / max(1, writes),
+        }
+    return results
+
+def per_call(function, iterations):
+    """Mean cost of one call in microseconds"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def bench_crypto(iterations=2000):
+    """Per-call cost of key handling, uncached vs cached (microseconds)"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        crypto = CryptoManager()
+        crypto.generate_keypair(SUITE_RSA)
+        peer = CryptoManager()
+        peer.generate_keypair(SUITE_RSA)
+    peer_pem = peer.get_public_key_pem()
+    handle = crypto.add_peer_public_key('peer', peer_pem)
+    signature = peer.sign_message('benchmark')
+
+    def uncached_fingerprint():
+        pem_data = peer.public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        crypto_utils.format_fingerprint(hashlib.sha256(pem_data).hexdigest())
+
+    def uncached_padding():
+        padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+        padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH)
+        hashes.SHA256()
+
+    def uncached_verify():
+        peer.public_key.verify(
+            signature, b'benchmark',
+            padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+            hashes.SHA256()
+        )
+
+    return {
+        'fingerprint': {
+            'uncached_us': per_call(uncached_fingerprint, iterations),
+            'cached_us': per_call(lambda: crypto.get_public_key_fingerprint(handle), iterations),
+        },
+        'public_key_pem': {
+            'uncached_us': per_call(lambda: crypto.public_key.public_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo), iterations),
+            'cached_us': per_call(crypto.get_public_key_pem, iterations),
+        },
+        'padding_objects': {
+            'uncached_us': per_call(uncached_padding, iterations),
+            'cached_us': 0.0,
+        },
+        'load_peer_key': {
+            'uncached_us': per_call(lambda: load_pem_public_key(peer_pem), iterations),
+            'cached_us': per_call(lambda: crypto.add_peer_public_key('peer', peer_pem), iterations),
+        },
+        'verify_signature': {
+            'uncached_us': per_call(uncached_verify, iterations),
+            'cached_us': per_call(lambda: crypto.verify_signature('benchmark', signature, handle), iterations),
+        },
+    }
+
+def message_frame_sizes(suite, members, size=64):
+    """Frame bytes of the first message of a session (keys wrapped) and of the next ones"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        sender = CryptoManager()
+        sender.generate_keypair(suite)
+        for i in range(members):
+            member = CryptoManager()
+            member.generate_keypair(suite)
+            sender.add_peer_public_key(f"member{i}", member.get_public_key_pem())
+    recipients = [f"member{i}" for i in range(members)]
+    text = 'x' * size
+    sizes = []
+    for _ in range(2):
+        message = sender.encrypt_session_message(text, recipients, 'bench')
+        message.update({'type': 'encrypted_message', 'room': 'bench', 'from': 'sender',
+                        'timestamp': time.time(), 'signature': sender.sign_message(text)})
+        sizes.append(len(encode_message(message)))
+    return {'first_message': sizes[0], 'next_messages': sizes[1]}
+
+def bench_suites(iterations=200):
+    """Cipher suites side by side: per-operation cost (microseconds) and wire sizes (bytes)"""
+    results = {}
+    for name, suite in SUITES.items():
+        keygen_iterations = iterations if name != SUITE_RSA else max(1, iterations // 20)
+        private_key = suite.generate_private_key()
+        public_key = private_key.public_key()
+        data = b'x' * 64
+        signature = suite.sign(private_key, data)
+        key = os.urandom(32)
+        wrapped_key = suite.wrap_key(public_key, key)
+        pem_data = suite.public_bytes(public_key)
+        results[name] = {
+            'keygen_us': per_call(suite.generate_private_key, keygen_iterations),
+            'sign_us': per_call(lambda: suite.sign(private_key, data), iterations),
+            'verify_us': per_call(lambda: suite.verify(public_key, signature, data), iterations),
+            'wrap_key_us': per_call(lambda: suite.wrap_key(public_key, key), iterations),
+            'unwrap_key_us': per_call(lambda: suite.unwrap_key(private_key, wrapped_key), iterations),
+            'load_public_key_us': per_call(lambda: suite.load_public_key(pem_data), iterations),
+            'public_key_bytes': len(pem_data),
+            'signature_bytes': len(signature),
+            'wrapped_key_bytes': len(wrapped_key),
+            'direct_message_bytes': message_frame_sizes(name, 1),
+            'room_of_8_message_bytes': message_frame_sizes(name, 8),
+        }
+    return results
+
+def bench_history(messages=1000000, page_size=50, pages=200):
+    """Local history with a million messages in one conversation: writes, reopening and paging"""
+    key = os.urandom(32)
+    with tempfile.TemporaryDirectory() as history_dir:
+        store = HistoryStore(history_dir, key)
+        start = time.perf_counter()
+        now = time.time() - messages
+        for i in range(messages):
+            store.append('room:bench', {'from': 'bench', 'text': f"mensaje {i}", 'timestamp': now + i,
+                                        'signature_valid': True})
+        queued = time.perf_counter() - start
+        store.flush()
+        written = time.perf_counter() - start
+        store.close()
+        disk_bytes = sum(os.path.getsize(os.path.join(root, name))
+                         for root, _, names in os.walk(history_dir) for name in names)
+
+        # Reopening reads no record: only the tail of the last index
+        start = time.perf_counter()
+        store = HistoryStore(history_dir, key)
+        count = store.count('room:bench')
+        reopen = time.perf_counter() - start
+
+        newest = per_call(lambda: store.page('room:bench', limit=page_size), pages)
+        # Scrolling back from a point in time, anywhere in the conversation
+        positions = [random.randrange(page_size + 1, messages) for _ in range(pages)]
+        start = time.perf_counter()
+        for position in positions:
+            store.page('room:bench', store.seq_at('room:bench', now + position), page_size)
+        random_page = (time.perf_counter() - start) / pages * 1e6
+        store.close()
+
+    return {
+        'messages': count,
+        'append_queue_us': queued / messages * 1e6,
+        'messages_per_second_written': messages / written,
+        'disk_bytes_per_message': disk_bytes / messages,
+        'reopen_ms': reopen * 1000,
+        'newest_page_us': newest,
+        'page_at_time_us': random_page,
+    }
+
+BENCHMARKS = {
+    'connect': bench_connect,
+    'receive': bench_receive,
+    'sessions': bench_sessions,
+    'crypto': bench_crypto,
+    'relay': bench_relay,
+    'suites': bench_suites,
+    'history': bench_history,
+}
+
+def main(argv):
+    names = argv or list(BENCHMARKS)
+    results = {}
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Benchmark desconocido: {name} (disponibles: {', '.join(BENCHMARKS)})")
+            return 1
+        results[name] = BENCHMARKS[name]()
+    print(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
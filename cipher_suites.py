@@ -0,0 +1,215 @@
+# cipher_suites.py - Asymmetric primitives behind the identity keys (RSA or X25519/Ed25519)
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+SUITE_RSA = 'rsa2048'
+SUITE_X25519 = 'x25519-ed25519'
+DEFAULT_SUITE = SUITE_X25519
+
+# Padding configurations are immutable, so one instance serves every call
+OAEP_PADDING = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+PSS_PADDING = padding.PSS(
+    mgf=padding.MGF1(hashes.SHA256()),
+    salt_length=padding.PSS.MAX_LENGTH
+)
+SIGNATURE_HASH = hashes.SHA256()
+
+# X25519 key wrapping: the key-encryption key is used exactly once, so a fixed nonce is safe
+WRAP_INFO = b'secure-chat x25519 key wrap'
+WRAP_NONCE = bytes(12)
+
+PEM_BEGIN = b'-----BEGIN '
+
+def _encryption(passphrase):
+    if passphrase:
+        return serialization.BestAvailableEncryption(passphrase.encode('utf-8'))
+    return serialization.NoEncryption()
+
+def _pem_blocks(pem_data):
+    """Split concatenated PEM blocks"""
+    if isinstance(pem_data, str):
+        pem_data = pem_data.encode('utf-8')
+    starts = []
+    position = pem_data.find(PEM_BEGIN)
+    while position != -1:
+        starts.append(position)
+        position = pem_data.find(PEM_BEGIN, position + 1)
+    return [pem_data[start:end] for start, end in zip(starts, starts[1:] + [len(pem_data)])]
+
+class RSASuite:
+    """RSA-2048 with OAEP key wrapping and PSS signatures (the original keys)"""
+    name = SUITE_RSA
+    key_file_suffix = ''  # keys/<user>.pem, as before suites existed
+
+    def generate_private_key(self):
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def owns(self, key):
+        return isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey))
+
+    def public_bytes(self, public_key):
+        return public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+
+    def load_public_key(self, pem_data):
+        key = serialization.load_pem_public_key(pem_data)
+        if not isinstance(key, rsa.RSAPublicKey):
+            raise ValueError("Not an RSA public key")
+        return key
+
+    def private_bytes(self, private_key, passphrase=None):
+        return private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=_encryption(passphrase)
+        )
+
+    def load_private_key(self, pem_data, passphrase=None):
+        password = passphrase.encode('utf-8') if passphrase else None
+        # Our own key file (owner-only permissions): the RSA consistency checks
+        # would dominate the load time, so they are skipped
+        return serialization.load_pem_private_key(
+            pem_data, password=password, unsafe_skip_rsa_key_validation=True)
+
+    def sign(self, private_key, data):
+        return private_key.sign(data, PSS_PADDING, SIGNATURE_HASH)
+
+    def verify(self, public_key, signature, data):
+        public_key.verify(signature, data, PSS_PADDING, SIGNATURE_HASH)
+
+    def wrap_key(self, public_key, key):
+        return public_key.encrypt(key, OAEP_PADDING)
+
+    def unwrap_key(self, private_key, wrapped_key):
+        return private_key.decrypt(wrapped_key, OAEP_PADDING)
+
+class EdX25519PublicKey:
+    """Ed25519 verification key plus X25519 key agreement key"""
+    __slots__ = ('signing_key', 'agreement_key', 'agreement_bytes')
+
+    def __init__(self, signing_key, agreement_key):
+        self.signing_key = signing_key
+        self.agreement_key = agreement_key
+        self.agreement_bytes = agreement_key.public_bytes(
+            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+class EdX25519PrivateKey:
+    """Ed25519 signing key plus X25519 key agreement key, used as one identity"""
+    __slots__ = ('signing_key', 'agreement_key', '_public_key')
+
+    def __init__(self, signing_key, agreement_key):
+        self.signing_key = signing_key
+        self.agreement_key = agreement_key
+        self._public_key = EdX25519PublicKey(signing_key.public_key(), agreement_key.public_key())
+
+    def public_key(self):
+        return self._public_key
+
+class X25519Suite:
+    """Ed25519 signatures and X25519 (ECIES-style) key wrapping
+
+    A key is wrapped for a recipient with a fresh ephemeral X25519 key: the
+    shared secret goes through HKDF-SHA256 (bound to both public keys) and
+    the result encrypts the key with AES-256-GCM. The wrapped key is the
+    ephemeral public key followed by the ciphertext (80 bytes in total).
+    Public and private keys are two concatenated PEM blocks: Ed25519 first,
+    then X25519.
+    """
+    name = SUITE_X25519
+    key_file_suffix = '.x25519'
+
+    def generate_private_key(self):
+        return EdX25519PrivateKey(Ed25519PrivateKey.generate(), X25519PrivateKey.generate())
+
+    def owns(self, key):
+        return isinstance(key, (EdX25519PrivateKey, EdX25519PublicKey))
+
+    def public_bytes(self, public_key):
+        return b''.join(key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ) for key in (public_key.signing_key, public_key.agreement_key))
+
+    def load_public_key(self, pem_data):
+        blocks = _pem_blocks(pem_data)
+        if len(blocks) != 2:
+            raise ValueError("Expected an Ed25519 and an X25519 public key")
+        signing_key = serialization.load_pem_public_key(blocks[0])
+        agreement_key = serialization.load_pem_public_key(blocks[1])
+        if not isinstance(signing_key, Ed25519PublicKey) or not isinstance(agreement_key, X25519PublicKey):
+            raise ValueError("Expected an Ed25519 and an X25519 public key")
+        return EdX25519PublicKey(signing_key, agreement_key)
+
+    def private_bytes(self, private_key, passphrase=None):
+        return b''.join(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=_encryption(passphrase)
+        ) for key in (private_key.signing_key, private_key.agreement_key))
+
+    def load_private_key(self, pem_data, passphrase=None):
+        password = passphrase.encode('utf-8') if passphrase else None
+        blocks = _pem_blocks(pem_data)
+        if len(blocks) != 2:
+            raise ValueError("Expected an Ed25519 and an X25519 private key")
+        signing_key = serialization.load_pem_private_key(blocks[0], password=password)
+        agreement_key = serialization.load_pem_private_key(blocks[1], password=password)
+        if not isinstance(signing_key, Ed25519PrivateKey) or not isinstance(agreement_key, X25519PrivateKey):
+            raise ValueError("Expected an Ed25519 and an X25519 private key")
+        return EdX25519PrivateKey(signing_key, agreement_key)
+
+    def sign(self, private_key, data):
+        return private_key.signing_key.sign(data)
+
+    def verify(self, public_key, signature, data):
+        public_key.signing_key.verify(signature, data)
+
+    def _key_encryption_key(self, shared_secret, ephemeral_bytes, recipient_bytes):
+        return HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None,
+            info=WRAP_INFO + ephemeral_bytes + recipient_bytes
+        ).derive(shared_secret)
+
+    def wrap_key(self, public_key, key):
+        ephemeral = X25519PrivateKey.generate()
+        ephemeral_bytes = ephemeral.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+        key_encryption_key = self._key_encryption_key(
+            ephemeral.exchange(public_key.agreement_key), ephemeral_bytes, public_key.agreement_bytes)
+        return ephemeral_bytes + AESGCM(key_encryption_key).encrypt(WRAP_NONCE, key, None)
+
+    def unwrap_key(self, private_key, wrapped_key):
+        ephemeral_bytes = bytes(wrapped_key[:32])
+        shared_secret = private_key.agreement_key.exchange(X25519PublicKey.from_public_bytes(ephemeral_bytes))
+        key_encryption_key = self._key_encryption_key(
+            shared_secret, ephemeral_bytes, private_key.public_key().agreement_bytes)
+        return AESGCM(key_encryption_key).decrypt(WRAP_NONCE, bytes(wrapped_key[32:]), None)
+
+SUITES = {suite.name: suite for suite in (X25519Suite(), RSASuite())}  # In order of preference
+
+def get_suite(name):
+    suite = SUITES.get(name)
+    if suite is None:
+        raise ValueError(f"Unknown cipher suite: {name}")
+    return suite
+
+def suite_for_key(key):
+    """Suite of a public or private key object"""
+    for suite in SUITES.values():
+        if suite.owns(key):
+            return suite
+    raise ValueError(f"Unsupported key type: {type(key).__name__}")
+
+def suite_for_pem(pem_data):
+    """Suite of a PEM public or private key, from its number of blocks"""
+    return SUITES[SUITE_X25519] if len(_pem_blocks(pem_data)) == 2 else SUITES[SUITE_RSA]
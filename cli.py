@@ -0,0 +1,192 @@
+# cli.py - Interactive terminal frontend on top of the SecureChatClient core
+import asyncio
+import os
+import threading
+from datetime import datetime
+
+def signature_indicator(signature_valid):
+    """None: the sender's key is unknown, so the signature could not be checked"""
+    if signature_valid is None:
+        return "❔"
+    return "✅" if signature_valid else "❌"
+
+class ChatCLI:
+    """Reads commands from the terminal and prints the events of one session
+
+    input() blocks, so it stays on the main thread. Events are printed and
+    commands awaited on a UI event loop of its own, and the session runs on
+    the network loop (client.NetworkLoop): a slow terminal never delays the
+    connection.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.loop = None
+        self.printer = None
+        self.scrollback = None  # (room, user, seq of the oldest message shown) for /more
+
+    def run(self, host='localhost', port=8888):
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever, name='chat-ui', daemon=True)
+        thread.start()
+        try:
+            if self.call(self.start(host, port)):
+                print("\n💬 Chat iniciado. Esperando intercambio de llaves...")
+                try:
+                    while True:
+                        message = input()
+                        if message.lower() == 'quit':
+                            break
+                        self.call(self.handle_command(message))
+                except (EOFError, KeyboardInterrupt):
+                    print("\n👋 Cerrando chat...")
+                self.call(self.stop())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            thread.join()
+            self.loop.close()
+
+    def call(self, coroutine):
+        """Run a coroutine on the UI loop and wait for it"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def start(self, host, port):
+        events = self.client.messages()  # Subscribed before connecting: nothing is missed
+        self.printer = asyncio.create_task(self.print_events(events))
+        try:
+            await self.client.connect(host, port)
+        except Exception as e:
+            print(f"❌ Error de conexión: {e}")
+            events.close()
+            self.printer.cancel()
+            return False
+        return True
+
+    async def stop(self):
+        await self.client.disconnect()
+        await self.printer  # Ends with the session's events
+
+    async def print_events(self, events):
+        async for event in events:
+            text = self.format_event(event)
+            if text is not None:
+                print(text)
+
+    def format_event(self, event):
+        event_type = event['type']
+        if event_type == 'notice':
+            return event['text']
+        if event_type == 'message':
+            timestamp = datetime.fromtimestamp(event['timestamp']).strftime('%H:%M:%S')
+            if event['room']:
+                conversation = f"[{event['room']}] "
+            elif event['private']:
+                conversation = "[privado] "
+            else:
+                conversation = ""
+            text = f"\n{timestamp} {signature_indicator(event['signature_valid'])} {conversation}{event['from']}: {event['text']}"
+            if event['signature_valid'] is None:
+                text += f"\n⚠️  ADVERTENCIA: {event['from']} no está en el directorio, firma no verificable!"
+            elif not event['signature_valid']:
+                text += "\n⚠️  ADVERTENCIA: Firma digital inválida!"
+            return text
+        if event_type == 'sent':
+            timestamp = datetime.fromtimestamp(event['timestamp']).strftime('%H:%M:%S')
+            if event['room'] is not None:
+                return f"{timestamp} ✅ [{event['room']}] Tú: {event['text']}"
+            if event['to'] is not None:
+                return f"{timestamp} ✅ [privado → {event['to']}] Tú: {event['text']}"
+            return f"{timestamp} ✅ Tú: {event['text']}"
+        return None
+
+    async def show_history(self, room, user, before=None, limit=20):
+        """Print one page of history; /more prints the one before it"""
+        records = await self.client.load_history(room, user, before, limit)
+        if not records:
+            print("📜 No hay más historial")
+            self.scrollback = None
+            return
+        print(f"📜 Historial de {'#' + room if room is not None else user}:")
+        for record in records:
+            timestamp = datetime.fromtimestamp(record['timestamp']).strftime('%d/%m %H:%M:%S')
+            print(f"   {timestamp} {signature_indicator(record['signature_valid'])} {record['from']}: {record['text']}")
+        self.scrollback = (room, user, records[0]['seq'])
+
+    async def handle_command(self, message):
+        client = self.client
+        if message.lower() == 'cache':
+            print("📋 Comandos de cache disponibles:")
+            print("   cache - Mostrar esta ayuda")
+            print("   cache clear - Limpiar cache de identidades")
+            print("   cache show - Mostrar identidades en cache")
+        elif message.lower() == 'cache clear':
+            client.key_cache.clear_cache()
+            client.directory.revalidate()
+            print("🗑️  Cache limpiado")
+        elif message.lower() == 'cache show':
+            verified_keys = client.key_cache.items()
+            if verified_keys:
+                print("📋 Identidades verificadas en cache:")
+                for username, fingerprint in verified_keys:
+                    print(f"   {username}: {fingerprint}")
+            else:
+                print("📋 No hay identidades en cache")
+        elif message.lower() == 'verify' or message.lower().startswith('verify '):
+            if await client.verify(message[len('verify'):].strip() or None):
+                print("✅ Verificación confirmada. Chat seguro establecido!")
+                print("💬 Ya puedes enviar mensajes seguros.")
+                print("💾 Identidad guardada en cache para futuras conexiones")
+        elif message.startswith('/join '):
+            await client.join_room(message[len('/join '):].strip())
+        elif message.startswith('/leave'):
+            room = message[len('/leave'):].strip() or client.active_room
+            if room:
+                await client.leave_room(room)
+            else:
+                print("❌ No estás en ninguna sala")
+        elif message.startswith('/msg '):
+            parts = message.split(' ', 2)
+            if len(parts) < 3 or not parts[2].strip():
+                print("❌ Uso: /msg <usuario> <mensaje>")
+            else:
+                await client.send(parts[2], to=parts[1])
+        elif message.startswith('/send '):
+            target = message[len('/send '):].strip()
+            to = client.peer_username
+            if target.startswith('@'):
+                to, _, target = target[1:].partition(' ')
+                target = target.strip()
+            if not target or not to:
+                print("❌ Uso: /send [@usuario] <ruta>")
+            else:
+                await client.send_file(os.path.expanduser(target), to)
+        elif message == '/history' or message.startswith('/history '):
+            target = message[len('/history'):].strip()
+            room, user = client.active_room, client.peer_username
+            if target.startswith('#'):
+                room, user = target[1:], None
+            elif target:
+                room, user = None, target
+            if room is None and user is None:
+                print("❌ Uso: /history [#sala|usuario]")
+            else:
+                await self.show_history(room, user)
+        elif message == '/more':
+            if self.scrollback is None:
+                print("❌ Usa /history primero")
+            else:
+                await self.show_history(*self.scrollback)
+        elif message == '/rooms':
+            rooms = list(client.rooms.items())  # Snapshot: the network loop updates it
+            if rooms:
+                for room, members in rooms:
+                    marker = "*" if room == client.active_room else " "
+                    print(f" {marker} {room}: {', '.join(sorted(members | {client.username}))}")
+            else:
+                print("📋 No estás en ninguna sala")
+        elif message.strip():
+            if client.active_room:
+                await client.send(message, room=client.active_room)
+                return
+            if not client.verified and client.peer_username:
+                print("⚠️  Advertencia: Enviando mensaje sin verificar fingerprint")
+            await client.send(message)
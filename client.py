@@ -1,263 +1,948 @@
-# client.py - Secure chat client
+# client.py - Secure chat client core, on asyncio (cli.py is the terminal frontend)
+import asyncio
+import functools
+import os
+import random
 import socket
+import sqlite3
 import threading
-import json
 import time
-import os
-import pickle
-from datetime import datetime
-from crypto_utils import CryptoManager
-
-class KeyCache:
-    def __init__(self, cache_file="verified_keys.pkl"):
-        self.cache_file = cache_file
-        self.verified_keys = self.load_cache()
-    
-    def load_cache(self):
-        """Load verified keys from cache file"""
-        if os.path.exists(self.cache_file):
-            try:
-                with open(self.cache_file, 'rb') as f:
-                    return pickle.load(f)
-            except Exception as e:
-                print(f"⚠️  Error cargando cache: {e}")
-                return {}
-        return {}
-    
-    def save_cache(self):
-        """Save verified keys to cache file"""
+from crypto_utils import CryptoManager, LEGACY_PROTOCOL_VERSION, PROTOCOL_VERSION
+from cipher_suites import DEFAULT_SUITE, SUITE_RSA, SUITES, get_suite
+from protocol import FrameDecoder, encode_message
+from trust_store import KeyCache, SHARED_CACHE_FILE
+from key_directory import DirectoryCache, DirectoryEntry, TRUST_CHANGED
+from receive_pipeline import ReceivePipeline
+from file_transfer import FileTransferManager
+from history_store import HistoryStore
+from session_tickets import resume_proof_data
+from metrics import registry
+
+RECV_BYTES = registry.counter('client.recv_bytes')
+MESSAGES_RECEIVED = registry.counter('client.messages_received')
+MESSAGES_SENT = registry.counter('client.messages_sent')
+SEND_BYTES = registry.counter('client.send_bytes')
+KEY_CACHE_HITS = registry.counter('client.key_directory_hits')
+KEY_LOOKUPS = registry.counter('client.key_lookups')
+RECONNECTS = registry.counter('client.reconnects')
+EVENTS_DROPPED = registry.counter('client.events_dropped')
+
+# Reconnection backoff: doubles after every failed attempt, with jitter
+RECONNECT_INITIAL_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+def on_client_loop(method):
+    """Run a coroutine method on the session's event loop, whichever loop awaits it"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if self.loop is None or self.loop is asyncio.get_running_loop():
+            return await method(self, *args, **kwargs)
+        future = asyncio.run_coroutine_threadsafe(method(self, *args, **kwargs), self.loop)
+        return await asyncio.wrap_future(future)
+    return wrapper
+
+def current_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+class NetworkLoop:
+    """An event loop on a background thread that hosts client sessions
+
+    Frontends with their own loop (or none) create their sessions with
+    loop=network.loop; any number of sessions can share it.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='chat-network', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self, coroutine, timeout=None):
+        """Run a coroutine on the network loop and wait for its result (from another thread)"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+class EventStream:
+    """Events for one messages() consumer, queued on the consumer's loop
+
+    The queue is bounded: when the consumer falls behind, the oldest events
+    are dropped rather than stalling the network loop.
+    """
+    def __init__(self, client, max_events):
+        self.client = client
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(max_events)
+        client.streams = client.streams + [self]  # Copied: published from other threads
+
+    def put(self, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+            EVENTS_DROPPED.inc()
+        self.queue.put_nowait(event)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.queue.get()
+        if event is None:
+            self.close()
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        self.client.streams = [stream for stream in self.client.streams if stream is not self]
+
+class ClientProtocol(asyncio.BufferedProtocol):
+    """One connection of a SecureChatClient: frames are read straight into the decoder"""
+    def __init__(self, client):
+        self.client = client
+        self.decoder = FrameDecoder()
+        self.transport = None
+        self.writable = asyncio.Event()  # Cleared while the transport buffer is full
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        RECV_BYTES.inc(nbytes)
+        self.decoder.buffer_updated(nbytes)
         try:
-            with open(self.cache_file, 'wb') as f:
-                pickle.dump(self.verified_keys, f)
+            messages = list(self.decoder.messages())
         except Exception as e:
-            print(f"⚠️  Error guardando cache: {e}")
-    
-    def is_verified(self, username, fingerprint):
-        """Check if a username-fingerprint pair is verified"""
-        return self.verified_keys.get(username) == fingerprint
-    
-    def mark_verified(self, username, fingerprint):
-        """Mark a username-fingerprint pair as verified"""
-        self.verified_keys[username] = fingerprint
-        self.save_cache()
-        print(f"💾 Identidad de {username} guardada en cache")
-    
-    def get_cached_fingerprint(self, username):
-        """Get cached fingerprint for a username"""
-        return self.verified_keys.get(username)
-    
-    def clear_cache(self):
-        """Clear all cached keys"""
-        self.verified_keys = {}
-        if os.path.exists(self.cache_file):
-            os.remove(self.cache_file)
-        print("🗑️  Cache limpiado")
+            self.client.notice(f"❌ Error recibiendo mensaje: {e}")
+            self.transport.close()
+            return
+        MESSAGES_RECEIVED.inc(len(messages))
+        self.client.receive_batch(self, messages)
+
+    def connection_lost(self, exc):
+        self.writable.set()
+        self.client.connection_lost(self, exc)
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+def conversation_name(room=None, user=None):
+    """History conversation of a room, or of the direct messages with a user"""
+    return f"room:{room}" if room is not None else f"user:{user}"
 
 class SecureChatClient:
-    def __init__(self, username):
+    """One chat session: registration, keys, rooms and end-to-end encryption
+
+    The session lives on one asyncio event loop (the loop given, or the one
+    connect() is awaited on). Its public coroutines can be awaited from any
+    other loop too, so a GUI or the CLI keeps its own loop and one process
+    can run many sessions. Whatever the session has to show (chat messages,
+    fingerprints, notices) comes out of messages() as dicts.
+    """
+    def __init__(self, username, key_dir='keys', passphrase=None, key_pool=None, ephemeral=False,
+                 receive_workers=None, download_dir='downloads', transfer_dir='transfers', suite=None,
+                 loop=None, max_events=1024, history_dir='history'):
         self.username = username
         self.crypto = CryptoManager()
-        self.socket = None
+        self.suite = suite  # Cipher suite of the identity (None: the existing one, or the default)
+        self.server_suites = None  # Suites the server accepts, from the registration
+        self.key_dir = key_dir  # Persistent identity keys
+        self.passphrase = passphrase  # Encrypts the identity key on disk
+        self.key_pool = key_pool  # Pre-generated keys (KeyPool)
+        self.ephemeral = ephemeral  # Use a throwaway key instead of the identity
+        self.loop = loop  # Event loop of the session (None: the one connect() runs on)
+        self.registered = asyncio.Event()
+        self.receive_workers = receive_workers  # Crypto threads (None: pool shared by the sessions, 0: inline)
+        self.pipeline = None
+        self.protocol = None  # ClientProtocol of the current connection
+        self.host = None
+        self.port = None
         self.connected = False
+        self.ticket = None  # Session ticket from the server, presented when reconnecting
+        self.reconnecting = False  # Connection lost: messages wait in the outbox
+        # Grows with every attempt until registered again, so a server that
+        # keeps refusing the connection (full, or rate limiting) is not hammered
+        self.reconnect_delay = RECONNECT_INITIAL_DELAY
+        self.reconnect_task = None
+        self.outbox = []  # [(message, room, to)] sent while reconnecting
+        self.send_lock = asyncio.Lock()  # Keeps encryption and writes in send order
+        self.tasks = set()  # Background tasks, referenced until done
+        self.streams = []  # EventStreams of the messages() consumers
+        self.max_events = max_events
         self.peer_username = None
-        self.key_cache = KeyCache()  # Initialize key cache
+        # Pins of the identities this user verified, next to their identity key
+        self.key_cache = KeyCache(os.path.join(key_dir, f"{username}_verified_keys.db"),
+                                  shared_file=SHARED_CACHE_FILE,
+                                  on_error=lambda e: self.notice(f"⚠️  Error importando identidades verificadas: {e}"))
+        self.directory = DirectoryCache(self.key_cache)  # Keys fetched from the server directory
+        self.lookups_in_flight = set()  # Usernames asked to the directory, not answered yet
         self.verified = False  # Track verification status
-        
-    def connect(self, host='localhost', port=8888):
-        """Connect to server and register user"""
+        self.rooms = {}  # {room: set of other members}
+        self.active_room = None  # Room that receives plain text input
+        self.pending_messages = {}  # {username: [messages]} waiting for a key
+        # Received while a sender's key is looked up: everything after the
+        # first such message waits with it, so arrival order is kept
+        self.held_messages = []
+        self.awaited_senders = set()  # Senders whose key the held messages wait for
+        self.unknown_senders = set()  # Senders the directory does not know (unverifiable)
+        self.transfers = FileTransferManager(self, download_dir, transfer_dir)
+        self.history_dir = history_dir  # Encrypted local history (None: not kept)
+        self.history = None  # HistoryStore, opened once the identity key is loaded
+
+    # Events
+
+    def messages(self):
+        """Async iterator over the session's events, until it disconnects
+
+        Every event is a dict with a 'type': 'message' (a received chat
+        message), 'sent', 'registered' or 'notice' (text for the user).
+        It can be iterated on another loop than the session's.
+        """
+        return EventStream(self, self.max_events)
+
+    def publish(self, event):
+        """Hand an event to every consumer (callable from any thread)"""
+        running = current_loop()
+        for stream in self.streams:
+            if stream.loop is running:
+                stream.put(event)
+            else:
+                stream.loop.call_soon_threadsafe(stream.put, event)
+
+    def notice(self, text):
+        self.publish({'type': 'notice', 'text': text})
+
+    def spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    # Connection
+
+    @on_client_loop
+    async def connect(self, host='localhost', port=8888, timeout=10.0):
+        """Connect, register (or resume) and wait until the server confirms it"""
+        self.loop = asyncio.get_running_loop()
+        # Load (or create) our keypair: disk and key generation stay off the loop
+        if self.crypto.private_key is None:
+            await self.loop.run_in_executor(None, self.load_keys)
+        if self.history is None and self.history_dir and not self.ephemeral:
+            await self.loop.run_in_executor(None, self.open_history)
+
+        # Show our public key fingerprint
+        self.notice(f"🔍 Tu fingerprint de llave pública:\n    {self.crypto.get_public_key_fingerprint()}")
+
+        self.host = host
+        self.port = port
+        if self.receive_workers != 0 and self.pipeline is None:
+            self.pipeline = ReceivePipeline(
+                self.open_message, self.show_message, self.handle_received_message,
+                workers=self.receive_workers, on_error=self.notice, hold=self.hold_message
+            )
+        await self.open_connection()
+        self.connected = True
         try:
-            # Generate keypair
-            print("🔐 Generando par de llaves RSA...")
-            self.crypto.generate_keypair()
-            
-            # Show our public key fingerprint
-            fingerprint = self.crypto.get_public_key_fingerprint()
-            print(f"🔍 Tu fingerprint de llave pública:")
-            print(f"    {fingerprint}")
-            
-            # Connect to server
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((host, port))
-            
-            # Register user by sending public key
-            register_data = {
-                'username': self.username,
-                'public_key': self.crypto.get_public_key_pem().decode('utf-8')
-            }
-            self.socket.send(json.dumps(register_data).encode('utf-8'))
-            
-            # FIX: Set connected BEFORE starting the thread to avoid race condition
-            self.connected = True
-            
-            # Start receive thread
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
-            
-            print(f"✅ Conectado como {self.username}")
-            
-        except Exception as e:
-            print(f"❌ Error de conexión: {e}")
-    
-    def receive_messages(self):
-        """Thread to receive messages from server"""
+            await asyncio.wait_for(self.registered.wait(), timeout)
+        except asyncio.TimeoutError:
+            await self.disconnect()
+            raise ConnectionError("el servidor no confirmó el registro")
+        self.notice(f"✅ Conectado como {self.username}")
+
+    async def open_connection(self):
+        """Open the connection and resume the session (with a ticket) or register"""
+        _, self.protocol = await self.loop.create_connection(
+            lambda: ClientProtocol(self), self.host, self.port)
+        if self.ticket is None:
+            self.send_registration()
+            return
+        self.send_resume()
+
+    def send_resume(self, challenge=None):
+        """Present the ticket; the server answers with a challenge to sign with the identity key"""
+        message = {
+            'type': 'resume',
+            'ticket': self.ticket,
+            'rooms': list(self.rooms),  # Restored with their current members
+            'offline_acks': True
+        }
+        if challenge is not None:
+            message['signature'] = self.crypto.sign_data(resume_proof_data(challenge, self.ticket))
+        self.write(encode_message(message))
+
+    def connection_lost(self, protocol, exc):
+        if protocol is not self.protocol or not self.connected:
+            return
+        self.reconnecting = True
+        self.registered.clear()
+        self.notice(f"⚠️  Conexión perdida ({exc or 'cerrada por el servidor'}), reconectando...")
+        self.reconnect_task = self.spawn(self.reconnect())
+
+    async def reconnect(self):
+        """Reconnect with exponential backoff until it works or the client disconnects"""
+        # Uploads stop (saving their progress) and are offered again once registered
+        await self.loop.run_in_executor(None, self.transfers.suspend)
         while self.connected:
+            delay = self.reconnect_delay
+            self.reconnect_delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            # Jitter spreads the clients of a restarted server over the delay
+            await asyncio.sleep(random.uniform(delay / 2, delay))
             try:
-                data = self.socket.recv(4096).decode('utf-8')
-                if not data:
-                    break
-                    
-                message = json.loads(data)
+                await self.open_connection()
+                RECONNECTS.inc()
+                return
+            except OSError as e:
+                self.notice(f"⚠️  Reconexión fallida ({e}), reintentando en {self.reconnect_delay:.0f}s")
+
+    async def flush_outbox(self):
+        """Send what was sent while reconnecting, in order"""
+        while self.outbox:
+            pending, self.outbox = self.outbox, []
+            for message, room, to in pending:
+                await self.send_now(message, room, to)
+        self.reconnecting = False
+
+    async def resume_session(self):
+        """Back online after a reconnection: the outbox first, then the interrupted uploads"""
+        await self.flush_outbox()
+        self.transfers.resume_outgoing()
+
+    def write(self, frame):
+        """Queue a frame on the connection (on the loop; the transport buffers it)"""
+        if self.protocol is None or self.protocol.transport.is_closing():
+            raise ConnectionError("sin conexión con el servidor")
+        self.protocol.transport.write(frame)
+
+    def write_threadsafe(self, frame):
+        """Queue a frame from another thread; dropped if the connection is gone"""
+        self.loop.call_soon_threadsafe(self._write_if_connected, frame)
+
+    def _write_if_connected(self, frame):
+        if self.protocol is not None and not self.protocol.transport.is_closing():
+            self.protocol.transport.write(frame)
+
+    def receive_batch(self, protocol, messages):
+        """Messages decoded from one read of the connection"""
+        if self.pipeline is None:
+            for message in messages:
                 self.handle_received_message(message)
-                
-            except Exception as e:
-                if self.connected:
-                    print(f"❌ Error recibiendo mensaje: {e}")
-                break
-    
+        elif not self.pipeline.submit_batch(messages):
+            # Backlog full: stop reading (TCP pushes back on the server) until it is delivered
+            protocol.transport.pause_reading()
+            self.pipeline.on_drained = protocol.transport.resume_reading
+
+    def send_registration(self):
+        """Register with our public key, its cipher suite and the suites we can use"""
+        self.write(encode_message({
+            'type': 'register',
+            'username': self.username,
+            'public_key': self.crypto.get_public_key_pem().decode('utf-8'),
+            'suite': self.crypto.suite.name,
+            'suites': list(SUITES),
+            'offline_acks': True  # Stored messages are deleted once we opened them
+        }))
+
+    def identity_key_path(self, suite=SUITE_RSA):
+        return os.path.join(self.key_dir, f"{self.username}{get_suite(suite).key_file_suffix}.pem")
+
+    def load_keys(self, suite=None):
+        """Load the identity key from disk, creating it on first run (blocking)
+
+        Without a suite, an existing identity is preferred (its fingerprint
+        is the one contacts verified), then the default suite.
+        """
+        if suite is None:
+            suite = self.suite or next(
+                (name for name in SUITES if os.path.exists(self.identity_key_path(name))), DEFAULT_SUITE)
+        path = self.identity_key_path(suite)
+        if not self.ephemeral and os.path.exists(path):
+            self.crypto.load_private_key(path, self.passphrase)
+            self.notice(f"🔐 Llave de identidad cargada ({suite})")
+            return
+
+        if suite == SUITE_RSA and self.key_pool is not None:
+            self.crypto.set_private_key(self.key_pool.get(timeout=5))
+            self.notice("🔐 Par de llaves RSA tomado del pool")
+        else:
+            self.notice(f"🔐 Generando par de llaves {suite}...")
+            self.crypto.generate_keypair(suite)
+
+        if not self.ephemeral:
+            self.crypto.save_private_key(path, self.passphrase)
+            self.notice(f"💾 Llave de identidad guardada en {path}")
+
+    def open_history(self):
+        """Open the local history with a key derived from the identity (blocking)
+
+        Each identity key has its own history: a new identity starts an
+        empty one, since it could not decrypt the old one.
+        """
+        identity = self.crypto.get_public_key_fingerprint().replace(':', '')[:16]
+        try:
+            self.history = HistoryStore(os.path.join(self.history_dir, self.username, identity),
+                                        self.crypto.derive_storage_key(b'history'),
+                                        on_error=lambda e: self.notice(f"❌ Error guardando historial: {e}"))
+        except ValueError as e:
+            self.notice(f"⚠️  {e}: no se guardará historial")
+
+    def record_history(self, conversation, record):
+        """Queue a message for the history; written by the history's own thread"""
+        if self.history is not None:
+            self.history.append(conversation, record)
+
+    async def renegotiate_suite(self, server_suites):
+        """The server refused our identity's suite: register again with one it accepts"""
+        suite = next((name for name in SUITES if name in server_suites and name != self.crypto.suite.name), None)
+        if suite is None:
+            self.notice("❌ No hay suites de cifrado en común con el servidor")
+            return
+        self.notice(f"🔄 Cambiando a la suite {suite}")
+        await self.loop.run_in_executor(None, self.load_keys, suite)
+        self.notice(f"🔍 Tu fingerprint de llave pública:\n    {self.crypto.get_public_key_fingerprint()}")
+        self.send_registration()
+
+    # Receiving
+
     def handle_received_message(self, message):
-        """Handle messages received from server"""
+        """Handle messages received from server (in arrival order, on the loop)"""
         msg_type = message.get('type')
-        
+
         if msg_type == 'registration_success':
-            print(f"🎉 {message['message']}")
-            
+            self.notice(f"🎉 {message['message']}")
+            self.server_suites = message.get('suites', [SUITE_RSA])
+            self.ticket = message.get('ticket')
+            if self.reconnecting:
+                # Registered from scratch: join the rooms we were in again
+                for room in self.rooms:
+                    self.write(encode_message({'type': 'join_room', 'room': room}))
+            self.on_registered(resumed=False)
+
+        elif msg_type == 'resume_challenge':
+            self.send_resume(message['nonce'])
+
+        elif msg_type == 'resumed':
+            self.notice(f"🔄 {message['message']}")
+            self.server_suites = message.get('suites', [SUITE_RSA])
+            self.ticket = message['ticket']
+            self.on_registered(resumed=True)
+
         elif msg_type == 'key_exchange':
             # Receive peer's public key
-            self.peer_username = message['from']
+            username = message['from']
             peer_public_key_pem = message['public_key'].encode('utf-8')
-            self.crypto.load_peer_public_key(peer_public_key_pem)
-            
-            # Show peer's fingerprint for verification
-            peer_fingerprint = self.crypto.get_public_key_fingerprint(self.crypto.peer_public_key)
-            
-            # Check if this peer is already verified in cache
-            cached_fingerprint = self.key_cache.get_cached_fingerprint(self.peer_username)
-            is_cached = self.key_cache.is_verified(self.peer_username, peer_fingerprint)
-            
-            print(f"\n🔑 Intercambio de llaves con {self.peer_username}")
-            print(f"🔍 Fingerprint de {self.peer_username}:")
-            print(f"    {peer_fingerprint}")
-            
-            if is_cached:
-                print("✅ Usuario verificado previamente - Identidad confiable")
-                print("💬 Ya puedes enviar mensajes seguros")
-                self.verified = True
+
+            if message.get('requested'):
+                # Answer to a key request for a direct message
+                self.crypto.add_peer_public_key(username, peer_public_key_pem)
+                self.show_peer_fingerprint(username)
+                self.flush_pending_messages(username)
             else:
-                if cached_fingerprint:
-                    print(f"⚠️  Fingerprint cambiado desde la última verificación!")
-                    print(f"   Anterior: {cached_fingerprint}")
-                    print(f"   Actual:   {peer_fingerprint}")
-                
-                print("⚠️  IMPORTANTE: Verifica este fingerprint con tu contacto por un canal seguro!")
-                print("💬 Escribe 'verify' para confirmar verificación y habilitar el chat seguro")
-                print("📝 O escribe mensajes directamente (sin verificar, bajo tu responsabilidad)")
-            
+                self.peer_username = username
+                self.crypto.load_peer_public_key(peer_public_key_pem, username)
+                if self.show_peer_fingerprint(username):
+                    self.verified = True
+            self.release_held(username)
+
+        elif msg_type == 'key_directory':
+            self.on_key_directory(message)
+
+        elif msg_type == 'offline_batch':
+            self.ack_offline(message)
+
+        elif msg_type == 'room_members':
+            room = message['room']
+            known = self.rooms.get(room)
+            self.rooms[room] = set(message['members'])
+            if known is None:
+                self.notice(f"\n🚪 Te uniste a la sala {room} ({len(message['members']) + 1} miembros)")
+            for username, public_key_pem in message['members'].items():
+                self.crypto.add_peer_public_key(username, public_key_pem.encode('utf-8'))
+                if known is None or username not in known:
+                    if known is not None:
+                        # Restored after a reconnection: only the changes are shown
+                        self.notice(f"\n🚪 {username} se unió a la sala {room}")
+                    self.show_member_fingerprint(username)
+                self.release_held(username)
+            for username in (known or set()) - self.rooms[room]:
+                self.notice(f"\n🚪 {username} salió de la sala {room}")
+
+        elif msg_type == 'member_joined':
+            room = message['room']
+            username = message['username']
+            self.crypto.add_peer_public_key(username, message['public_key'].encode('utf-8'))
+            # Possibly a restarted client without the keys of our earlier messages
+            self.crypto.forget_sessions(username)
+            self.rooms.setdefault(room, set()).add(username)
+            self.notice(f"\n🚪 {username} se unió a la sala {room}")
+            self.show_member_fingerprint(username)
+            self.release_held(username)
+
+        elif msg_type == 'member_left':
+            room = message['room']
+            # The sender key rotates automatically on the next message
+            self.rooms.get(room, set()).discard(message['username'])
+            self.notice(f"\n🚪 {message['username']} salió de la sala {room}")
+
+        elif msg_type in ('file_offer', 'file_chunk', 'file_ack'):
+            self.transfers.handle(message)
+
+        elif msg_type == 'error':
+            self.notice(f"❌ Servidor: {message['message']}")
+            if message.get('resume_failed'):
+                self.ticket = None
+                self.send_registration()
+            elif 'suites' in message and not self.registered.is_set():
+                self.spawn(self.renegotiate_suite(message['suites']))
+
         elif msg_type == 'encrypted_message':
+            if self.hold_message(message):
+                return
             # Decrypt and verify message
             try:
-                sender = message['from']
-                encrypted_content = message['encrypted_content']
-                signature = message['signature']
-                timestamp = datetime.fromtimestamp(message['timestamp'])
-                
-                # Decrypt message
-                decrypted_message = self.crypto.decrypt_message(encrypted_content)
-                
-                # Verify signature
-                signature_valid = self.crypto.verify_signature(decrypted_message, signature)
-                signature_indicator = "✅" if signature_valid else "❌"
-                
-                print(f"\n{timestamp.strftime('%H:%M:%S')} {signature_indicator} {sender}: {decrypted_message}")
-                
-                if not signature_valid:
-                    print("⚠️  ADVERTENCIA: Firma digital inválida!")
-                    
+                self.show_message(message, self.open_message(message))
             except Exception as e:
-                print(f"❌ Error procesando mensaje: {e}")
-    
-    def send_message(self, message):
-        """Send encrypted message"""
-        if not self.crypto.peer_public_key:
-            print("❌ No se puede enviar mensaje: llave del peer no disponible")
+                self.notice(f"❌ Error procesando mensaje: {e}")
+
+    def on_registered(self, resumed):
+        self.registered.set()
+        self.reconnect_delay = RECONNECT_INITIAL_DELAY
+        self.publish({'type': 'registered', 'resumed': resumed})
+        # Lookups sent on a lost connection are never answered: ask again
+        self.lookups_in_flight.clear()
+        waiting = list(self.awaited_senders) + list(self.pending_messages)
+        if waiting:
+            self.request_keys(waiting)
+        self.prefetch_contacts()
+        if self.reconnecting:
+            self.spawn(self.resume_session())
+        else:
+            self.transfers.resume_outgoing()
+
+    def open_message(self, message):
+        """Decrypt and verify a message (runs on a receive pipeline worker)"""
+        sender = message['from']
+        version = message.get('version', LEGACY_PROTOCOL_VERSION)
+        order_check = None
+
+        # Decrypt message according to its wire format version
+        if version == PROTOCOL_VERSION:
+            decrypted_message, session_key, counter = self.crypto.open_session_message(message, self.username)
+            order_check = (session_key, counter)
+        elif version == LEGACY_PROTOCOL_VERSION:
+            decrypted_message = self.crypto.decrypt_message(message['encrypted_content'])
+        else:
+            raise ValueError(f"Versión de protocolo no soportada: {version}")
+
+        # Verify signature, only ever with the sender's own key: None if the
+        # directory does not know the sender (hold_message waited for its answer)
+        sender_public_key = self.crypto.peer_public_keys.get(sender)
+        if sender_public_key is None:
+            signature_valid = None
+        else:
+            signature_valid = self.crypto.verify_signature(decrypted_message, message['signature'], sender_public_key)
+        return decrypted_message, signature_valid, order_check
+
+    def hold_message(self, message):
+        """Set aside a message whose sender's key is not known yet; True if held
+
+        The sender is resolved through the directory cache first; only on a
+        miss is the server asked. Until it answers the messages of every
+        sender are held behind it, and they are opened in arrival order
+        once it does (release_held).
+        """
+        sender = message.get('from')
+        if (sender not in self.crypto.peer_public_keys and sender not in self.unknown_senders
+                and sender not in self.awaited_senders and not self.resolve_cached(sender)):
+            self.awaited_senders.add(sender)
+            self.request_keys([sender])
+        if not self.awaited_senders:
+            return False
+        self.held_messages.append(message)
+        return True
+
+    def resolve_cached(self, username):
+        """Load a user's key from the directory cache; False on a miss
+
+        A stale entry is used right away and revalidated in the background,
+        as when sending.
+        """
+        entry = self.directory.get(username)
+        if entry is None:
+            return False
+        try:
+            self.crypto.add_peer_public_key(username, entry.public_key.encode('utf-8'))
+        except ValueError:
+            return False
+        if self.directory.is_fresh(entry):
+            KEY_CACHE_HITS.inc()
+        else:
+            self.request_keys([username])
+        return True
+
+    def ack_offline(self, marker):
+        """Acknowledge a replayed batch: the server deletes it from its store
+
+        The marker is handled in order, once every message before it was
+        opened; while some of them are held it is held with them.
+        """
+        if self.awaited_senders:
+            self.held_messages.append(marker)
+            return
+        self._write_if_connected(encode_message({'type': 'offline_ack', 'seq': marker['seq']}))
+
+    def release_held(self, username):
+        """A sender's key arrived (or the directory does not know it): open what it held"""
+        if username in self.crypto.peer_public_keys:
+            self.unknown_senders.discard(username)
+        if username not in self.awaited_senders:
             return
-            
+        self.awaited_senders.discard(username)
+        if self.awaited_senders:
+            return  # Still waiting for another sender
+        held, self.held_messages = self.held_messages, []
+        if self.pipeline is not None:
+            # Ahead of what was received since: they arrived before it
+            self.pipeline.resubmit(held)
+        else:
+            for message in held:
+                self.handle_received_message(message)
+
+    def show_message(self, message, opened):
+        """Publish an opened message (runs in arrival order)"""
+        decrypted_message, signature_valid, order_check = opened
+        if order_check is not None:
+            self.crypto.accept_counter(*order_check)
+
+        sender = message['from']
+        event = {
+            'type': 'message',
+            'from': sender,
+            'text': decrypted_message,
+            'timestamp': message['timestamp'],
+            'room': message.get('room'),
+            # A direct message outside the two-party chat
+            'private': not message.get('room') and bool(message.get('to')) and sender != self.peer_username,
+            'signature_valid': signature_valid,
+        }
+        self.publish(event)
+        self.record_history(conversation_name(event['room'], sender), {
+            'from': sender,
+            'text': decrypted_message,
+            'timestamp': event['timestamp'],
+            'signature_valid': signature_valid,
+        })
+
+    def show_peer_fingerprint(self, username):
+        """Show a peer's fingerprint; returns True if it was already verified"""
+        peer_fingerprint = self.crypto.get_public_key_fingerprint(self.crypto.peer_public_keys[username])
+
+        # Check if this peer is already verified in cache
+        cached_fingerprint = self.key_cache.get_cached_fingerprint(username)
+        is_cached = self.key_cache.is_verified(username, peer_fingerprint)
+
+        lines = [
+            f"\n🔑 Intercambio de llaves con {username}",
+            f"🔍 Fingerprint de {username}:",
+            f"    {peer_fingerprint}",
+        ]
+        if is_cached:
+            lines.append("✅ Usuario verificado previamente - Identidad confiable")
+            lines.append("💬 Ya puedes enviar mensajes seguros")
+        else:
+            if cached_fingerprint:
+                lines.append("⚠️  Fingerprint cambiado desde la última verificación!")
+                lines.append(f"   Anterior: {cached_fingerprint}")
+                lines.append(f"   Actual:   {peer_fingerprint}")
+
+            lines.append("⚠️  IMPORTANTE: Verifica este fingerprint con tu contacto por un canal seguro!")
+            lines.append(f"💬 Escribe 'verify {username}' para confirmar verificación y habilitar el chat seguro")
+            lines.append("📝 O escribe mensajes directamente (sin verificar, bajo tu responsabilidad)")
+        self.notice("\n".join(lines))
+        return is_cached
+
+    def show_member_fingerprint(self, username):
+        """Show a one-line fingerprint status for a room member"""
+        fingerprint = self.crypto.get_public_key_fingerprint(self.crypto.peer_public_keys[username])
+        cached_fingerprint = self.key_cache.get_cached_fingerprint(username)
+        if cached_fingerprint == fingerprint:
+            self.notice(f"   ✅ {username} (verificado)")
+        elif cached_fingerprint:
+            self.notice(f"   ⚠️  {username}: fingerprint cambiado! {fingerprint}")
+        else:
+            self.notice(f"   ⚠️  {username} (sin verificar): {fingerprint}")
+
+    # Sending
+
+    @on_client_loop
+    async def send(self, message, room=None, to=None):
+        """Encrypt, sign and send a message to a room, a user or the current peer
+
+        Returns True once the message is written to the connection. While
+        reconnecting it is queued, and a direct message to a user whose key
+        is not known yet waits for the directory; both return False.
+        """
+        if self.reconnecting:
+            self.outbox.append((message, room, to))
+            self.notice("⏳ Sin conexión: el mensaje se enviará al reconectar")
+            return False
+        return await self.send_now(message, room, to)
+
+    async def send_now(self, message, room=None, to=None):
+        if room is not None:
+            if room not in self.rooms:
+                self.notice(f"❌ No perteneces a la sala {room}")
+                return False
+            recipients = self.rooms[room] - {self.username}
+            conversation = ('room', room)
+            destination = {'room': room}
+        else:
+            if to is None:
+                to = self.peer_username
+            if to is None or to not in self.crypto.peer_public_keys:
+                if to is None or to == self.peer_username:
+                    self.notice("❌ No se puede enviar mensaje: llave del peer no disponible")
+                    return False
+                # Ask the directory for the recipient's key and send once it arrives
+                self.pending_messages.setdefault(to, []).append(message)
+                self.request_keys([to])
+                return False
+            entry = self.directory.get(to)
+            if entry is not None:
+                if self.directory.is_fresh(entry):
+                    KEY_CACHE_HITS.inc()
+                else:
+                    # Send with the cached key and revalidate it in the background
+                    self.request_keys([to])
+            recipients = [to]
+            conversation = ('dm', to)
+            destination = {'to': to}
+
         try:
-            # Encrypt message
-            encrypted_content = self.crypto.encrypt_message(message)
-            
-            # Sign message
-            signature = self.crypto.sign_message(message)
-            
-            # Send to server
-            message_data = {
-                'encrypted_content': encrypted_content,
-                'signature': signature
-            }
-            self.socket.send(json.dumps(message_data).encode('utf-8'))
-            
-            # Show sent message
-            timestamp = datetime.now().strftime('%H:%M:%S')
-            print(f"{timestamp} ✅ Tú: {message}")
-            
+            async with self.send_lock:
+                # Encryption and signing run off the loop; the lock keeps the send order
+                frame = await self.loop.run_in_executor(
+                    None, self.seal_message, message, recipients, conversation, destination)
+                self.write(frame)
+            MESSAGES_SENT.inc()
+            SEND_BYTES.inc(len(frame))
+            # Senders wait while the server reads slower than they write
+            await self.protocol.writable.wait()
         except Exception as e:
-            print(f"❌ Error enviando mensaje: {e}")
-    
-    def start_chat(self):
-        """Start main chat loop"""
-        if not self.connected:
-            print("❌ No conectado al servidor")
+            self.notice(f"❌ Error enviando mensaje: {e}")
+            return False
+
+        timestamp = time.time()
+        self.publish({
+            'type': 'sent',
+            'text': message,
+            'timestamp': timestamp,
+            'room': room,
+            'to': to if to != self.peer_username else None,
+        })
+        self.record_history(conversation_name(room, to), {
+            'from': self.username,
+            'text': message,
+            'timestamp': timestamp,
+            'signature_valid': True,
+        })
+        return True
+
+    def seal_message(self, message, recipients, conversation, destination):
+        """Encrypted and signed frame of a message (runs on a worker thread)"""
+        # Encrypt message with the session key (wrapped for each recipient on rekey)
+        message_data = self.crypto.encrypt_session_message(message, recipients, conversation)
+        message_data['type'] = 'encrypted_message'
+        message_data.update(destination)
+        # Sign message
+        message_data['signature'] = self.crypto.sign_message(message)
+        return encode_message(message_data)
+
+    def request_keys(self, usernames):
+        """Look up several users in the server directory with one round trip
+
+        Users with a fresh cache entry or an outstanding lookup are skipped;
+        stale entries are sent with their version so unchanged keys come
+        back without the PEM.
+        """
+        wanted = []
+        ready = []  # Answered while the caller queued something for them
+        for username in usernames:
+            if username in self.lookups_in_flight or username == self.username:
+                continue
+            entry = self.directory.get(username)
+            if self.directory.is_fresh(entry) and username in self.crypto.peer_public_keys:
+                ready.append(username)
+                continue
+            wanted.append(username)
+        if wanted:
+            self.write(encode_message({
+                'type': 'key_lookup',
+                'usernames': wanted,
+                'known': self.directory.known_versions(wanted)
+            }))
+            self.lookups_in_flight.update(wanted)
+        for username in ready:
+            if username in self.pending_messages or self.transfers.waiting_for(username):
+                self.flush_pending_messages(username)
+        if wanted:
+            KEY_LOOKUPS.inc()
+        return len(wanted)
+
+    def prefetch_contacts(self):
+        """Fetch the keys of every verified contact right after registering"""
+        contacts = [username for username, _ in self.key_cache.items()]
+        if contacts:
+            self.request_keys(contacts)
+
+    def on_key_directory(self, message):
+        """Store the keys of a directory answer and send what was waiting for them"""
+        answered = []
+        shown = set()
+        for fields in message['keys']:
+            username = fields['username']
+            if 'public_key' in fields:
+                try:
+                    handle = self.crypto.add_peer_public_key(username, fields['public_key'].encode('utf-8'))
+                    entry = self.directory.put(DirectoryEntry(
+                        username, fields['version'], fields['fingerprint'], fields['public_key'], fields['online']
+                    ), handle.fingerprint)
+                except ValueError as e:
+                    self.crypto.remove_peer_public_key(username)
+                    self.notice(f"❌ Llave rechazada: {e}")
+                    # What it sent cannot be verified: shown as such
+                    self.unknown_senders.add(username)
+                    self.release_held(username)
+                    continue
+                if entry.trust == TRUST_CHANGED:
+                    self.show_member_fingerprint(username)
+                    shown.add(username)
+            elif self.directory.refresh(username, fields['version'], fields['online']) is None:
+                continue  # Evicted meanwhile: asked again below without a version
+            answered.append(username)
+
+        self.lookups_in_flight.difference_update(fields['username'] for fields in message['keys'])
+        self.lookups_in_flight.difference_update(message['missing'])
+        for username in message['missing']:
+            if username in self.awaited_senders:
+                self.unknown_senders.add(username)
+                self.release_held(username)
+            dropped_messages = self.pending_messages.pop(username, None)
+            dropped_files = self.transfers.discard_pending(username)
+            if dropped_messages or dropped_files:
+                self.notice(f"❌ Usuario desconocido: {username}")
+
+        for username in answered:
+            waiting = username in self.pending_messages or self.transfers.waiting_for(username)
+            if (waiting or username in self.awaited_senders) and username not in shown:
+                self.show_member_fingerprint(username)
+            self.release_held(username)
+            if waiting:
+                self.flush_pending_messages(username)
+        retry = [fields['username'] for fields in message['keys'] if fields['username'] not in answered
+                 and 'public_key' not in fields]
+        if retry:
+            self.request_keys(retry)
+
+    def flush_pending_messages(self, username):
+        """Send direct messages that were waiting for the recipient's key"""
+        pending = self.pending_messages.pop(username, [])
+        if pending:
+            self.spawn(self.send_pending(pending, username))
+        self.transfers.flush_pending(username)
+
+    async def send_pending(self, pending, username):
+        for message in pending:
+            await self.send(message, to=username)
+
+    # Rooms, files and identities
+
+    @on_client_loop
+    async def join_room(self, room):
+        if self.reconnecting:
+            self.notice("❌ Sin conexión con el servidor, intenta de nuevo al reconectar")
             return
-            
-        print("\n💬 Chat iniciado. Esperando intercambio de llaves...")
-        verified = False
-        
+        self.write(encode_message({'type': 'join_room', 'room': room}))
+        self.active_room = room
+
+    @on_client_loop
+    async def leave_room(self, room):
+        if not self.reconnecting:
+            # While reconnecting the room is simply not resumed
+            self.write(encode_message({'type': 'leave_room', 'room': room}))
+        self.rooms.pop(room, None)
+        if self.active_room == room:
+            self.active_room = None
+
+    @on_client_loop
+    async def send_file(self, path, to):
+        self.transfers.send_file(path, to)
+
+    @on_client_loop
+    async def verify(self, username=None):
+        """Pin the current key of a contact (the current peer by default); False if it failed"""
+        username = username or self.peer_username
+        if not username or username not in self.crypto.peer_public_keys:
+            self.notice("❌ No hay peer para verificar aún")
+            return False
+        peer_fingerprint = self.crypto.get_public_key_fingerprint(self.crypto.peer_public_keys[username])
         try:
-            while True:
-                message = input()
-                if message.lower() == 'quit':
-                    break
-                elif message.lower() == 'cache':
-                    print("📋 Comandos de cache disponibles:")
-                    print("   cache - Mostrar esta ayuda")
-                    print("   cache clear - Limpiar cache de identidades")
-                    print("   cache show - Mostrar identidades en cache")
-                    continue
-                elif message.lower() == 'cache clear':
-                    self.key_cache.clear_cache()
-                    continue
-                elif message.lower() == 'cache show':
-                    if self.key_cache.verified_keys:
-                        print("📋 Identidades verificadas en cache:")
-                        for username, fingerprint in self.key_cache.verified_keys.items():
-                            print(f"   {username}: {fingerprint}")
-                    else:
-                        print("📋 No hay identidades en cache")
-                    continue
-                elif message.lower() == 'verify':
-                    if self.peer_username:
-                        # Mark as verified in cache
-                        peer_fingerprint = self.crypto.get_public_key_fingerprint(self.crypto.peer_public_key)
-                        self.key_cache.mark_verified(self.peer_username, peer_fingerprint)
-                        self.verified = True
-                        print("✅ Verificación confirmada. Chat seguro establecido!")
-                        print("💬 Ya puedes enviar mensajes seguros.")
-                        print("💾 Identidad guardada en cache para futuras conexiones")
-                    else:
-                        print("❌ No hay peer para verificar aún")
-                elif message.strip():
-                    if not self.verified and self.peer_username:
-                        print("⚠️  Advertencia: Enviando mensaje sin verificar fingerprint")
-                    self.send_message(message)
-                    
-        except KeyboardInterrupt:
-            print("\n👋 Cerrando chat...")
-        finally:
-            self.disconnect()
-    
-    def disconnect(self):
-        """Disconnect from server"""
+            self.key_cache.mark_verified(username, peer_fingerprint)
+        except sqlite3.Error as e:
+            self.notice(f"⚠️  Error guardando cache: {e}")
+            return False
+        self.directory.revalidate(username)
+        if username == self.peer_username:
+            self.verified = True
+        return True
+
+    @on_client_loop
+    async def load_history(self, room=None, user=None, before=None, limit=50):
+        """A page of the local history of a room or of a user, oldest first
+
+        Every message has its 'seq'; pass the first one as before to get
+        the page before it. Only that page is read and decrypted.
+        """
+        if self.history is None:
+            return []
+        conversation = conversation_name(room, user)
+        def read_page():
+            self.history.flush()  # Messages still queued belong to the newest page
+            return self.history.page(conversation, before, limit)
+        return await self.loop.run_in_executor(None, read_page)
+
+    @on_client_loop
+    async def disconnect(self):
+        """Disconnect from server; ends the messages() iterators"""
         self.connected = False
-        if self.socket:
-            self.socket.close()
-        print("🔌 Desconectado del servidor")
\ No newline at end of file
+        self.registered.clear()
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+            self.reconnect_task = None
+        if self.protocol is not None:
+            self.protocol.transport.close()
+        if self.pipeline:
+            self.pipeline.close()
+            self.pipeline = None
+        # Uploads save their progress before this returns
+        await self.loop.run_in_executor(None, self.transfers.close)
+        if self.history is not None:
+            # Written up to the last message before this returns
+            await self.loop.run_in_executor(None, self.history.close)
+            self.history = None
+        self.notice("🔌 Desconectado del servidor")
+        self.publish(None)
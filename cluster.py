@@ -0,0 +1,312 @@
+# cluster.py - Inter-node bus for running several relay processes as one cluster
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import threading
+from protocol import FRAME_HEADER, MAX_FRAME_SIZE, FrameDecoder, ProtocolError, decode_body, encode_message
+
+logger = logging.getLogger('secure_chat.cluster')
+
+RECONNECT_INTERVAL = 1.0
+
+NONCE_SIZE = 16
+HANDSHAKE_TIMEOUT = 10.0  # Seconds for a node_hello before the connection is dropped
+MAX_HELLO_SIZE = 512  # A node id and a nonce (and a proof) fit with room to spare
+TAG_SIZE = 16  # Truncated HMAC-SHA256 sent after every frame of a link
+# Bytes a link may hold for a peer that does not read before it is dropped,
+# as the server drops a slow client; the peer reconnects and gets the
+# directory again, as after any link failure
+MAX_LINK_BUFFER = 64 * 1024 * 1024
+
+class LocalBroker:
+    """In-process stand-in for the network: every LocalBus attached to it is a peer"""
+    def __init__(self):
+        self.buses = {}  # {node_id: LocalBus}
+        self.lock = threading.Lock()
+
+class LocalBus:
+    """Bus between servers running in the same process (each on its own event loop)
+
+    Messages go through the same encoding as the socket bus and are handed
+    to the peer's loop in order, so links behave like ordered streams.
+    """
+    def __init__(self, broker, node_id):
+        self.broker = broker
+        self.node_id = node_id
+        self.server = None
+        self.loop = None
+        self.decoders = {}  # {peer node_id: FrameDecoder}
+
+    async def start(self, server):
+        self.server = server
+        self.loop = asyncio.get_running_loop()
+        with self.broker.lock:
+            peers = list(self.broker.buses.values())
+            self.broker.buses[self.node_id] = self
+        for peer in peers:
+            self.loop.call_soon(server.on_peer_up, peer.node_id)
+            peer.loop.call_soon_threadsafe(peer.server.on_peer_up, self.node_id)
+
+    def send(self, node_id, message):
+        peer = self.broker.buses.get(node_id)
+        if peer is not None:
+            peer.loop.call_soon_threadsafe(peer._receive, self.node_id, encode_message(message))
+
+    def publish(self, message):
+        frame = encode_message(message)
+        for node_id, peer in list(self.broker.buses.items()):
+            if node_id != self.node_id:
+                peer.loop.call_soon_threadsafe(peer._receive, self.node_id, frame)
+
+    def _receive(self, sender, frame):
+        decoder = self.decoders.setdefault(sender, FrameDecoder())
+        for message in decoder.feed(frame):
+            self.server.on_bus_message(sender, message)
+
+    async def close(self):
+        with self.broker.lock:
+            self.broker.buses.pop(self.node_id, None)
+            peers = list(self.broker.buses.values())
+        for peer in peers:
+            peer.loop.call_soon_threadsafe(peer.server.on_peer_down, self.node_id)
+
+def parse_address(address):
+    """'unix:/path/to/socket' or 'host:port'"""
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or 'localhost', int(port))
+
+def _handshake_data(connector, acceptor, connector_nonce, acceptor_nonce):
+    """Both node ids and both nonces, unambiguously: a rewritten id changes it"""
+    data = bytearray()
+    for value in (connector.encode('utf-8'), acceptor.encode('utf-8'), connector_nonce, acceptor_nonce):
+        data += len(value).to_bytes(2, 'big') + value
+    return bytes(data)
+
+def _hello_proof(secret, connector, acceptor, connector_nonce, acceptor_nonce):
+    """What the accepting node answers to show it knows the cluster secret"""
+    data = b'node_hello' + _handshake_data(connector, acceptor, connector_nonce, acceptor_nonce)
+    return hmac.new(secret, data, hashlib.sha256).digest()
+
+def _link_key(secret, connector, acceptor, connector_nonce, acceptor_nonce):
+    """Key of a link's frame tags, bound to the ids each end claimed"""
+    data = b'link' + _handshake_data(connector, acceptor, connector_nonce, acceptor_nonce)
+    return hmac.new(secret, data, hashlib.sha256).digest()
+
+def _frame_tag(key, counter, *parts):
+    mac = hmac.new(key, counter.to_bytes(8, 'big'), hashlib.sha256)
+    for part in parts:
+        mac.update(part)
+    return mac.digest()[:TAG_SIZE]
+
+async def _read_frame(reader, max_size=MAX_FRAME_SIZE):
+    """(header, msg_type, body) of the next frame of a stream"""
+    header = await reader.readexactly(FRAME_HEADER.size)
+    body_length, msg_type = FRAME_HEADER.unpack(header)
+    if body_length > max_size:
+        raise ProtocolError("Frame too large")
+    return header, msg_type, await reader.readexactly(body_length)
+
+async def _read_hello(reader):
+    """The node_hello that opens a link, small and within HANDSHAKE_TIMEOUT"""
+    _, msg_type, body = await asyncio.wait_for(_read_frame(reader, MAX_HELLO_SIZE), HANDSHAKE_TIMEOUT)
+    hello = decode_body(msg_type, body)
+    if (hello['type'] != 'node_hello' or not isinstance(hello.get('node'), str)
+            or not isinstance(hello.get('nonce'), bytes)):
+        raise ProtocolError("Se esperaba node_hello")
+    return hello
+
+class BusLink:
+    """The sending half of a link to a peer
+
+    Every frame is followed by a tag: an HMAC of the frame and its position
+    in the stream, under a key derived from the cluster secret and both
+    node ids and nonces of the handshake. Frames cannot be forged, altered,
+    replayed, reordered or credited to another node by anyone without the
+    secret.
+    """
+    def __init__(self, peer_id, writer, key):
+        self.peer_id = peer_id
+        self.writer = writer
+        self.key = key
+        self.counter = 0
+
+    def write(self, frame):
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > MAX_LINK_BUFFER:
+            logger.warning("⚠️  Nodo %s no lee, enlace cerrado", self.peer_id)
+            self.writer.transport.abort()
+            return
+        self.writer.writelines((frame, _frame_tag(self.key, self.counter, frame)))
+        self.counter += 1
+
+    def close(self):
+        self.writer.close()
+
+class SocketBus:
+    """Bus over Unix sockets (one host) or TCP (several hosts)
+
+    Every node listens on its own address and keeps one outgoing connection
+    to each peer for the messages it sends. The connection starts with a
+    node_hello in each direction: both ends learn the other's node id, the
+    accepting node proves it knows the shared secret, and every later frame
+    carries an HMAC (BusLink) that the accepting node checks. Lost peers
+    are retried every RECONNECT_INTERVAL seconds.
+    """
+    def __init__(self, node_id, listen, peers=(), secret=None):
+        if not secret:
+            raise ValueError("El bus del cluster requiere un secreto compartido")
+        self.node_id = node_id
+        self.listen = listen
+        self.peers = list(peers)  # Addresses of the other nodes
+        self.secret = secret  # Shared by every node of the cluster
+        self.server = None
+        self.listener = None
+        self.links = {}  # {peer node_id: BusLink}
+        self.tasks = []
+
+    async def start(self, server):
+        self.server = server
+        kind, address = parse_address(self.listen)
+        if kind == 'unix':
+            if os.path.exists(address):
+                os.remove(address)  # Left behind by a previous run
+            self.listener = await asyncio.start_unix_server(self._accept, path=address)
+        else:
+            self.listener = await asyncio.start_server(self._accept, *address, reuse_address=True)
+        for peer in self.peers:
+            self.tasks.append(asyncio.create_task(self._connect_loop(peer)))
+        logger.info("🔗 Nodo %s escuchando en %s", self.node_id, self.listen)
+
+    async def _open(self, address):
+        kind, address = parse_address(address)
+        if kind == 'unix':
+            return await asyncio.open_unix_connection(address)
+        return await asyncio.open_connection(*address)
+
+    async def _connect_loop(self, address):
+        """Keep an outgoing link to one peer open"""
+        while True:
+            peer_id = None
+            link = None
+            writer = None
+            try:
+                reader, writer = await self._open(address)
+                nonce = os.urandom(NONCE_SIZE)
+                writer.write(encode_message({'type': 'node_hello', 'node': self.node_id, 'nonce': nonce}))
+                hello = await _read_hello(reader)
+                peer_id = hello['node']
+                proof = _hello_proof(self.secret, self.node_id, peer_id, nonce, hello['nonce'])
+                if not isinstance(hello.get('proof'), bytes) or not hmac.compare_digest(hello['proof'], proof):
+                    raise ProtocolError("el nodo no conoce el secreto del cluster")
+                key = _link_key(self.secret, self.node_id, peer_id, nonce, hello['nonce'])
+                link = self.links[peer_id] = BusLink(peer_id, writer, key)
+                self.server.on_peer_up(peer_id)
+                # The peer writes nothing after its hello: EOF means the link is gone
+                while await reader.read(64 * 1024):
+                    pass
+            except OSError:
+                pass  # The peer is down: retried below
+            except Exception as e:
+                logger.warning("⚠️  Enlace con %s fallido: %s", address, e)
+            if writer is not None:
+                writer.close()
+            if link is not None and self.links.get(peer_id) is link:
+                del self.links[peer_id]
+                logger.warning("⚠️  Nodo %s desconectado", peer_id)
+                self.server.on_peer_down(peer_id)
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    async def _accept(self, reader, writer):
+        """Incoming link: the peer's messages for this node, each checked against its tag"""
+        peer_id = None
+        try:
+            hello = await _read_hello(reader)
+            peer_id = hello['node']
+            nonce = os.urandom(NONCE_SIZE)
+            writer.write(encode_message({
+                'type': 'node_hello',
+                'node': self.node_id,
+                'nonce': nonce,
+                'proof': _hello_proof(self.secret, peer_id, self.node_id, hello['nonce'], nonce)
+            }))
+            # Until the first tag checks out, peer_id is only a claim: the key binds it
+            key = _link_key(self.secret, peer_id, self.node_id, hello['nonce'], nonce)
+            counter = 0
+            while True:
+                try:
+                    header, msg_type, body = await _read_frame(reader)
+                except asyncio.IncompleteReadError as e:
+                    if e.partial:
+                        raise
+                    break  # Closed between two frames
+                tag = await reader.readexactly(TAG_SIZE)
+                if not hmac.compare_digest(tag, _frame_tag(key, counter, header, body)):
+                    raise ProtocolError("Frame del bus sin autenticar")
+                counter += 1
+                self.server.on_bus_message(peer_id, decode_body(msg_type, body))
+        except Exception as e:
+            logger.error("❌ Error en el enlace con el nodo %s: %s", peer_id, e)
+        writer.close()
+
+    def send(self, node_id, message):
+        link = self.links.get(node_id)
+        if link is not None:
+            link.write(encode_message(message))
+
+    def publish(self, message):
+        frame = encode_message(message)
+        for link in list(self.links.values()):
+            link.write(frame)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for link in self.links.values():
+            link.close()
+        self.links.clear()
+        if self.listener is not None:
+            self.listener.close()
+            kind, address = parse_address(self.listen)
+            if kind == 'unix' and os.path.exists(address):
+                os.remove(address)
+
+def _run_node(index, nodes, host, port, bus_dir, store_dir, ticket_key, bus_secret):
+    from server import SecureChatServer
+    addresses = [f"unix:{os.path.join(bus_dir, f'node{i}.sock')}" for i in range(nodes)]
+    bus = SocketBus(f"node{index}", addresses[index], addresses[:index] + addresses[index + 1:], bus_secret)
+    server = SecureChatServer(
+        host=host, port=port, reuse_port=True, cluster=bus,
+        store_dir=os.path.join(store_dir, f"node{index}") if store_dir else None,
+        directory_file=os.path.join(bus_dir, f"node{index}_keys.db"),
+        ticket_key=ticket_key
+    )
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+
+def run_local_cluster(nodes, host='localhost', port=8888, bus_dir='cluster_bus', store_dir=None):
+    """Run nodes relay processes sharing one port (SO_REUSEPORT) and a Unix-socket bus"""
+    import multiprocessing
+    os.makedirs(bus_dir, exist_ok=True)
+    # One ticket key for every node: a session resumes on whichever node accepts the connection
+    ticket_key = os.urandom(32)
+    bus_secret = os.urandom(32)
+    processes = [
+        multiprocessing.Process(target=_run_node,
+                                args=(i, nodes, host, port, bus_dir, store_dir, ticket_key, bus_secret))
+        for i in range(nodes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
@@ -1,116 +1,382 @@
 import base64
 import hashlib
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.hazmat.primitives.serialization import load_pem_public_key
+import threading
+from collections import OrderedDict
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import os
+from cipher_suites import (DEFAULT_SUITE, SUITE_RSA, OAEP_PADDING, get_suite,
+                           suite_for_key, suite_for_pem)
+from metrics import timed
+
+# Wire format versions: v1 messages (no 'version' field) are RSA-OAEP encrypted,
+# v2 messages use an RSA-wrapped AES-256-GCM session key
+LEGACY_PROTOCOL_VERSION = 1
+PROTOCOL_VERSION = 2
+
+# Rekeying thresholds for outgoing session keys
+SESSION_KEY_MAX_MESSAGES = 1 << 20
+SESSION_KEY_MAX_BYTES = 1 << 32
+
+# Parsed peer keys shared by every CryptoManager in the process
+PUBLIC_KEY_CACHE_SIZE = 1024
+
+class PublicKeyHandle:
+    """A public key with its suite, serialized form and fingerprint computed once"""
+    __slots__ = ('key', 'suite', '_pem', '_fingerprint')
+
+    def __init__(self, key, pem=None, suite=None):
+        self.key = key
+        self.suite = suite if suite is not None else suite_for_key(key)
+        self._pem = pem
+        self._fingerprint = None
+
+    @property
+    def pem(self):
+        if self._pem is None:
+            self._pem = self.suite.public_bytes(self.key)
+        return self._pem
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            # Always over our own serialization, whatever PEM the peer sent
+            pem_data = self.suite.public_bytes(self.key)
+            self._fingerprint = format_fingerprint(hashlib.sha256(pem_data).hexdigest())
+        return self._fingerprint
+
+class PublicKeyCache:
+    """LRU of parsed public keys, keyed by the hash of the PEM they came from"""
+    def __init__(self, max_size=PUBLIC_KEY_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @timed('crypto.load_peer_key')
+    def load(self, pem_data):
+        digest = hashlib.sha256(pem_data).digest()
+        with self.lock:
+            handle = self.entries.get(digest)
+            if handle is not None:
+                self.entries.move_to_end(digest)
+                return handle
+
+        suite = suite_for_pem(pem_data)
+        handle = PublicKeyHandle(suite.load_public_key(pem_data), pem=bytes(pem_data), suite=suite)
+        with self.lock:
+            self.entries[digest] = handle
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return handle
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+public_key_cache = PublicKeyCache()
+
+def format_fingerprint(hex_digest):
+    """Readable format: AA:BB:CC:DD..."""
+    return ':'.join(hex_digest[i:i+2] for i in range(0, len(hex_digest), 2))
+
+def as_public_key_handle(public_key):
+    """Accept either a PublicKeyHandle or a key object"""
+    if isinstance(public_key, PublicKeyHandle):
+        return public_key
+    return PublicKeyHandle(public_key)
+
+class SessionKey:
+    """AES-256-GCM key used for one direction of a conversation"""
+    def __init__(self, key=None, key_id=None):
+        self.key = key if key is not None else AESGCM.generate_key(bit_length=256)
+        self.key_id = key_id if key_id is not None else os.urandom(8)
+        self.aead = AESGCM(self.key)
+        # 96-bit nonce: 4 random bytes + 64-bit message counter
+        self.nonce_prefix = os.urandom(4)
+        self.counter = 0
+        self.bytes_encrypted = 0
+        self.last_counter = -1  # Highest counter accepted when receiving
+        self.recipients = frozenset()  # Users this key was wrapped for
+
+    def next_nonce(self):
+        """Return a fresh nonce, never reused under this key"""
+        nonce = self.nonce_prefix + self.counter.to_bytes(8, 'big')
+        self.counter += 1
+        return nonce
+
+    def needs_rekey(self):
+        """Check if the key reached its usage limits"""
+        return (self.counter >= SESSION_KEY_MAX_MESSAGES or
+                self.bytes_encrypted >= SESSION_KEY_MAX_BYTES)
+
+    def associated_data(self):
+        """Data authenticated (but not encrypted) with every message"""
+        return bytes([PROTOCOL_VERSION]) + self.key_id
 
 class CryptoManager:
     def __init__(self):
+        self.suite = None  # Cipher suite of our identity key (cipher_suites)
         self.private_key = None
         self.public_key = None
-        self.peer_public_key = None
+        self.public_key_handle = None  # Our key with cached PEM and fingerprint
+        self.peer_public_key = None  # PublicKeyHandle of the two-party chat peer
+        self.peer_public_keys = {}  # {username: PublicKeyHandle} for rooms and direct messages
+        self.session_keys = {}  # {conversation: SessionKey} for outgoing messages
+        self.peer_session_keys = {}  # {(sender, key_id): SessionKey} for incoming messages
+        # Receive workers add peer session keys while the loop removes a user's
+        self.peer_session_lock = threading.Lock()
         
-    def generate_keypair(self):
-        """Generate RSA 2048-bit keypair"""
-        self.private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-        )
-        self.public_key = self.private_key.public_key()
-        print("Par de llaves generado exitosamente")
+    @timed('crypto.generate_keypair')
+    def generate_keypair(self, suite=DEFAULT_SUITE):
+        """Generate a keypair of the given cipher suite"""
+        self.set_private_key(get_suite(suite).generate_private_key())
+
+    def set_private_key(self, private_key):
+        """Use an existing private key (identity or pre-generated)"""
+        self.suite = suite_for_key(private_key)
+        self.private_key = private_key
+        self.public_key = private_key.public_key()
+        self.public_key_handle = PublicKeyHandle(self.public_key, suite=self.suite)
+
+    def save_private_key(self, path, passphrase=None):
+        """Store our private key as PKCS#8 PEM, encrypted if a passphrase is given"""
+        pem_data = self.suite.private_bytes(self.private_key, passphrase)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Written with owner-only permissions and renamed into place atomically
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pem_data)
+        os.replace(tmp_path, path)
+
+    def derive_storage_key(self, purpose):
+        """AES-256 key for local data (e.g. the history), derived from our private key"""
+        return HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None, info=b'secure-chat ' + purpose
+        ).derive(self.suite.private_bytes(self.private_key))
+
+    @timed('crypto.load_private_key')
+    def load_private_key(self, path, passphrase=None):
+        """Load our private key from a PKCS#8 PEM file"""
+        with open(path, 'rb') as f:
+            pem_data = f.read()
+        self.set_private_key(suite_for_pem(pem_data).load_private_key(pem_data, passphrase))
         
     def get_public_key_pem(self):
         """Return public key in PEM format for sharing"""
-        return self.public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
+        return self.public_key_handle.pem
     
-    def load_peer_public_key(self, pem_data):
+    def load_peer_public_key(self, pem_data, username=None):
         """Load peer's public key"""
-        self.peer_public_key = load_pem_public_key(pem_data)
-        print("Llave pública del peer cargada")
+        handle = public_key_cache.load(pem_data)
+        self.peer_public_key = handle
+        # A key exchange means a new session of the peer: it no longer has
+        # the session keys we wrapped for it, even if its key is the same
+        self.session_keys.pop(None, None)
+        if username is not None:
+            self.set_peer_public_key(username, handle)
+            self.forget_sessions(username)
+
+    def add_peer_public_key(self, username, pem_data):
+        """Load the public key of another room member or contact"""
+        handle = public_key_cache.load(pem_data)
+        self.set_peer_public_key(username, handle)
+        return handle
+
+    def set_peer_public_key(self, username, handle):
+        previous = self.peer_public_keys.get(username)
+        self.peer_public_keys[username] = handle
+        if previous is not handle:
+            # Session keys wrapped with a previous key of this user are useless to it
+            self.forget_sessions(username)
+
+    def forget_sessions(self, username):
+        """Drop the outgoing session keys wrapped for a user: the next message rekeys"""
+        for conversation, session_key in list(self.session_keys.items()):
+            if username in session_key.recipients:
+                del self.session_keys[conversation]
+
+    def remove_peer_public_key(self, username):
+        self.peer_public_keys.pop(username, None)
+        with self.peer_session_lock:
+            for sender, key_id in list(self.peer_session_keys):
+                if sender == username:
+                    del self.peer_session_keys[(sender, key_id)]
     
     def get_public_key_fingerprint(self, public_key=None):
         """Generate SHA-256 fingerprint of public key for verification"""
         if public_key is None:
-            public_key = self.public_key
-        
-        pem_data = public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-        fingerprint = hashlib.sha256(pem_data).hexdigest()
-        # Readable format: AA:BB:CC:DD...
-        return ':'.join(fingerprint[i:i+2] for i in range(0, len(fingerprint), 2))
+            public_key = self.public_key_handle
+        if isinstance(public_key, PublicKeyHandle):
+            return public_key.fingerprint
+        return PublicKeyHandle(public_key).fingerprint
     
+    @timed('crypto.encrypt_legacy')
     def encrypt_message(self, message):
         """Encrypt message using peer's public key"""
         if not self.peer_public_key:
             raise ValueError("Peer's public key not loaded")
+        if self.peer_public_key.suite.name != SUITE_RSA:
+            raise ValueError("The v1 wire format requires RSA keys")
             
         message_bytes = message.encode('utf-8')
         
         # RSA has size limit, use OAEP padding
-        ciphertext = self.peer_public_key.encrypt(
-            message_bytes,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        ciphertext = self.peer_public_key.key.encrypt(message_bytes, OAEP_PADDING)
         return base64.b64encode(ciphertext).decode('utf-8')
     
+    @timed('crypto.decrypt_legacy')
     def decrypt_message(self, encrypted_message):
         """Decrypt message using our private key"""
         if not self.private_key:
             raise ValueError("Private key not generated")
+        if self.suite.name != SUITE_RSA:
+            raise ValueError("The v1 wire format requires RSA keys")
             
-        ciphertext = base64.b64decode(encrypted_message.encode('utf-8'))
+        if isinstance(encrypted_message, str):
+            ciphertext = base64.b64decode(encrypted_message.encode('utf-8'))
+        else:
+            ciphertext = encrypted_message
         
-        plaintext = self.private_key.decrypt(
-            ciphertext,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        plaintext = self.private_key.decrypt(ciphertext, OAEP_PADDING)
         return plaintext.decode('utf-8')
     
+    @timed('crypto.wrap_session_key')
+    def wrap_session_key(self, session_key, public_key=None):
+        """Encrypt a session key with peer's public key (in the peer's suite)"""
+        if public_key is None:
+            public_key = self.peer_public_key
+        handle = as_public_key_handle(public_key)
+        return handle.suite.wrap_key(handle.key, session_key.key)
+
+    @timed('crypto.unwrap_session_key')
+    def unwrap_key(self, encrypted_key):
+        """Decrypt a symmetric key wrapped with our public key"""
+        if not self.private_key:
+            raise ValueError("Private key not generated")
+        return self.suite.unwrap_key(self.private_key, encrypted_key)
+
+    def unwrap_session_key(self, sender, key_id, encrypted_key):
+        """Decrypt a session key sent by the peer and remember it (any thread)"""
+        session_key = SessionKey(key=self.unwrap_key(encrypted_key), key_id=key_id)
+        with self.peer_session_lock:
+            # Another worker may have unwrapped it meanwhile: keep its counter
+            session_key = self.peer_session_keys.setdefault((sender, key_id), session_key)
+        return session_key
+
+    @timed('crypto.encrypt_session')
+    def encrypt_session_message(self, message, recipients=None, conversation=None):
+        """Encrypt message with the session key (v2 wire format)
+
+        The session key is wrapped (RSA-OAEP or X25519) only in the first
+        message after a (re)key, so the peer pays the private-key operation
+        once per session.
+        With recipients, the key is a sender key for the whole conversation:
+        it is wrapped once per member and rotates when membership changes,
+        so each message is encrypted only once regardless of room size.
+        """
+        payload = {'version': PROTOCOL_VERSION}
+        session_key = self.session_keys.get(conversation)
+
+        if recipients is None:
+            if not self.peer_public_key:
+                raise ValueError("Peer's public key not loaded")
+            if session_key is None or session_key.needs_rekey():
+                session_key = SessionKey()
+                self.session_keys[conversation] = session_key
+                payload['encrypted_key'] = self.wrap_session_key(session_key)
+        else:
+            recipients = frozenset(recipients)
+            missing = [username for username in recipients if username not in self.peer_public_keys]
+            if missing:
+                raise ValueError(f"Public key not loaded for: {', '.join(sorted(missing))}")
+            if (session_key is None or session_key.needs_rekey() or
+                    session_key.recipients != recipients):
+                session_key = SessionKey()
+                session_key.recipients = recipients
+                self.session_keys[conversation] = session_key
+                payload['encrypted_keys'] = {
+                    username: self.wrap_session_key(session_key, self.peer_public_keys[username])
+                    for username in recipients
+                }
+
+        message_bytes = message.encode('utf-8')
+        nonce = session_key.next_nonce()
+        ciphertext = session_key.aead.encrypt(nonce, message_bytes, session_key.associated_data())
+        session_key.bytes_encrypted += len(message_bytes)
+
+        payload['key_id'] = session_key.key_id
+        payload['nonce'] = nonce
+        payload['encrypted_content'] = ciphertext
+        return payload
+
+    @timed('crypto.open_session')
+    def open_session_message(self, payload, recipient=None):
+        """Decrypt a v2 message without the ordering check
+
+        Safe to call from several threads; returns (plaintext, session_key,
+        counter) so the caller can run accept_counter in arrival order.
+        """
+        sender = payload.get('from')
+        key_id = payload['key_id']
+        session_key = self.peer_session_keys.get((sender, key_id))
+        if session_key is None:
+            encrypted_key = payload.get('encrypted_key')
+            if not encrypted_key and payload.get('encrypted_keys'):
+                encrypted_key = payload['encrypted_keys'].get(recipient)
+                if encrypted_key is None:
+                    raise ValueError("Session key not wrapped for this recipient")
+            if not encrypted_key:
+                raise ValueError("Unknown session key")
+            session_key = self.unwrap_session_key(sender, key_id, encrypted_key)
+
+        nonce = payload['nonce']
+        counter = int.from_bytes(nonce[4:], 'big')
+        plaintext = session_key.aead.decrypt(nonce, payload['encrypted_content'], session_key.associated_data())
+        return plaintext.decode('utf-8'), session_key, counter
+
+    def accept_counter(self, session_key, counter):
+        """Reject replayed or reordered messages"""
+        if counter <= session_key.last_counter:
+            raise ValueError("Replayed or reordered message")
+        session_key.last_counter = counter
+
+    def decrypt_session_message(self, payload, recipient=None):
+        """Decrypt a v2 message using the peer's session key"""
+        plaintext, session_key, counter = self.open_session_message(payload, recipient)
+        self.accept_counter(session_key, counter)
+        return plaintext
+
+    @timed('crypto.sign')
     def sign_message(self, message):
         """Sign message with our private key"""
-        message_bytes = message.encode('utf-8')
-        signature = self.private_key.sign(
-            message_bytes,
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()),
-                salt_length=padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256()
-        )
-        return base64.b64encode(signature).decode('utf-8')
+        return self.sign_data(message.encode('utf-8'))
+
+    def sign_data(self, data):
+        """Sign raw bytes with our private key"""
+        return self.suite.sign(self.private_key, data)
     
-    def verify_signature(self, message, signature):
+    @timed('crypto.verify')
+    def verify_signature(self, message, signature, public_key=None):
         """Verify message signature using peer's public key"""
-        if not self.peer_public_key:
+        if public_key is None:
+            public_key = self.peer_public_key
+        if not public_key:
             raise ValueError("Peer's public key not loaded")
             
         try:
             message_bytes = message.encode('utf-8')
-            signature_bytes = base64.b64decode(signature.encode('utf-8'))
+            if isinstance(signature, str):
+                signature_bytes = base64.b64decode(signature.encode('utf-8'))
+            else:
+                signature_bytes = signature
             
-            self.peer_public_key.verify(
-                signature_bytes,
-                message_bytes,
-                padding.PSS(
-                    mgf=padding.MGF1(hashes.SHA256()),
-                    salt_length=padding.PSS.MAX_LENGTH
-                ),
-                hashes.SHA256()
-            )
+            handle = as_public_key_handle(public_key)
+            handle.suite.verify(handle.key, signature_bytes, message_bytes)
             return True
         except Exception:
             return False
\ No newline at end of file
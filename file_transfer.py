@@ -0,0 +1,603 @@
+# file_transfer.py - Streaming encrypted file transfer with resumable uploads
+import asyncio
+import base64
+import hashlib
+import json
+import mmap
+import os
+import threading
+from crypto_utils import SessionKey
+from protocol import encode_message
+from metrics import registry
+
+CHUNK_SIZE = 64 * 1024
+# Chunks in flight per transfer; window * chunk stays under the relay's
+# per-connection queue bound, so a transfer never trips the slow-consumer policy
+WINDOW = 8
+ACK_EVERY = 2  # The receiver acknowledges every ACK_EVERY chunks (and the last one)
+STATE_SAVE_EVERY = 16  # Chunks between progress saves on the sending side
+
+METADATA_NONCE = b'\xff' * 12  # Reserved: chunk nonces never reach it
+
+CHUNKS_SENT = registry.counter('client.file_chunks_sent')
+CHUNKS_RECEIVED = registry.counter('client.file_chunks_received')
+
+def chunk_nonce(index):
+    # A fresh key per file, so the chunk index alone makes nonces unique
+    return b'\x00\x00\x00\x00' + index.to_bytes(8, 'big')
+
+def chunk_associated_data(file_id, index, final):
+    # Binds each chunk to its file and position; the final flag stops truncation
+    return file_id + index.to_bytes(8, 'big') + (b'\x01' if final else b'\x00')
+
+def offer_signature_text(offer):
+    """What the sender signs: everything the receiver trusts from the offer"""
+    return ':'.join([
+        offer['file_id'].hex(),
+        str(offer['chunk_size']),
+        str(offer['chunks']),
+        hashlib.sha256(offer['encrypted_key']).hexdigest(),
+        hashlib.sha256(offer['encrypted_metadata']).hexdigest(),
+    ])
+
+def _encode_state(state):
+    return {key: base64.b64encode(value).decode('ascii') if isinstance(value, bytes) else value
+            for key, value in state.items()}
+
+def _decode_state(data, binary_fields):
+    return {key: base64.b64decode(value) if key in binary_fields else value
+            for key, value in data.items()}
+
+def _write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def safe_file_name(name):
+    """Keep only the last path component of a name chosen by the sender"""
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    if name in ('', '.', '..'):
+        name = 'archivo'
+    return name
+
+def unique_path(path):
+    base, extension = os.path.splitext(path)
+    candidate, counter = path, 1
+    while os.path.exists(candidate) or os.path.exists(candidate + '.part'):
+        candidate = f"{base} ({counter}){extension}"
+        counter += 1
+    return candidate
+
+class OutgoingTransfer:
+    """A file being streamed to one recipient
+
+    Chunks are read through mmap and encrypted one at a time, so memory use
+    is bounded by the window regardless of the file size. The acked chunk
+    count is saved (with the file key wrapped for ourselves), so the
+    transfer resumes from there after a disconnect or a restart.
+    """
+    STATE_BINARY = ('file_id', 'own_key')
+
+    def __init__(self, manager, state, key):
+        self.manager = manager
+        self.state = state
+        self.file_key = SessionKey(key=key, key_id=state['file_id'])
+        self.acked = state['acked']  # Chunks the receiver has written
+        self.position = state['acked']  # Next chunk to send
+        self.condition = threading.Condition()
+        self.running = False
+        self.restart = False  # A resume arrived while the thread was stopping
+        self.thread = None
+
+    @property
+    def file_id(self):
+        return self.state['file_id']
+
+    def on_ack(self, next_index, resume):
+        with self.condition:
+            if resume:
+                # Answer to an offer: the receiver says where to continue
+                self.acked = self.position = next_index
+            else:
+                self.acked = max(self.acked, next_index)
+            self.condition.notify_all()
+            if resume:
+                if self.running:
+                    # The previous thread may be on its way out: it starts a new one when it exits
+                    self.restart = True
+                else:
+                    self._start()
+
+    def _start(self):
+        # Called with the condition held
+        self.running = True
+        self.restart = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        chunks = self.state['chunks']
+        chunk_size = self.state['chunk_size']
+        try:
+            with open(self.state['path'], 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.state['size'] else b''
+                try:
+                    last_saved = self.acked
+                    while self.manager.online():
+                        with self.condition:
+                            while (self.acked < chunks and self.manager.online() and
+                                   (self.position >= chunks or self.position - self.acked >= WINDOW)):
+                                self.condition.wait(1)
+                            if self.acked >= chunks or not self.manager.online():
+                                break
+                            index = self.position
+                            self.position += 1
+                            acked = self.acked
+                        self._send_chunk(data, index, chunk_size, chunks)
+                        if acked - last_saved >= STATE_SAVE_EVERY:
+                            self.manager.save_outgoing(self, acked)
+                            last_saved = acked
+                finally:
+                    if isinstance(data, mmap.mmap):
+                        data.close()
+        except Exception as e:
+            if self.manager.client.connected:
+                self.manager.client.notice(f"❌ Error enviando archivo {self.state['path']}: {e}")
+
+        try:
+            if self.acked >= chunks:
+                self.manager.finish_outgoing(self)
+            else:
+                self.manager.save_outgoing(self, self.acked)
+        finally:
+            with self.condition:
+                self.running = False
+                if self.restart and self.acked < chunks:
+                    self._start()
+
+    def _send_chunk(self, data, index, chunk_size, chunks):
+        final = index == chunks - 1
+        plaintext = data[index * chunk_size:(index + 1) * chunk_size]
+        ciphertext = self.file_key.aead.encrypt(
+            chunk_nonce(index), plaintext, chunk_associated_data(self.file_id, index, final))
+        self.manager.send_from_thread({
+            'type': 'file_chunk',
+            'to': self.state['to'],
+            'file_id': self.file_id,
+            'index': index,
+            'final': final,
+            'encrypted_content': ciphertext
+        })
+        CHUNKS_SENT.inc()
+
+class IncomingTransfer:
+    """A file being received into <download_dir>/<name>.part
+
+    The file is only touched from the executor, one operation at a time
+    (FileTransferManager.serial); the lock keeps a disconnect from closing
+    it under a write.
+    """
+    STATE_BINARY = ('file_id', 'encrypted_key')
+
+    def __init__(self, state, key):
+        self.state = state
+        self.file_key = SessionKey(key=key, key_id=state['file_id'])
+        self.file = None
+        self.expected = state['next']  # Next chunk to queue (on the loop)
+        self.lock = threading.Lock()
+
+    def open(self):
+        with self.lock:
+            part_path = self.state['part_path']
+            mode = 'r+b' if os.path.exists(part_path) else 'w+b'
+            self.file = open(part_path, mode)
+            # Anything after the last acknowledged chunk is sent again
+            self.file.truncate(self.state['next'] * self.state['chunk_size'])
+            self.file.seek(0, os.SEEK_END)
+
+    def write_chunk(self, index, final, ciphertext, flush=False):
+        plaintext = self.file_key.aead.decrypt(
+            chunk_nonce(index), ciphertext, chunk_associated_data(self.state['file_id'], index, final))
+        with self.lock:
+            if self.file is None:
+                raise ValueError("recepción cerrada")
+            self.file.write(plaintext)
+            if flush:
+                self.file.flush()
+            self.state['next'] = index + 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class FileTransferManager:
+    """Sends and receives files for a SecureChatClient
+
+    The relay only sees encrypted chunks addressed to a user; the file key
+    travels RSA-wrapped in a signed offer, together with the encrypted name
+    and size. Flow control is end to end: the sender keeps at most WINDOW
+    unacknowledged chunks in flight through the relay.
+
+    Disk access and RSA operations run in the loop's executor, never on
+    the loop; the operations of one incoming file are chained (serial) so
+    its chunks are written in order.
+    """
+    def __init__(self, client, download_dir='downloads', transfer_dir='transfers'):
+        self.client = client
+        self.download_dir = download_dir
+        self.outgoing_dir = os.path.join(transfer_dir, 'outgoing')
+        self.incoming_dir = os.path.join(transfer_dir, 'incoming')
+        self.outgoing = {}  # {file_id: OutgoingTransfer}
+        self.incoming = {}  # {file_id: IncomingTransfer}
+        self.pending_files = {}  # {username: [paths]} waiting for a public key
+        self.pending_offers = {}  # {username: [offers]} waiting for the sender's key
+        self.queued = {}  # {file_id: task} last operation queued for an incoming file
+        self.lock = threading.Lock()
+
+    def online(self):
+        """Connected and registered: chunks sent now reach the server"""
+        return self.client.connected and self.client.registered.is_set()
+
+    def send(self, message):
+        self.client.write(encode_message(message))
+
+    def send_from_thread(self, message):
+        """Send from an upload thread (the frame is written on the client's loop)"""
+        self.client.write_threadsafe(encode_message(message))
+
+    def blocking(self, function, *args):
+        """Run function in the executor; awaitable from the client's loop"""
+        return self.client.loop.run_in_executor(None, function, *args)
+
+    def serial(self, file_id, coroutine_function):
+        """Run a coroutine after everything queued before for the same incoming file"""
+        previous = self.queued.get(file_id)
+        async def run():
+            if previous is not None:
+                await asyncio.wait([previous])
+            await coroutine_function()
+        task = self.queued[file_id] = self.client.spawn(run())
+        def done(task):
+            if self.queued.get(file_id) is task:
+                del self.queued[file_id]
+        task.add_done_callback(done)
+
+    # Sending
+
+    def send_file(self, path, to):
+        """Offer a file to a user, resuming an earlier transfer of the same file"""
+        if self.client.reconnecting:
+            self.client.notice("❌ Sin conexión con el servidor, intenta de nuevo al reconectar")
+            return
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            self.client.notice(f"❌ No se puede leer {path}: {e}")
+            return
+        recipient_key = self.client.crypto.peer_public_keys.get(to)
+        if recipient_key is None:
+            # Offered once the directory sends the recipient's key
+            self.pending_files.setdefault(to, []).append(path)
+            self.client.request_keys([to])
+            return
+        self.client.spawn(self._offer(path, to, stat, recipient_key))
+
+    async def _offer(self, path, to, stat, recipient_key):
+        try:
+            transfer, offer = await self.blocking(self._prepare_offer, path, to, stat, recipient_key)
+        except Exception as e:
+            self.client.notice(f"❌ No se puede enviar {path}: {e}")
+            return
+        if not self.online():
+            return  # Offered again once registered
+        self.send(offer)
+        if transfer.acked:
+            self.client.notice(f"📤 Reanudando envío de {os.path.basename(path)} a {to} "
+                               f"({transfer.acked}/{transfer.state['chunks']} fragmentos)")
+        else:
+            self.client.notice(f"📤 Enviando {os.path.basename(path)} a {to} ({stat.st_size} bytes)")
+
+    def _prepare_offer(self, path, to, stat, recipient_key):
+        """The transfer of a file and its signed offer (blocking: disk and RSA)"""
+        transfer = self._load_outgoing(path, to, stat) or self._new_outgoing(path, to, stat)
+        with self.lock:
+            transfer = self.outgoing.setdefault(transfer.file_id, transfer)
+        self.save_outgoing(transfer, transfer.acked)
+
+        metadata = json.dumps({'name': os.path.basename(path), 'size': stat.st_size}).encode('utf-8')
+        offer = {
+            'type': 'file_offer',
+            'to': to,
+            'file_id': transfer.file_id,
+            'chunk_size': transfer.state['chunk_size'],
+            'chunks': transfer.state['chunks'],
+            'encrypted_key': self.client.crypto.wrap_session_key(transfer.file_key, recipient_key),
+            'encrypted_metadata': transfer.file_key.aead.encrypt(METADATA_NONCE, metadata, transfer.file_id),
+        }
+        offer['signature'] = self.client.crypto.sign_message(offer_signature_text(offer))
+        return transfer, offer
+
+    def _new_outgoing(self, path, to, stat):
+        file_key = SessionKey(key_id=os.urandom(16))
+        state = {
+            'file_id': file_key.key_id,
+            'to': to,
+            'path': path,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'chunk_size': CHUNK_SIZE,
+            'chunks': max(1, -(-stat.st_size // CHUNK_SIZE)),
+            # Only wrapped for ourselves: the key never touches the disk in clear
+            'own_key': self.client.crypto.wrap_session_key(file_key, self.client.crypto.public_key_handle),
+            'acked': 0,
+        }
+        return OutgoingTransfer(self, state, file_key.key)
+
+    def _outgoing_state_path(self, path, to):
+        name = hashlib.sha256(f"{to}\0{path}".encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.outgoing_dir, name + '.json')
+
+    def _load_outgoing(self, path, to, stat):
+        state_path = self._outgoing_state_path(path, to)
+        if not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = _decode_state(json.load(f), OutgoingTransfer.STATE_BINARY)
+            if state['size'] != stat.st_size or state['mtime_ns'] != stat.st_mtime_ns:
+                return None  # The file changed: start over with a new key
+            with self.lock:
+                active = self.outgoing.get(state['file_id'])
+            if active is not None:
+                return active
+            return OutgoingTransfer(self, state, self.client.crypto.unwrap_key(state['own_key']))
+        except Exception as e:
+            self.client.notice(f"⚠️  No se pudo reanudar el envío de {path}: {e}")
+            return None
+
+    def save_outgoing(self, transfer, acked):
+        transfer.state['acked'] = acked
+        os.makedirs(self.outgoing_dir, exist_ok=True)
+        _write_json(self._outgoing_state_path(transfer.state['path'], transfer.state['to']),
+                    _encode_state(transfer.state))
+
+    def finish_outgoing(self, transfer):
+        with self.lock:
+            self.outgoing.pop(transfer.file_id, None)
+        try:
+            os.remove(self._outgoing_state_path(transfer.state['path'], transfer.state['to']))
+        except FileNotFoundError:
+            pass
+        self.client.notice(f"\n✅ Archivo {os.path.basename(transfer.state['path'])} entregado a {transfer.state['to']}")
+
+    def resume_outgoing(self):
+        """Offer again every unfinished upload (after connecting)"""
+        self.client.spawn(self._resume_outgoing())
+
+    async def _resume_outgoing(self):
+        for path, to in await self.blocking(self._unfinished_outgoing):
+            self.send_file(path, to)
+
+    def _unfinished_outgoing(self):
+        """(path, recipient) of every saved upload (blocking)"""
+        if not os.path.isdir(self.outgoing_dir):
+            return []
+        unfinished = []
+        for name in os.listdir(self.outgoing_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.outgoing_dir, name), 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            unfinished.append((state['path'], state['to']))
+        return unfinished
+
+    def on_ack(self, message):
+        with self.lock:
+            transfer = self.outgoing.get(message['file_id'])
+        # Only the recipient can move the window (or rewind it) of a transfer
+        if transfer is not None and message.get('from') == transfer.state['to']:
+            transfer.on_ack(message['next'], message.get('resume', False))
+
+    # Receiving
+
+    def _incoming_state_path(self, file_id):
+        return os.path.join(self.incoming_dir, file_id.hex() + '.json')
+
+    def on_offer(self, offer):
+        sender = offer['from']
+        sender_key = self.client.crypto.peer_public_keys.get(sender)
+        if sender_key is None:
+            # Verified once the directory sends the sender's key
+            self.pending_offers.setdefault(sender, []).append(offer)
+            self.client.request_keys([sender])
+            return
+        if not self.client.crypto.verify_signature(offer_signature_text(offer), offer['signature'], sender_key):
+            self.client.notice(f"⚠️  ADVERTENCIA: Oferta de archivo de {sender} con firma inválida, ignorada")
+            return
+
+        file_id = offer['file_id']
+        async def accept():
+            try:
+                transfer, resumed = await self.blocking(
+                    self._prepare_incoming, offer, self.incoming.get(file_id))
+            except Exception as e:
+                self.client.notice(f"❌ Oferta de archivo de {sender} inválida: {e}")
+                return
+            state = transfer.state
+            if resumed:
+                self.client.notice(f"\n📥 Reanudando {state['name']} de {sender} "
+                                   f"({state['next']}/{state['chunks']} fragmentos)")
+            else:
+                self.client.notice(f"\n📥 Recibiendo {state['name']} de {sender} ({state['size']} bytes)")
+            transfer.expected = state['next']
+            self.incoming[file_id] = transfer
+            if self.online():
+                self.send({'type': 'file_ack', 'to': sender, 'file_id': file_id,
+                           'next': state['next'], 'resume': True})
+        self.serial(file_id, accept)
+
+    def _prepare_incoming(self, offer, transfer):
+        """The transfer an offer starts or resumes, opened for writing (blocking: disk and RSA)"""
+        sender = offer['from']
+        file_id = offer['file_id']
+        transfer = transfer or self._load_incoming(file_id, sender)
+        resumed = transfer is not None
+        if transfer is None:
+            key = self.client.crypto.unwrap_key(offer['encrypted_key'])
+            file_key = SessionKey(key=key, key_id=file_id)
+            metadata = json.loads(file_key.aead.decrypt(METADATA_NONCE, offer['encrypted_metadata'], file_id))
+            path = unique_path(os.path.join(self.download_dir, safe_file_name(metadata['name'])))
+            state = {
+                'file_id': file_id,
+                'from': sender,
+                'encrypted_key': offer['encrypted_key'],
+                'name': os.path.basename(path),
+                'size': metadata['size'],
+                'chunk_size': offer['chunk_size'],
+                'chunks': offer['chunks'],
+                'part_path': path + '.part',
+                'next': 0,
+            }
+            os.makedirs(self.download_dir, exist_ok=True)
+            transfer = IncomingTransfer(state, key)
+
+        transfer.close()
+        transfer.open()
+        self.save_incoming(transfer)
+        return transfer, resumed
+
+    def _load_incoming(self, file_id, sender):
+        state_path = self._incoming_state_path(file_id)
+        if not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = _decode_state(json.load(f), IncomingTransfer.STATE_BINARY)
+            if state['from'] != sender:
+                return None
+            return IncomingTransfer(state, self.client.crypto.unwrap_key(state['encrypted_key']))
+        except Exception as e:
+            self.client.notice(f"⚠️  No se pudo reanudar la recepción: {e}")
+            return None
+
+    def save_incoming(self, transfer):
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        _write_json(self._incoming_state_path(transfer.state['file_id']), _encode_state(transfer.state))
+
+    def on_chunk(self, message):
+        transfer = self.incoming.get(message['file_id'])
+        if transfer is None or message['from'] != transfer.state['from']:
+            return
+        index = message['index']
+        if index != transfer.expected:
+            return  # Duplicate from before a resume; the sender rewinds on the next offer
+        transfer.expected += 1
+        self.serial(transfer.state['file_id'], lambda: self._receive_chunk(transfer, message))
+
+    async def _receive_chunk(self, transfer, message):
+        state = transfer.state
+        index = message['index']
+        if index != state['next'] or self.incoming.get(state['file_id']) is not transfer:
+            return  # Queued behind an invalid chunk, or the transfer is gone
+        final = message['final']
+        acknowledge = final or (index + 1) % ACK_EVERY == 0
+        try:
+            await self.blocking(self._write_chunk, transfer, message, acknowledge)
+        except Exception as e:
+            transfer.expected = state['next']
+            if self.client.connected:
+                self.client.notice(f"❌ Fragmento {index} de {state['name']} inválido: {e}")
+            return
+        CHUNKS_RECEIVED.inc()
+
+        if acknowledge and self.online():
+            self.send({'type': 'file_ack', 'to': state['from'],
+                       'file_id': state['file_id'], 'next': state['next']})
+        if final:
+            await self.finish_incoming(transfer)
+
+    def _write_chunk(self, transfer, message, acknowledge):
+        """Decrypt and write a chunk, saving the progress before it is acknowledged (blocking)"""
+        transfer.write_chunk(message['index'], message['final'], message['encrypted_content'],
+                             flush=acknowledge)
+        if acknowledge:
+            self.save_incoming(transfer)
+
+    async def finish_incoming(self, transfer):
+        state = transfer.state
+        del self.incoming[state['file_id']]
+        if state['next'] != state['chunks']:
+            await self.blocking(transfer.close)
+            self.client.notice(f"❌ Archivo {state['name']} incompleto")
+            return
+        path = await self.blocking(self._complete_incoming, transfer)
+        self.client.notice(f"\n✅ Archivo recibido de {state['from']}: {path}")
+
+    def _complete_incoming(self, transfer):
+        """Move a received file into place and return its path (blocking)"""
+        transfer.close()
+        state = transfer.state
+        path = state['part_path'][:-len('.part')]
+        if os.path.exists(path):
+            path = unique_path(path)
+        os.replace(state['part_path'], path)
+        os.remove(self._incoming_state_path(state['file_id']))
+        return path
+
+    # Keys
+
+    def flush_pending(self, username):
+        """Continue transfers that were waiting for a user's public key"""
+        paths = self.pending_files.pop(username, [])
+        offers = self.pending_offers.pop(username, [])
+        for offer in offers:
+            self.on_offer(offer)
+        for path in paths:
+            self.send_file(path, username)
+
+    def waiting_for(self, username):
+        """True if files or offers wait for a user's public key"""
+        return username in self.pending_files or username in self.pending_offers
+
+    def discard_pending(self, username):
+        """Drop what waited for the key of an unknown user"""
+        paths = self.pending_files.pop(username, None)
+        offers = self.pending_offers.pop(username, None)
+        return bool(paths or offers)
+
+    def handle(self, message):
+        msg_type = message['type']
+        if msg_type == 'file_chunk':
+            self.on_chunk(message)
+        elif msg_type == 'file_ack':
+            self.on_ack(message)
+        elif msg_type == 'file_offer':
+            self.on_offer(message)
+
+    def suspend(self):
+        """Stop the uploads after the connection dropped; progress is saved before this returns
+
+        They are offered again (and continue where the receiver is) once the
+        client is registered again.
+        """
+        with self.lock:
+            outgoing = list(self.outgoing.values())
+        for transfer in outgoing:
+            with transfer.condition:
+                transfer.condition.notify_all()
+        for transfer in outgoing:
+            if transfer.thread is not None:
+                transfer.thread.join(5)
+
+    def close(self):
+        """Stop after a disconnect"""
+        self.suspend()
+        for transfer in list(self.incoming.values()):
+            transfer.close()
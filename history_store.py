@@ -0,0 +1,344 @@
+# history_store.py - Encrypted local message history, segmented by conversation
+import bisect
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from metrics import registry, SIZE_BUCKETS
+
+# Index entry: record position | record size | timestamp. Entries have a
+# fixed size, so the entry of a sequence number is found by arithmetic.
+INDEX_ENTRY = struct.Struct('!QId')
+NONCE_SIZE = 12
+LOG_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+KEY_CHECK_FILE = 'key_check'
+KEY_CHECK_DATA = b'secure-chat history'
+
+HISTORY_APPENDS = registry.counter('client.history_appends')
+HISTORY_BATCH = registry.histogram('client.history_batch', SIZE_BUCKETS)
+HISTORY_DECRYPTS = registry.counter('client.history_decrypts')
+
+class Conversation:
+    """Segments of one conversation's history
+
+    A segment is a pair of files named after its first sequence number:
+    <seq>.log holds the sealed records back to back and <seq>.idx one
+    INDEX_ENTRY per record. Sequence numbers start at 1 and have no gaps,
+    so a seq is found with a bisect over the segments and one multiply.
+    The index timestamps never go backwards (a message stamped before the
+    previous one is indexed at the previous one's time), so the time index
+    is a bisect too.
+    """
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self.aad = name.encode('utf-8')
+        self.segments = []  # First seq of every segment, ascending
+        self.count = 0  # Last seq written (what readers can see)
+        self.next_seq = 1  # Next seq to assign (writer thread only)
+        self.last_timestamp = 0.0
+        self.log_file = None  # Files of the last segment, opened by the writer
+        self.index_file = None
+        self.log_size = 0
+        self.maps = {}  # {path: mmap} for reads
+        self._load()
+
+    def reload(self):
+        """Start over from what is on disk, after a failed write (writer thread, under the store lock)"""
+        self.close()
+        self.segments = []
+        self.count = 0
+        self.last_timestamp = 0.0
+        self.log_size = 0
+        self._load()
+        self.next_seq = self.count + 1
+
+    def _path(self, first, suffix):
+        return os.path.join(self.directory, f"{first:020d}{suffix}")
+
+    def _load(self):
+        if not os.path.isdir(self.directory):
+            return  # Created with its first record
+        self.segments = sorted(int(name[:-len(INDEX_SUFFIX)]) for name in os.listdir(self.directory)
+                               if name.endswith(INDEX_SUFFIX))
+        if not self.segments:
+            return
+        # Only the last segment can have a torn tail: records without an
+        # index entry, or entries whose record did not reach the disk
+        first = self.segments[-1]
+        index_path = self._path(first, INDEX_SUFFIX)
+        log_path = self._path(first, LOG_SUFFIX)
+        log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        entries = os.path.getsize(index_path) // INDEX_ENTRY.size
+        with open(index_path, 'rb') as f:
+            while entries:
+                f.seek((entries - 1) * INDEX_ENTRY.size)
+                position, size, timestamp = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+                if position + size <= log_size:
+                    self.last_timestamp = timestamp
+                    log_size = position + size
+                    break
+                entries -= 1
+            else:
+                log_size = 0
+        with open(index_path, 'r+b') as f:
+            f.truncate(entries * INDEX_ENTRY.size)
+        with open(log_path, 'ab') as f:
+            f.truncate(log_size)
+        self.count = first + entries - 1
+        self.next_seq = self.count + 1
+
+    def append(self, records, segment_entries):
+        """Write [(seq, timestamp, sealed record)] (writer thread, under the store lock)"""
+        for seq, timestamp, sealed in records:
+            if self.index_file is None or seq - self.segments[-1] >= segment_entries:
+                self._open_segment(seq, segment_entries)
+            timestamp = max(timestamp, self.last_timestamp)
+            self.log_file.write(sealed)
+            self.index_file.write(INDEX_ENTRY.pack(self.log_size, len(sealed), timestamp))
+            self.log_size += len(sealed)
+            self.last_timestamp = timestamp
+        # Records before their index entries: a crash never indexes a missing record
+        self.log_file.flush()
+        self.index_file.flush()
+        self.count = records[-1][0]
+
+    def _open_segment(self, seq, segment_entries):
+        """Open the last segment for appending, or start a new one at seq if it is full"""
+        self.close_files()
+        if not self.segments or seq - self.segments[-1] >= segment_entries:
+            os.makedirs(self.directory, exist_ok=True)
+            self.segments.append(seq)
+        self.log_file = open(self._path(self.segments[-1], LOG_SUFFIX), 'ab')
+        self.index_file = open(self._path(self.segments[-1], INDEX_SUFFIX), 'ab')
+        self.log_size = self.log_file.tell()
+
+    def sync(self):
+        for f in (self.log_file, self.index_file):
+            if f is not None:
+                os.fsync(f.fileno())
+
+    def _map(self, path, end):
+        """Return an mmap of a file covering at least end bytes"""
+        mapped = self.maps.get(path)
+        if mapped is None or len(mapped) < end:
+            if mapped is not None:
+                mapped.close()
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[path] = mapped
+        return mapped
+
+    def entry(self, seq):
+        """(position, size, timestamp) of a record, and its segment"""
+        first = self.segments[bisect.bisect_right(self.segments, seq) - 1]
+        offset = (seq - first) * INDEX_ENTRY.size
+        mapped = self._map(self._path(first, INDEX_SUFFIX), offset + INDEX_ENTRY.size)
+        return first, INDEX_ENTRY.unpack_from(mapped, offset)
+
+    def read(self, first_seq, last_seq):
+        """Sealed records of first_seq..last_seq, straight from the log (no decryption)"""
+        sealed = []
+        for seq in range(first_seq, last_seq + 1):
+            first, (position, size, timestamp) = self.entry(seq)
+            mapped = self._map(self._path(first, LOG_SUFFIX), position + size)
+            sealed.append((seq, mapped[position:position + size]))
+        return sealed
+
+    def timestamp(self, seq):
+        return self.entry(seq)[1][2]
+
+    def seq_at(self, timestamp):
+        """First seq indexed at or after timestamp (count + 1 if none)"""
+        low, high = 1, self.count + 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def close_files(self):
+        for f in (self.log_file, self.index_file):
+            if f is not None:
+                f.close()
+        self.log_file = self.index_file = None
+
+    def close(self):
+        self.close_files()
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps.clear()
+
+class HistoryStore:
+    """Decrypted chat history kept on disk, encrypted with a local key
+
+    Every record is a JSON object sealed with AES-256-GCM, bound to its
+    conversation and sequence number (a record cannot be moved to another
+    place of the history undetected). The key is derived from the identity
+    key, so the history is as protected as the identity key file.
+
+    append() only queues: a writer thread encrypts and writes whatever
+    accumulated in one batch, one flush per conversation, so the receive
+    path never waits for the disk. Reading is by pages: only the records
+    of the requested window are read and decrypted, however long the
+    conversation is.
+    """
+    def __init__(self, directory, key, segment_entries=64 * 1024, batch_size=1024, fsync=False,
+                 on_error=None):
+        self.directory = directory
+        self.aead = AESGCM(key)
+        self.segment_entries = segment_entries
+        self.batch_size = batch_size
+        self.fsync = fsync  # fsync every batch (otherwise left to the operating system)
+        self.on_error = on_error  # Called with the exception of a failed write (writer thread)
+        self.loaded = {}  # {conversation: Conversation} opened so far
+        self.lock = threading.Lock()  # Writer thread against readers
+        self.queue = queue.Queue()
+        os.makedirs(directory, exist_ok=True)
+        self._check_key()
+        self.thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self.thread.start()
+
+    def _check_key(self):
+        """Refuse a key other than the one the history was written with"""
+        path = os.path.join(self.directory, KEY_CHECK_FILE)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            try:
+                self.aead.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], KEY_CHECK_DATA)
+            except InvalidTag:
+                raise ValueError("El historial fue cifrado con otra llave de identidad")
+            return
+        nonce = os.urandom(NONCE_SIZE)
+        with open(path, 'wb') as f:
+            f.write(nonce + self.aead.encrypt(nonce, KEY_CHECK_DATA, KEY_CHECK_DATA))
+
+    def _conversation(self, name):
+        conversation = self.loaded.get(name)
+        if conversation is None:
+            # Directory names are hex: any conversation name, on any file system
+            path = os.path.join(self.directory, name.encode('utf-8').hex())
+            conversation = self.loaded[name] = Conversation(path, name)
+        return conversation
+
+    def conversations(self):
+        """Names of every conversation with history"""
+        return sorted(bytes.fromhex(name).decode('utf-8') for name in os.listdir(self.directory)
+                      if os.path.isdir(os.path.join(self.directory, name)))
+
+    # Writing
+
+    def append(self, conversation, record):
+        """Queue a record (a JSON-serializable dict with a 'timestamp'); callable from any thread"""
+        self.queue.put((conversation, record))
+
+    def flush(self):
+        """Wait until every queued record is on disk"""
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            try:
+                self._write_batch([item for item in batch if item is not None])
+            except Exception as e:
+                self._report(e)
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                return
+
+    def _report(self, error):
+        if self.on_error is not None:
+            self.on_error(error)
+
+    def _write_batch(self, batch):
+        # Sequence numbers are only taken once their records are written:
+        # a failed write leaves no gap for the next batch to skip over
+        by_conversation = {}
+        next_seqs = {}
+        for name, record in batch:
+            with self.lock:
+                conversation = self._conversation(name)
+            seq = next_seqs.get(conversation, conversation.next_seq)
+            next_seqs[conversation] = seq + 1
+            data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+            nonce = os.urandom(NONCE_SIZE)
+            sealed = nonce + self.aead.encrypt(nonce, data, conversation.aad + struct.pack('!Q', seq))
+            by_conversation.setdefault(conversation, []).append((seq, record['timestamp'], sealed))
+
+        written = 0
+        with self.lock:
+            for conversation, records in by_conversation.items():
+                try:
+                    conversation.append(records, self.segment_entries)
+                    if self.fsync:
+                        conversation.sync()
+                except Exception as e:
+                    # Whatever part of the batch reached the disk is kept
+                    conversation.reload()
+                    self._report(e)
+                    continue
+                conversation.next_seq = next_seqs[conversation]
+                written += len(records)
+        HISTORY_APPENDS.inc(written)
+        HISTORY_BATCH.observe(len(batch))
+
+    # Reading
+
+    def count(self, conversation):
+        """Number of records of a conversation (its last seq)"""
+        with self.lock:
+            return self._conversation(conversation).count
+
+    def seq_at(self, conversation, timestamp):
+        """First seq of a conversation at or after timestamp, for paging from a date"""
+        with self.lock:
+            return self._conversation(conversation).seq_at(timestamp)
+
+    def page(self, conversation, before=None, limit=50):
+        """Up to limit records before seq before (the newest without it), oldest first
+
+        Each record comes back with its 'seq'; the seq of the first one is
+        the before of the previous page.
+        """
+        with self.lock:
+            loaded = self._conversation(conversation)
+            last = loaded.count if before is None else min(before - 1, loaded.count)
+            first = max(1, last - limit + 1)
+            sealed = loaded.read(first, last) if last >= first else []
+
+        # Decrypted outside the lock: the writer is never held up by a reader
+        records = []
+        for seq, data in sealed:
+            record = json.loads(self.aead.decrypt(
+                data[:NONCE_SIZE], data[NONCE_SIZE:], loaded.aad + struct.pack('!Q', seq)))
+            record['seq'] = seq
+            records.append(record)
+        HISTORY_DECRYPTS.inc(len(records))
+        return records
+
+    def close(self):
+        """Write what is queued and stop the writer"""
+        self.queue.put(None)
+        self.thread.join()
+        with self.lock:
+            for conversation in self.loaded.values():
+                if self.fsync:
+                    conversation.sync()
+                conversation.close()
+            self.loaded.clear()
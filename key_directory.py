@@ -0,0 +1,204 @@
+# key_directory.py - Server-side public key directory and the client's cache of it
+import collections
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from crypto_utils import format_fingerprint
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS public_keys (
+    username TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    public_key TEXT NOT NULL,
+    published_at REAL NOT NULL,
+    PRIMARY KEY (username, version)
+);
+CREATE INDEX IF NOT EXISTS public_keys_fingerprint ON public_keys (fingerprint);
+"""
+
+# Trust of a directory entry against the local pins (KeyCache)
+TRUST_VERIFIED = 'verified'      # Same fingerprint as the pin
+TRUST_UNVERIFIED = 'unverified'  # No pin for this user
+TRUST_CHANGED = 'changed'        # Pinned to a different fingerprint
+
+def pem_fingerprint(public_key_pem):
+    """Fingerprint of a PEM as sent (clients send their canonical serialization)"""
+    if isinstance(public_key_pem, str):
+        public_key_pem = public_key_pem.encode('utf-8')
+    return format_fingerprint(hashlib.sha256(public_key_pem).hexdigest())
+
+def trust_level(pinned, fingerprint):
+    """Trust of a fingerprint given the pinned one (None if not pinned)"""
+    if pinned is None:
+        return TRUST_UNVERIFIED
+    return TRUST_VERIFIED if pinned == fingerprint else TRUST_CHANGED
+
+class DirectoryEntry:
+    """One published key: a (username, version) pair"""
+    __slots__ = ('username', 'version', 'fingerprint', 'public_key', 'online', 'expires', 'trust')
+
+    def __init__(self, username, version, fingerprint, public_key, online=False):
+        self.username = username
+        self.version = version  # Increases every time the user publishes a different key
+        self.fingerprint = fingerprint
+        self.public_key = public_key  # PEM text
+        self.online = online
+        self.expires = 0.0  # Client cache only
+        self.trust = None  # Client cache only
+
+    def to_message(self, with_key=True):
+        fields = {'username': self.username, 'version': self.version,
+                  'fingerprint': self.fingerprint, 'online': self.online}
+        if with_key:
+            fields['public_key'] = self.public_key
+        return fields
+
+class KeyDirectory:
+    """Versioned public keys of every user that ever registered
+
+    Keys stay published after their owner disconnects, so contacts can be
+    looked up (and messaged) while offline. A registration with a different
+    key adds a new version; the old versions stay queryable by fingerprint.
+    The latest version of every user seen since startup is kept in memory,
+    so lookups on the hot path do not touch SQLite.
+    """
+    def __init__(self, path=':memory:'):
+        if path != ':memory:':
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        # Created by whoever builds the server, used from its event loop thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.latest = {}  # {username: DirectoryEntry}
+        self.online = set()
+
+    def publish(self, username, public_key_pem):
+        """Record the key a user registered with; returns its entry"""
+        fingerprint = pem_fingerprint(public_key_pem)
+        entry = self.lookup(username)
+        if entry is None or entry.fingerprint != fingerprint:
+            version = entry.version + 1 if entry is not None else 1
+            with self.connection:
+                self.connection.execute(
+                    "INSERT INTO public_keys (username, version, fingerprint, public_key, published_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (username, version, fingerprint, public_key_pem, time.time())
+                )
+            entry = DirectoryEntry(username, version, fingerprint, public_key_pem)
+            self.latest[username] = entry
+        self.set_online(username, True)
+        return entry
+
+    def set_online(self, username, online):
+        if online:
+            self.online.add(username)
+        else:
+            self.online.discard(username)
+        entry = self.latest.get(username)
+        if entry is not None:
+            entry.online = online
+
+    def lookup(self, username):
+        """Latest entry of a user, or None if the user never registered"""
+        entry = self.latest.get(username)
+        if entry is None:
+            row = self.connection.execute(
+                "SELECT version, fingerprint, public_key FROM public_keys "
+                "WHERE username = ? ORDER BY version DESC LIMIT 1", (username,)
+            ).fetchone()
+            if row is None:
+                return None
+            entry = DirectoryEntry(username, *row, online=username in self.online)
+            self.latest[username] = entry
+        return entry
+
+    def lookup_fingerprint(self, fingerprint):
+        """Entry (of any version) published with a fingerprint"""
+        row = self.connection.execute(
+            "SELECT username, version, public_key FROM public_keys WHERE fingerprint = ? "
+            "ORDER BY published_at DESC LIMIT 1", (fingerprint,)
+        ).fetchone()
+        if row is None:
+            return None
+        username, version, public_key = row
+        return DirectoryEntry(username, version, fingerprint, public_key, online=username in self.online)
+
+    def close(self):
+        self.connection.close()
+
+class DirectoryCache:
+    """Client-side TTL/LRU cache of directory entries, checked against the pins
+
+    Every entry is validated when it is stored: the fingerprint is computed
+    from the key itself (the server's claim is not trusted) and compared
+    with the KeyCache pin of the user. Fresh entries answer lookups without
+    a round trip; stale ones are still usable while they are revalidated
+    with the version the client already has.
+    """
+    def __init__(self, key_cache, ttl=300.0, max_size=1024):
+        self.key_cache = key_cache
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # {username: DirectoryEntry}
+        self.lock = threading.Lock()  # Used from the UI and receive threads
+
+    def get(self, username):
+        """Cached entry (fresh or stale) of a user, or None"""
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is not None:
+                self.entries.move_to_end(username)
+            return entry
+
+    def is_fresh(self, entry):
+        return entry is not None and entry.expires > time.monotonic()
+
+    def put(self, entry, fingerprint):
+        """Store an entry whose key hashes to fingerprint; returns the entry"""
+        if fingerprint != entry.fingerprint:
+            raise ValueError(f"La llave de {entry.username} no coincide con su fingerprint")
+        entry.trust = trust_level(self.key_cache.get_cached_fingerprint(entry.username), fingerprint)
+        entry.expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[entry.username] = entry
+            self.entries.move_to_end(entry.username)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def refresh(self, username, version, online):
+        """The server confirmed the cached version: extend its lifetime"""
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None or entry.version != version:
+                return None
+            entry.online = online
+            entry.expires = time.monotonic() + self.ttl
+            return entry
+
+    def known_versions(self, usernames):
+        """{username: version} of cached entries, for conditional lookups"""
+        with self.lock:
+            return {username: self.entries[username].version
+                    for username in usernames if username in self.entries}
+
+    def revalidate(self, username=None):
+        """Re-check entries against the pins after a verification or a cache clear"""
+        with self.lock:
+            if username is None:
+                entries = list(self.entries.values())
+            else:
+                entries = [self.entries[username]] if username in self.entries else []
+        for entry in entries:
+            pinned = self.key_cache.get_cached_fingerprint(entry.username)
+            entry.trust = trust_level(pinned, entry.fingerprint)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,79 @@
+# key_pool.py - Background pool of pre-generated RSA keys
+import multiprocessing
+import queue
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+def _generate_keys(key_queue, key_size):
+    """Worker process: keep the queue full of serialized private keys"""
+    while True:
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+        key_queue.put(private_key.private_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ))
+
+class KeyPool:
+    """Pre-generated RSA keypairs for ephemeral sessions and first-run identities
+
+    A worker process generates keys ahead of time, so taking one costs a
+    DER parse instead of a full RSA-2048 generation on the critical path.
+    """
+    def __init__(self, size=4, key_size=2048, workers=1):
+        self.size = size
+        self.key_size = key_size
+        self.workers = workers
+        self.key_queue = None
+        self.processes = []
+
+    def start(self):
+        if self.processes:
+            return
+        self.key_queue = multiprocessing.Queue(maxsize=self.size)
+        for _ in range(self.workers):
+            process = multiprocessing.Process(
+                target=_generate_keys,
+                args=(self.key_queue, self.key_size),
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+
+    def available(self):
+        """Approximate number of ready keys"""
+        if self.key_queue is None:
+            return 0
+        try:
+            return self.key_queue.qsize()
+        except NotImplementedError:  # macOS
+            return 0
+
+    def get(self, timeout=None):
+        """Take a private key from the pool
+
+        Without a timeout this never waits: if the pool is empty the key is
+        generated in-process instead.
+        """
+        if self.key_queue is not None:
+            try:
+                if timeout is None:
+                    der_data = self.key_queue.get_nowait()
+                else:
+                    der_data = self.key_queue.get(timeout=timeout)
+                # Generated by our own worker: skip the (slow) RSA consistency checks
+                return serialization.load_der_private_key(
+                    der_data, password=None, unsafe_skip_rsa_key_validation=True)
+            except queue.Empty:
+                pass
+        return rsa.generate_private_key(public_exponent=65537, key_size=self.key_size)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.key_queue is not None:
+            self.key_queue.close()
+            self.key_queue = None
@@ -0,0 +1,354 @@
+# load_test.py - Load generator for the relay server (main.py bench)
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+from admission import UNTHROTTLED
+from benchmarks import free_port
+from cipher_suites import DEFAULT_SUITE, SUITES, get_suite
+from crypto_utils import CryptoManager
+from metrics import registry
+from protocol import FrameDecoder, encode_message
+from server import SecureChatServer
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Files whose versions the results are tracked against
+TRACKED_FILES = ('crypto_utils.py', 'protocol.py', 'server.py', 'client.py')
+
+def process_usage():
+    """CPU seconds and peak RSS (bytes) of the calling process"""
+    if resource is None:
+        return {'cpu_seconds': time.process_time(), 'max_rss_bytes': None}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {'cpu_seconds': usage.ru_utime + usage.ru_stime, 'max_rss_bytes': usage.ru_maxrss * scale}
+
+def current_rss():
+    """Resident set size right now (Linux only)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def _server_process(port, control, server_options):
+    """Child process: run the relay and answer usage requests until told to stop"""
+    sys.stdout = open(os.devnull, 'w')  # Per-message logging would dominate the profile
+    server = SecureChatServer(port=port, **server_options)
+    threading.Thread(target=server.start, daemon=True).start()
+    while True:
+        command = control.recv()
+        usage = process_usage()
+        usage['rss_bytes'] = current_rss()
+        if command == 'stop':
+            usage['metrics'] = registry.snapshot()
+        control.send(usage)
+        if command == 'stop':
+            break
+
+class ServerHandle:
+    """A relay server in a separate process, so its CPU and memory are measured alone"""
+    def __init__(self, **server_options):
+        self.port = free_port()
+        self.control, child_control = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_server_process,
+            args=(self.port, child_control, server_options),
+            daemon=True
+        )
+
+    def start(self, timeout=10):
+        self.process.start()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('localhost', self.port)).close()
+                return
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError("El servidor no arrancó a tiempo")
+
+    def usage(self):
+        self.control.send('usage')
+        return self.control.recv()
+
+    def stop(self):
+        self.control.send('stop')
+        usage = self.control.recv()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        return usage
+
+class BenchBot:
+    """A headless client: same wire format and crypto as SecureChatClient, no UI"""
+    def __init__(self, username, private_key, room):
+        self.username = username
+        self.room = room
+        self.crypto = CryptoManager()
+        self.crypto.set_private_key(private_key)
+        self.members = set()
+        self.registered = threading.Event()
+        self.socket = None
+        self.send_lock = threading.Lock()
+        self.latencies = []  # Seconds from encryption to verified delivery
+        self.received = 0
+        self.errors = 0
+
+    def connect(self, port):
+        self.socket = socket.create_connection(('localhost', port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.sendall(encode_message({
+            'type': 'register',
+            'username': self.username,
+            'public_key': self.crypto.get_public_key_pem().decode('utf-8'),
+            'suite': self.crypto.suite.name
+        }))
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+
+    def join(self):
+        self.socket.sendall(encode_message({'type': 'join_room', 'room': self.room}))
+
+    def receive_loop(self):
+        decoder = FrameDecoder()
+        try:
+            while decoder.recv_from(self.socket):
+                for message in decoder.messages():
+                    self.handle(message)
+        except OSError:
+            pass
+
+    def handle(self, message):
+        msg_type = message.get('type')
+        if msg_type == 'encrypted_message':
+            try:
+                text, session_key, counter = self.crypto.open_session_message(message, self.username)
+                self.crypto.accept_counter(session_key, counter)
+                sender_key = self.crypto.peer_public_keys.get(message['from'])
+                if not self.crypto.verify_signature(text, message['signature'], sender_key):
+                    raise ValueError("firma inválida")
+                sent_ns = int(text.split(' ', 2)[1])
+                self.latencies.append((time.monotonic_ns() - sent_ns) / 1e9)
+                self.received += 1
+            except Exception:
+                self.errors += 1
+        elif msg_type == 'registration_success':
+            self.registered.set()
+        elif msg_type == 'room_members':
+            for username, public_key_pem in message['members'].items():
+                self.crypto.add_peer_public_key(username, public_key_pem.encode('utf-8'))
+                self.members.add(username)
+        elif msg_type == 'member_joined':
+            self.crypto.add_peer_public_key(message['username'], message['public_key'].encode('utf-8'))
+            self.members.add(message['username'])
+        elif msg_type == 'error':
+            self.errors += 1
+
+    def send(self, size):
+        """Encrypt, sign and send one timestamped message to the room"""
+        text = f"bench {time.monotonic_ns()} "
+        text += 'x' * max(0, size - len(text))
+        with self.send_lock:
+            message_data = self.crypto.encrypt_session_message(text, self.members, ('room', self.room))
+            message_data['type'] = 'encrypted_message'
+            message_data['room'] = self.room
+            message_data['signature'] = self.crypto.sign_message(text)
+            self.socket.sendall(encode_message(message_data))
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def file_versions():
+    """Short content hash of the tracked source files"""
+    base = os.path.dirname(os.path.abspath(__file__))
+    versions = {}
+    for name in TRACKED_FILES:
+        try:
+            with open(os.path.join(base, name), 'rb') as f:
+                versions[name] = hashlib.sha256(f.read()).hexdigest()[:12]
+        except OSError:
+            versions[name] = None
+    return versions
+
+def run_load_test(clients=10, rate=10.0, size=256, duration=10.0, room_size=2,
+                  warmup=1.0, suite=DEFAULT_SUITE, **server_options):
+    """Drive clients bots at rate messages/s each and measure the relay
+
+    Bots are grouped in rooms of room_size members, so every message is
+    fanned out to room_size - 1 receivers. Sends follow a fixed schedule
+    (open loop): if the system falls behind, the backlog shows up as
+    latency instead of silently lowering the offered load.
+    """
+    room_size = max(2, min(room_size, clients))
+    # Every bot connects from loopback: per-IP caps would measure the limiter, not the relay
+    server_options.setdefault('limits', UNTHROTTLED)
+    server = ServerHandle(**server_options)
+    server.start()
+
+    # One identity key for every bot: key generation is not what is measured
+    private_key = get_suite(suite).generate_private_key()
+    bots = [BenchBot(f"bot{i}", private_key, f"room{i // room_size}") for i in range(clients)]
+    # A short last room would see a different fan-out; fold it into the previous one
+    if clients % room_size and clients > room_size:
+        for bot in bots[-(clients % room_size):]:
+            bot.room = f"room{clients // room_size - 1}"
+
+    server_usage = None
+    try:
+        setup_start = time.perf_counter()
+        for bot in bots:
+            bot.connect(server.port)
+        for bot in bots:
+            if not bot.registered.wait(10):
+                raise RuntimeError(f"{bot.username} no pudo registrarse")
+        room_sizes = {}
+        for bot in bots:
+            room_sizes[bot.room] = room_sizes.get(bot.room, 0) + 1
+        for bot in bots:
+            bot.join()
+        # Every bot needs the keys of all the other members of its room
+        deadline = time.monotonic() + 30
+        for bot in bots:
+            while len(bot.members) < room_sizes[bot.room] - 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        setup_seconds = time.perf_counter() - setup_start
+
+        # Warm up session keys (the first message of each sender wraps its key)
+        for bot in bots:
+            bot.send(size)
+        time.sleep(warmup)
+        for bot in bots:
+            bot.latencies = []
+            bot.received = 0
+
+        server_before = server.usage()
+        bots_before = process_usage()
+        interval = 1.0 / (rate * clients)
+        sent = 0
+        start = time.monotonic()
+        end = start + duration
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            due = int((now - start) / interval) + 1
+            while sent < due:
+                bots[sent % clients].send(size)
+                sent += 1
+            sleep_for = start + sent * interval - time.monotonic()
+            if sleep_for > 0:
+                time.sleep(sleep_for)
+        send_seconds = time.monotonic() - start
+
+        # Let in-flight messages arrive
+        expected = sum(room_sizes[bots[i % clients].room] - 1 for i in range(sent))
+        drain_deadline = time.monotonic() + 10
+        while sum(bot.received for bot in bots) < expected and time.monotonic() < drain_deadline:
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+        server_after = server.usage()
+        bots_after = process_usage()
+    finally:
+        for bot in bots:
+            bot.close()
+        server_usage = server.stop()
+
+    latencies = sorted(latency for bot in bots for latency in bot.latencies)
+    delivered = len(latencies)
+    return {
+        'config': {
+            'clients': clients,
+            'rate_per_client': rate,
+            'message_size': size,
+            'duration_seconds': duration,
+            'room_size': room_size,
+            'suite': suite,
+            'server_options': server_options,
+        },
+        'setup_seconds': setup_seconds,
+        'messages': {
+            'target': int(rate * clients * duration),
+            'sent': sent,
+            'expected_deliveries': expected,
+            'delivered': delivered,
+            'errors': sum(bot.errors for bot in bots),
+        },
+        'throughput': {
+            'sent_per_second': sent / send_seconds,
+            'delivered_per_second': delivered / elapsed,
+        },
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50) * 1000 if latencies else None,
+            'p99': percentile(latencies, 0.99) * 1000 if latencies else None,
+            'max': latencies[-1] * 1000 if latencies else None,
+        },
+        'server': {
+            'cpu_percent': (server_after['cpu_seconds'] - server_before['cpu_seconds']) / elapsed * 100,
+            'rss_bytes': server_after['rss_bytes'],
+            'max_rss_bytes': server_after['max_rss_bytes'],
+            'metrics': server_usage['metrics'] if server_usage else None,
+        },
+        'bots': {
+            'cpu_percent': (bots_after['cpu_seconds'] - bots_before['cpu_seconds']) / elapsed * 100,
+            'max_rss_bytes': bots_after['max_rss_bytes'],
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'files': file_versions(),
+        },
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='main.py bench', description="Prueba de carga del relay")
+    parser.add_argument('--clients', type=int, default=10, help="número de bots")
+    parser.add_argument('--rate', type=float, default=10.0, help="mensajes por segundo de cada bot")
+    parser.add_argument('--size', type=int, default=256, help="tamaño del mensaje en bytes")
+    parser.add_argument('--duration', type=float, default=10.0, help="segundos de envío")
+    parser.add_argument('--room-size', type=int, default=2, help="miembros por sala (fan-out + 1)")
+    parser.add_argument('--flush-interval', type=float, default=0.0,
+                        help="segundos de espera para agrupar escrituras en el servidor")
+    parser.add_argument('--suite', choices=list(SUITES), default=DEFAULT_SUITE,
+                        help="suite de cifrado de los bots")
+    parser.add_argument('--output', help="archivo donde guardar el JSON (por defecto, stdout)")
+    args = parser.parse_args(argv)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = run_load_test(args.clients, args.rate, args.size, args.duration, args.room_size,
+                                suite=args.suite, flush_interval=args.flush_interval)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+        print(f"📊 Resultados guardados en {args.output}")
+    else:
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
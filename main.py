@@ -1,30 +1,149 @@
+import logging
+import os
 import sys
 from server import SecureChatServer
-from client import SecureChatClient
+from client import SecureChatClient, NetworkLoop
+from cli import ChatCLI
+from key_pool import KeyPool
+from cipher_suites import SUITE_RSA
+from admission import DEFAULT_LIMITS
+import cluster
+import load_test
+import metrics
+
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    load_dotenv = None
+
+def option(name, default=None):
+    """Value of a '--name value' command line option"""
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
+def limit_options():
+    """Admission limits given as --max-connections, --user-rate... ('none' disables one)"""
+    limits = {}
+    for name, default in DEFAULT_LIMITS.items():
+        value = option('--' + name.replace('_', '-'))
+        if value is not None:
+            limits[name] = None if value.lower() == 'none' else type(default)(float(value))
+    return limits
+
+def start_instrumentation():
+    """Logging level, metrics export and profiler from the command line"""
+    level = 'DEBUG' if '--verbose' in sys.argv else os.environ.get('CHAT_LOG_LEVEL', 'INFO')
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+    logging.getLogger('secure_chat').setLevel(level.upper())
+    
+    stoppers = []
+    metrics_port = option('--metrics-port', os.environ.get('CHAT_METRICS_PORT'))
+    if metrics_port:
+        http_server = metrics.start_http_server(int(metrics_port))
+        stoppers.append(http_server.shutdown)
+        print(f"📊 Métricas en http://localhost:{metrics_port}/metrics")
+    metrics_dump = option('--metrics-dump', os.environ.get('CHAT_METRICS_DUMP'))
+    if metrics_dump:
+        dumper = metrics.MetricsDumper(metrics_dump)
+        dumper.start()
+        stoppers.append(dumper.stop)
+    profile = option('--profile', os.environ.get('CHAT_PROFILE'))
+    if profile:
+        profiler = metrics.SamplingProfiler(profile)
+        profiler.start()
+        stoppers.append(profiler.stop)
+    return stoppers
 
 def main():
+    # .env settings apply to every mode (CHAT_LOG_LEVEL, CHAT_TICKET_KEY...), so load them first
+    if load_dotenv is not None:
+        load_dotenv()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        # Load test: JSON on stdout, no banner
+        return load_test.main(sys.argv[2:])
+    
     print("Sistema de Chat Seguro con Cifrado Asimétrico")
     print("=" * 50)
     
+    stoppers = start_instrumentation()
+    try:
+        run()
+    finally:
+        for stop in stoppers:
+            stop()
+
+def run():
     if len(sys.argv) > 1 and sys.argv[1] == 'server':
-        # Run server
-        server = SecureChatServer()
+        # Run server (a cluster node if --cluster-listen is given)
+        bus = None
+        ticket_key = os.environ.get('CHAT_TICKET_KEY')
+        cluster_listen = option('--cluster-listen')
+        if cluster_listen:
+            # Hex secret shared by every node: links without it are refused
+            bus_secret = os.environ.get('CHAT_CLUSTER_SECRET')
+            if not bus_secret:
+                print("❌ El modo cluster requiere CHAT_CLUSTER_SECRET (el mismo en todos los nodos)")
+                return
+            peers = [peer for peer in option('--cluster-peers', '').split(',') if peer]
+            bus = cluster.SocketBus(option('--node-id', cluster_listen), cluster_listen, peers,
+                                    bytes.fromhex(bus_secret))
+        server = SecureChatServer(
+            host=option('--host', 'localhost'),
+            store_dir='offline_messages',
+            directory_file='key_directory.db',
+            cluster=bus,
+            reuse_port='--reuse-port' in sys.argv,
+            flush_interval=float(option('--flush-interval', 0)),
+            suites=[suite for suite in option('--suites', '').split(',') if suite],
+            # Hex AES-256 key, shared by the nodes that should accept each other's tickets
+            ticket_key=bytes.fromhex(ticket_key) if ticket_key else None,
+            limits=limit_options()
+        )
         try:
             server.start()
         except KeyboardInterrupt:
             print("\nCerrando servidor...")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'cluster':
+        # Several server processes on one port, linked by Unix sockets
+        nodes = int(option('--nodes', os.cpu_count() or 2))
+        print(f"🔗 Iniciando cluster local de {nodes} nodos")
+        cluster.run_local_cluster(nodes, store_dir='offline_messages')
+        print("\nCerrando cluster...")
     else:
         # Run client
-        username = input("Ingresa tu nombre de usuario: ").strip()
-        if not username:
-            print("Nombre de usuario requerido")
-            return
-            
-        client = SecureChatClient(username)
-        client.connect()
+
+        # Identity suite: the existing identity (or x25519-ed25519) unless chosen
+        suite = option('--suite', os.environ.get('CHAT_SUITE'))
         
-        if client.connected:
-            client.start_chat()
+        # Pre-generate RSA keys while the user types, in case there is no identity yet
+        key_pool = KeyPool(size=1)
+        if suite == SUITE_RSA:
+            key_pool.start()
+        
+        network = NetworkLoop().start()
+        try:
+            username = input("Ingresa tu nombre de usuario: ").strip()
+            if not username:
+                print("Nombre de usuario requerido")
+                return
+                
+            # The session lives on the network loop; the CLI only reads and prints
+            client = SecureChatClient(
+                username,
+                passphrase=os.environ.get('CHAT_KEY_PASSPHRASE'),
+                key_pool=key_pool,
+                ephemeral='--ephemeral' in sys.argv,
+                suite=suite,
+                loop=network.loop
+            )
+            ChatCLI(client).run()
+        finally:
+            network.stop()
+            key_pool.stop()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
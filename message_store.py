@@ -0,0 +1,411 @@
+# message_store.py - Append-only store for messages to offline users
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+# Record layout: length | crc32 | timestamp | seq | recipient length | recipient | frame
+# The crc covers everything after itself; length counts the bytes after the crc
+RECORD_HEADER = struct.Struct('!IIdQH')
+RECORD_FIXED = struct.Struct('!dQH')  # The part of the header covered by the crc
+SEGMENT_SUFFIX = '.log'
+CURSORS_FILE = 'cursors.json'
+
+# When appended records reach the disk
+FSYNC_ALWAYS = 'always'  # After every append
+FSYNC_BATCH = 'batch'    # Every fsync_batch appends or fsync_interval seconds
+FSYNC_NEVER = 'never'    # Left to the operating system
+
+# Live bytes compact_steps() copies between two yields
+COMPACTION_STEP_BYTES = 1024 * 1024
+
+class StoredMessage:
+    """Location of one pending message in the log"""
+    __slots__ = ('seq', 'segment', 'position', 'size', 'timestamp')
+
+    def __init__(self, seq, segment, position, size, timestamp):
+        self.seq = seq
+        self.segment = segment  # Base offset of the segment file
+        self.position = position  # Record start inside the segment
+        self.size = size  # Whole record size
+        self.timestamp = timestamp
+
+class OfflineMessageStore:
+    """Segmented append-only log of encrypted frames for offline recipients
+
+    Frames are stored exactly as relayed, so the store never holds
+    plaintext. Every recipient has an in-memory index of pending records
+    (rebuilt from the segments on startup) and a delivery cursor (the last
+    delivered sequence number) persisted in cursors.json.
+
+    The store has a single writer (the server's event loop), which never
+    waits for the disk: appends only reach the page cache, sync_job()
+    hands the fsyncs and the cursors file to another thread, and
+    compact_steps() reclaims space a bounded amount at a time. Callers run
+    the sync when needs_sync() says so; sync() and compact() do the same
+    work in one blocking call.
+    """
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 fsync_policy=FSYNC_BATCH, fsync_batch=256, fsync_interval=1.0,
+                 retention_seconds=7 * 24 * 3600, max_total_bytes=1024 * 1024 * 1024,
+                 max_pending_per_recipient=10000, compaction_ratio=0.5):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_policy = fsync_policy
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.retention_seconds = retention_seconds
+        self.max_total_bytes = max_total_bytes
+        self.max_pending_per_recipient = max_pending_per_recipient
+        self.compaction_ratio = compaction_ratio
+
+        self.index = {}  # {recipient: deque of StoredMessage in delivery order}
+        self.cursors = {}  # {recipient: last delivered seq}
+        self.next_seq = {}  # {recipient: next seq to assign}
+        self.segments = {}  # {base offset: segment size in bytes}
+        self.maps = {}  # {base offset: mmap} for replay reads
+        self.active = None  # Base offset of the segment being appended to
+        self.active_file = None
+        self.unsynced = 0
+        self.unsynced_fds = []  # Duplicated descriptors of rolled segments, fsynced by the next job
+        self.last_sync = time.monotonic()
+        self.cursors_dirty = False
+        self.sync_lock = threading.Lock()  # One sync job writing at a time
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _segment_path(self, base):
+        return os.path.join(self.directory, f"{base:020d}{SEGMENT_SUFFIX}")
+
+    def _load(self):
+        """Rebuild the per-recipient index by scanning every segment"""
+        cursors_path = os.path.join(self.directory, CURSORS_FILE)
+        if os.path.exists(cursors_path):
+            with open(cursors_path, 'r', encoding='utf-8') as f:
+                self.cursors = json.load(f)
+        for username, seq in self.cursors.items():
+            self.next_seq[username] = seq + 1
+
+        pending = {}
+        bases = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                       if name.endswith(SEGMENT_SUFFIX))
+        for base in bases:
+            size = self._scan_segment(base, pending)
+            self.segments[base] = size
+
+        for recipient, records in pending.items():
+            # Records copied forward by compaction may appear twice
+            ordered = sorted(records.values(), key=lambda record: record.seq)
+            self.index[recipient] = deque(ordered)
+            self.next_seq[recipient] = max(self.next_seq.get(recipient, 1), ordered[-1].seq + 1)
+
+        if bases:
+            self.active = bases[-1]
+        self._open_active()
+
+    def _scan_segment(self, base, pending):
+        path = self._segment_path(base)
+        if os.path.getsize(path) == 0:
+            return 0
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        position = 0
+        while position + RECORD_HEADER.size <= len(data):
+            length, crc, timestamp, seq, name_length = RECORD_HEADER.unpack_from(data, position)
+            end = position + 8 + length
+            if end > len(data) or zlib.crc32(data[position + 8:end]) != crc:
+                break  # Torn write at the tail: drop it
+
+            name_start = position + RECORD_HEADER.size
+            recipient = data[name_start:name_start + name_length].decode('utf-8')
+            if seq > self.cursors.get(recipient, 0):
+                pending.setdefault(recipient, {})[seq] = StoredMessage(
+                    seq, base, position, end - position, timestamp)
+            position = end
+
+        torn = position < len(data)
+        data.close()
+        if torn:
+            with open(path, 'r+b') as f:
+                f.truncate(position)
+        return position
+
+    def _open_active(self):
+        if self.active is None or self.segments[self.active] >= self.segment_size:
+            self.active = self._next_base()
+            self.segments[self.active] = 0
+        self.active_file = open(self._segment_path(self.active), 'ab')
+
+    def _next_base(self):
+        if not self.segments:
+            return 0
+        last = max(self.segments)
+        return last + self.segments[last]
+
+    def _roll_segment(self):
+        self.active_file.flush()
+        if self.unsynced and self.fsync_policy != FSYNC_NEVER:
+            self.unsynced_fds.append(os.dup(self.active_file.fileno()))
+        self.active_file.close()
+        self.active = self._next_base()
+        self.segments[self.active] = 0
+        self.active_file = open(self._segment_path(self.active), 'ab')
+
+    def register(self, username):
+        """Start keeping messages for a user who has registered at least once"""
+        if username not in self.cursors:
+            self.cursors[username] = 0
+            self.next_seq.setdefault(username, 1)
+            self.cursors_dirty = True
+
+    def knows(self, username):
+        return username in self.cursors
+
+    def has_pending(self, username):
+        return bool(self.index.get(username))
+
+    def pending_count(self, username):
+        return len(self.index.get(username, ()))
+
+    def append(self, recipient, frame, seq=None, timestamp=None):
+        """Append an encrypted frame for an offline recipient"""
+        if seq is None:
+            seq = self.next_seq.get(recipient, 1)
+            self.next_seq[recipient] = seq + 1
+        if timestamp is None:
+            timestamp = time.time()
+
+        segment, position, size = self._write_record(recipient, seq, timestamp, frame)
+        records = self.index.setdefault(recipient, deque())
+        records.append(StoredMessage(seq, segment, position, size, timestamp))
+        if len(records) > self.max_pending_per_recipient:
+            # Oldest messages are dropped first
+            dropped = records.popleft()
+            self.cursors[recipient] = dropped.seq
+            self.cursors_dirty = True
+        return seq
+
+    def needs_sync(self):
+        """True if the fsync policy wants the appends on disk now (run sync_job)"""
+        if not self.unsynced:
+            return False
+        return (self.fsync_policy == FSYNC_ALWAYS or
+                (self.fsync_policy == FSYNC_BATCH and self.unsynced >= self.fsync_batch))
+
+    def _write_record(self, recipient, seq, timestamp, frame):
+        name = recipient.encode('utf-8')
+        body = RECORD_FIXED.pack(timestamp, seq, len(name)) + name + frame
+        record = struct.pack('!II', len(body), zlib.crc32(body)) + body
+
+        if self.segments[self.active] and self.segments[self.active] + len(record) > self.segment_size:
+            self._roll_segment()
+
+        position = self.segments[self.active]
+        self.active_file.write(record)
+        self.segments[self.active] = position + len(record)
+        self.unsynced += 1
+        return self.active, position, len(record)
+
+    def sync(self, force=False):
+        """Flush appended records and delivery cursors to disk"""
+        job = self.sync_job(force)
+        if job is not None:
+            job()
+
+    def sync_job(self, force=False):
+        """The disk work of sync() as a callable for another thread (None if nothing is due)
+
+        The records are flushed to the operating system here, on the
+        writer's thread; the job fsyncs duplicated descriptors and writes a
+        snapshot of the cursors, so appends can go on while it runs.
+        """
+        fds, self.unsynced_fds = self.unsynced_fds, []
+        if self.unsynced and (force or self.fsync_policy == FSYNC_ALWAYS or
+                              time.monotonic() - self.last_sync >= self.fsync_interval):
+            self.active_file.flush()
+            if self.fsync_policy != FSYNC_NEVER:
+                fds.append(os.dup(self.active_file.fileno()))
+            self.unsynced = 0
+            self.last_sync = time.monotonic()
+
+        cursors = None
+        if self.cursors_dirty:
+            cursors = json.dumps(self.cursors)
+            self.cursors_dirty = False
+        if not fds and cursors is None:
+            return None
+
+        def job():
+            with self.sync_lock:
+                try:
+                    for fd in fds:
+                        os.fsync(fd)
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+                if cursors is not None:
+                    self._write_cursors(cursors)
+        return job
+
+    def _write_cursors(self, cursors):
+        path = os.path.join(self.directory, CURSORS_FILE)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(cursors)
+                f.flush()
+                if self.fsync_policy != FSYNC_NEVER:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except OSError:
+            self.cursors_dirty = True  # Written again by the next sync
+            raise
+
+    def _map(self, base, end):
+        """Return an mmap of a segment covering at least end bytes"""
+        mapped = self.maps.get(base)
+        if mapped is None or len(mapped) < end:
+            if mapped is not None:
+                mapped.close()
+            if base == self.active:
+                self.active_file.flush()
+            with open(self._segment_path(base), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[base] = mapped
+        return mapped
+
+    def _read_frame(self, record):
+        mapped = self._map(record.segment, record.position + record.size)
+        name_length = RECORD_HEADER.unpack_from(mapped, record.position)[4]
+        start = record.position + RECORD_HEADER.size + name_length
+        return mapped[start:record.position + record.size]
+
+    def read_pending(self, recipient, max_bytes=256 * 1024):
+        """Return up to max_bytes of pending frames as (last_seq, frames)"""
+        frames = []
+        total = 0
+        last_seq = None
+        for record in self.index.get(recipient, ()):
+            if frames and total + record.size > max_bytes:
+                break
+            frame = self._read_frame(record)
+            frames.append(frame)
+            total += len(frame)
+            last_seq = record.seq
+        return last_seq, frames
+
+    def ack(self, recipient, seq):
+        """Mark every pending message up to seq as delivered"""
+        records = self.index.get(recipient)
+        while records and records[0].seq <= seq:
+            records.popleft()
+        if records is not None and not records:
+            del self.index[recipient]
+        if seq > self.cursors.get(recipient, 0):
+            self.cursors[recipient] = seq
+            self.cursors_dirty = True
+
+    def total_bytes(self):
+        return sum(self.segments.values())
+
+    def compact(self):
+        """Apply retention and reclaim segments with little live data"""
+        for job in self.compact_steps():
+            if job is not None:
+                job()
+
+    def compact_steps(self, step_bytes=COMPACTION_STEP_BYTES):
+        """compact() a bounded amount of work at a time (a generator, on the writer's thread)
+
+        Yields None between steps, where appends and acks may run, and a
+        sync job that must finish before the next step (the copies of a
+        segment are on disk before it is deleted).
+        """
+        now = time.time()
+        live = {base: 0 for base in self.segments}
+        for recipient, records in list(self.index.items()):
+            # Retention: expired messages are treated as delivered
+            while records and now - records[0].timestamp > self.retention_seconds:
+                self.ack(recipient, records[0].seq)
+            for record in records:
+                live[record.segment] += record.size
+
+        sealed = sorted(base for base in self.segments if base != self.active)
+        over_budget = self.total_bytes() - self.max_total_bytes
+        for base in sealed:
+            if base not in self.segments:
+                continue
+            if live[base] == 0:
+                self._delete_segment(base)
+            elif over_budget > 0:
+                # Disk budget exceeded: the oldest pending messages are dropped
+                over_budget -= self.segments[base]
+                self._drop_segment_records(base)
+                self._delete_segment(base)
+            elif live[base] < self.segments[base] * self.compaction_ratio:
+                yield from self._copy_forward(base, step_bytes)
+                yield self.sync_job(force=True)
+                self._delete_segment(base)
+            yield None
+        yield self.sync_job(force=True)
+
+    def _copy_forward(self, base, step_bytes):
+        """Re-append the live records of a segment, keeping their seq numbers
+
+        A generator yielding every step_bytes copied; records acknowledged
+        in between are skipped.
+        """
+        targets = [(recipient, record) for recipient, records in self.index.items()
+                   for record in records if record.segment == base]
+        copied = 0
+        for recipient, record in targets:
+            records = self.index.get(recipient)
+            if not records or record.seq < records[0].seq or record.segment != base:
+                continue  # Delivered since
+            frame = self._read_frame(record)
+            # Same seq and position in the index: delivery order is unchanged
+            record.segment, record.position, record.size = self._write_record(
+                recipient, record.seq, record.timestamp, frame)
+            copied += record.size
+            if copied >= step_bytes:
+                copied = 0
+                yield None
+
+    def _drop_segment_records(self, base):
+        for recipient in list(self.index):
+            records = self.index[recipient]
+            kept = deque(record for record in records if record.segment != base)
+            if len(kept) == len(records):
+                continue
+            if kept:
+                self.index[recipient] = kept
+                self.cursors[recipient] = max(self.cursors.get(recipient, 0), kept[0].seq - 1)
+            else:
+                del self.index[recipient]
+                self.cursors[recipient] = self.next_seq.get(recipient, 1) - 1
+            self.cursors_dirty = True
+
+    def _delete_segment(self, base):
+        mapped = self.maps.pop(base, None)
+        if mapped is not None:
+            mapped.close()
+        del self.segments[base]
+        try:
+            os.remove(self._segment_path(base))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        self.sync(force=True)
+        with self.sync_lock:  # A job still running on another thread
+            pass
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps.clear()
+        self.active_file.close()
@@ -0,0 +1,270 @@
+# metrics.py - Low-overhead counters, histograms and a sampling profiler
+import bisect
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets: 1 µs to ~16 s in powers of two (upper bounds, in seconds)
+LATENCY_BUCKETS = tuple(1e-6 * 2 ** i for i in range(25))
+# Size buckets for counts such as fan-out or batch sizes
+SIZE_BUCKETS = tuple(2 ** i for i in range(17))
+
+class Counter:
+    """Monotonic counter"""
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class Histogram:
+    """Fixed-bucket histogram: observing is a bisect and two additions"""
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max', 'lock')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last bucket: above every bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def clear(self):
+        with self.lock:
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given quantile"""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'sum': self.total,
+                'max': self.max,
+                'p50': self.quantile(0.50),
+                'p90': self.quantile(0.90),
+                'p99': self.quantile(0.99),
+            }
+
+class MetricsRegistry:
+    """Named metrics of the process; lookups happen once, at instrumentation time"""
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}  # {name: function returning the current value}
+        self.lock = threading.Lock()
+
+    def counter(self, name):
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = Counter()
+            return self.counters[name]
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(bounds)
+            return self.histograms[name]
+
+    def gauge(self, name, function):
+        with self.lock:
+            self.gauges[name] = function
+
+    def snapshot(self):
+        """All metrics as plain data (JSON serializable)"""
+        gauges = {}
+        for name, function in list(self.gauges.items()):
+            try:
+                gauges[name] = function()
+            except Exception:
+                gauges[name] = None
+        return {
+            'timestamp': time.time(),
+            'counters': {name: counter.value for name, counter in sorted(self.counters.items())},
+            'gauges': gauges,
+            'histograms': {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())},
+        }
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, counter in sorted(self.counters.items()):
+            metric = _metric_name(name)
+            lines.append(f"# TYPE {metric}_total counter")
+            lines.append(f"{metric}_total {counter.value}")
+        for name, value in sorted(self.snapshot()['gauges'].items()):
+            if value is not None:
+                metric = _metric_name(name)
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        for name, histogram in sorted(self.histograms.items()):
+            metric = _metric_name(name)
+            with histogram.lock:
+                counts = list(histogram.counts)
+                count, total = histogram.count, histogram.total
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.bounds, counts):
+                cumulative += bucket_count
+                lines.append(f'{metric}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {count}')
+            lines.append(f"{metric}_sum {total}")
+            lines.append(f"{metric}_count {count}")
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            counters = list(self.counters.values())
+            histograms = list(self.histograms.values())
+        for counter in counters:
+            with counter.lock:
+                counter.value = 0
+        for histogram in histograms:
+            histogram.clear()
+
+def _metric_name(name):
+    return 'secure_chat_' + name.replace('.', '_').replace('-', '_')
+
+registry = MetricsRegistry()
+
+def timed(name):
+    """Decorator recording the duration of every call in a histogram"""
+    def decorator(function):
+        histogram = registry.histogram(name)
+        perf_counter = time.perf_counter
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - start)
+        return wrapper
+    return decorator
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = registry.prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(registry.snapshot()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a console line
+
+def start_http_server(port, host='localhost'):
+    """Serve /metrics (Prometheus) and /metrics.json from a background thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics-http').start()
+    return server
+
+class MetricsDumper:
+    """Appends a JSON snapshot of the metrics to a file every interval seconds"""
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name='metrics-dump')
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(registry.snapshot()) + '\n')
+        except OSError as e:
+            print(f"⚠️  Error guardando métricas: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.dump()
+
+class SamplingProfiler:
+    """Opt-in statistical profiler: samples every thread's stack periodically
+
+    Writes collapsed stacks ("frame;frame;frame count" per line), the input
+    format of flamegraph.pl and speedscope. Sampling from a separate thread
+    leaves the profiled code untouched, so the cost is bounded by the
+    interval rather than by the number of calls.
+    """
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name='sampling-profiler')
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            print(f"🔬 Perfil guardado en {self.path} ({sum(self.samples.values())} muestras)")
+        except OSError as e:
+            print(f"⚠️  Error guardando perfil: {e}")
@@ -0,0 +1,268 @@
+# protocol.py - Length-prefixed binary framing shared by server and client
+import struct
+from metrics import timed
+
+# Frame layout: 4-byte body length | 1-byte message type | body
+FRAME_HEADER = struct.Struct('!IB')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+MESSAGE_TYPES = {
+    'register': 1,
+    'registration_success': 2,
+    'key_exchange': 3,
+    'encrypted_message': 4,
+    'join_room': 5,
+    'leave_room': 6,
+    'room_members': 7,
+    'member_joined': 8,
+    'member_left': 9,
+    'key_request': 10,
+    'error': 11,
+    # Between relay nodes of a cluster (never sent to clients)
+    'node_hello': 12,
+    'presence': 13,
+    'room_update': 14,
+    'forward': 15,
+    # File transfer, relayed like encrypted messages
+    'file_offer': 16,
+    'file_chunk': 17,
+    'file_ack': 18,
+    # Public key directory
+    'key_lookup': 19,
+    'key_directory': 20,
+    'resume': 21,
+    'resumed': 22,
+    # Offline replay: end of a replayed batch, and the client's acknowledgement
+    'offline_batch': 23,
+    'offline_ack': 24,
+    # Proof of the identity key before a session ticket is accepted
+    'resume_challenge': 25,
+}
+MESSAGE_TYPE_NAMES = {code: name for name, code in MESSAGE_TYPES.items()}
+
+# Body values are tagged: one type byte followed by the value
+_LENGTH = struct.Struct('!I')
+_KEY_LENGTH = struct.Struct('!H')
+_INT = struct.Struct('!q')
+_FLOAT = struct.Struct('!d')
+
+TAG_NONE = 0x00
+TAG_TRUE = 0x01
+TAG_FALSE = 0x02
+TAG_INT = 0x03
+TAG_FLOAT = 0x04
+TAG_STR = 0x05
+TAG_BYTES = 0x06
+TAG_LIST = 0x07
+TAG_MAP = 0x08
+
+class ProtocolError(Exception):
+    """Raised when a peer sends a malformed frame"""
+
+def _encode_value(value, out):
+    if value is None:
+        out.append(TAG_NONE)
+    elif value is True:
+        out.append(TAG_TRUE)
+    elif value is False:
+        out.append(TAG_FALSE)
+    elif isinstance(value, int):
+        out.append(TAG_INT)
+        out += _INT.pack(value)
+    elif isinstance(value, float):
+        out.append(TAG_FLOAT)
+        out += _FLOAT.pack(value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out.append(TAG_STR)
+        out += _LENGTH.pack(len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out.append(TAG_BYTES)
+        out += _LENGTH.pack(len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(TAG_LIST)
+        out += _LENGTH.pack(len(value))
+        for item in value:
+            _encode_value(item, out)
+    elif isinstance(value, dict):
+        out.append(TAG_MAP)
+        _encode_map(value, out)
+    else:
+        raise TypeError(f"Cannot encode value of type {type(value).__name__}")
+
+def _encode_map(fields, out):
+    out += _LENGTH.pack(len(fields))
+    for key, value in fields.items():
+        key_bytes = key.encode('utf-8')
+        out += _KEY_LENGTH.pack(len(key_bytes))
+        out += key_bytes
+        _encode_value(value, out)
+
+def _decode_value(view, offset):
+    tag = view[offset]
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    if tag == TAG_TRUE:
+        return True, offset
+    if tag == TAG_FALSE:
+        return False, offset
+    if tag == TAG_INT:
+        return _INT.unpack_from(view, offset)[0], offset + _INT.size
+    if tag == TAG_FLOAT:
+        return _FLOAT.unpack_from(view, offset)[0], offset + _FLOAT.size
+    if tag == TAG_STR or tag == TAG_BYTES:
+        length = _LENGTH.unpack_from(view, offset)[0]
+        start = offset + _LENGTH.size
+        end = start + length
+        if end > len(view):
+            raise ProtocolError("Truncated value")
+        if tag == TAG_STR:
+            return str(view[start:end], 'utf-8'), end
+        return bytes(view[start:end]), end
+    if tag == TAG_LIST:
+        count = _LENGTH.unpack_from(view, offset)[0]
+        offset += _LENGTH.size
+        items = []
+        for _ in range(count):
+            item, offset = _decode_value(view, offset)
+            items.append(item)
+        return items, offset
+    if tag == TAG_MAP:
+        return _decode_map(view, offset)
+    raise ProtocolError(f"Unknown value tag: {tag}")
+
+def _decode_map(view, offset):
+    count = _LENGTH.unpack_from(view, offset)[0]
+    offset += _LENGTH.size
+    fields = {}
+    for _ in range(count):
+        key_length = _KEY_LENGTH.unpack_from(view, offset)[0]
+        offset += _KEY_LENGTH.size
+        key = str(view[offset:offset + key_length], 'utf-8')
+        offset += key_length
+        fields[key], offset = _decode_value(view, offset)
+    return fields, offset
+
+@timed('protocol.encode')
+def encode_message(message):
+    """Serialize a message dict (with a 'type' key) into one frame"""
+    fields = dict(message)
+    msg_type = MESSAGE_TYPES[fields.pop('type')]
+
+    out = bytearray(FRAME_HEADER.size)
+    _encode_map(fields, out)
+    body_length = len(out) - FRAME_HEADER.size
+    if body_length > MAX_FRAME_SIZE:
+        raise ProtocolError("Frame too large")
+    FRAME_HEADER.pack_into(out, 0, body_length, msg_type)
+    return bytes(out)
+
+@timed('protocol.decode')
+def decode_body(msg_type, body):
+    """Deserialize a frame body into a message dict"""
+    name = MESSAGE_TYPE_NAMES.get(msg_type)
+    if name is None:
+        raise ProtocolError(f"Unknown message type: {msg_type}")
+    try:
+        message, end = _decode_map(body, 0)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ProtocolError(f"Malformed frame: {e}")
+    if end != len(body):
+        raise ProtocolError("Trailing data in frame")
+    message['type'] = name
+    return message
+
+class FrameDecoder:
+    """Incremental frame decoder over a reusable receive buffer
+
+    Data is received straight into the buffer (socket.recv_into or
+    asyncio.BufferedProtocol), and only the tail of an incomplete frame is
+    moved back to the start once complete frames have been consumed.
+    """
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First unconsumed byte
+        self.end = 0  # End of received data
+        self.max_frame_size = max_frame_size
+
+    def get_buffer(self, sizehint=-1):
+        """Return writable space for the next read"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            self._compact()
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """Record that nbytes were written into the last buffer"""
+        self.end += nbytes
+
+    def feed(self, data):
+        """Copy data into the buffer (for transports without recv_into)"""
+        while data:
+            space = self.get_buffer()
+            chunk = min(len(space), len(data))
+            space[:chunk] = data[:chunk]
+            self.buffer_updated(chunk)
+            data = data[chunk:]
+            if data:
+                yield from self.messages()
+        yield from self.messages()
+
+    def recv_from(self, sock):
+        """Receive from a blocking socket; returns 0 on EOF"""
+        nbytes = sock.recv_into(self.get_buffer())
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def frames(self):
+        """Yield (msg_type, body) for every complete frame received so far
+
+        The body is a memoryview into the receive buffer and is only valid
+        until the next read.
+        """
+        while self.end - self.start >= FRAME_HEADER.size:
+            body_length, msg_type = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            if body_length > self.max_frame_size:
+                raise ProtocolError("Frame too large")
+
+            frame_end = self.start + FRAME_HEADER.size + body_length
+            if frame_end > self.end:
+                self._reserve(FRAME_HEADER.size + body_length)
+                return
+
+            body = self.view[self.start + FRAME_HEADER.size:frame_end]
+            self.start = frame_end
+            yield msg_type, body
+
+    def messages(self):
+        """Yield every complete message received so far as a dict"""
+        for msg_type, body in self.frames():
+            yield decode_body(msg_type, body)
+
+    def _compact(self):
+        pending = self.end - self.start
+        if self.start:
+            # memoryview assignment handles the overlapping copy
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def _reserve(self, frame_size):
+        # Make room for a frame larger than the free space left in the buffer
+        if frame_size <= len(self.buffer) - self.start:
+            return
+        if frame_size <= len(self.buffer):
+            self._compact()
+            return
+        # Grow into a new buffer: views handed out earlier keep the old one alive
+        pending = self.end - self.start
+        buffer = bytearray(max(frame_size, 2 * len(self.buffer)))
+        buffer[:pending] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start, self.end = 0, pending
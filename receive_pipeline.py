@@ -0,0 +1,149 @@
+# receive_pipeline.py - Parallel decryption with in-order delivery
+import asyncio
+import collections
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+_shared_executor = None
+
+def shared_executor():
+    """Crypto thread pool shared by every session of the process"""
+    global _shared_executor
+    if _shared_executor is None:
+        _shared_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                              thread_name_prefix='receive-crypto')
+    return _shared_executor
+
+class ReceivePipeline:
+    """Runs the crypto of incoming messages on a thread pool
+
+    The event loop only decodes frames and submits them. Decryption and
+    signature verification run on worker threads (cryptography releases the
+    GIL during RSA and AES operations), and a delivery task on the loop hands
+    results over strictly in arrival order. Everything received up to the
+    next control message is split into batches that are opened in parallel.
+
+    Control messages (key exchanges, room changes) act as barriers: they
+    are applied in order and before any later message is decrypted, since
+    those messages may depend on the keys they carry. A message whose
+    sender's key is not known yet is set aside by hold() and resubmitted,
+    ahead of anything received since, once the key arrives.
+    """
+    def __init__(self, open_message, deliver, handle_control, workers=None,
+                 batch_size=16, max_in_flight=256, on_error=print, hold=None):
+        self.open_message = open_message  # (message) -> result, runs on a worker
+        self.deliver = deliver  # (message, result), runs in order on the loop
+        self.handle_control = handle_control  # (message), runs in order on the loop
+        # (message) -> True if the message was set aside (its sender's key is
+        # not known yet); it comes back through resubmit() once it can be opened
+        self.hold = hold
+        self.on_error = on_error  # (text), for messages that could not be processed
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        # Without a worker count the sessions of the process share one pool
+        self.own_executor = workers is not None
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='receive-crypto') if workers else shared_executor()
+        self.pending = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.on_drained = None  # Called once the backlog is empty (resumes reading)
+        self.task = asyncio.get_running_loop().create_task(self._delivery_loop())
+
+    def submit(self, message):
+        return self.submit_batch([message])
+
+    def submit_batch(self, messages):
+        """Called on the loop with the messages decoded from one read
+
+        Returns False once max_in_flight messages are waiting: the caller
+        stops reading (pushing back on TCP) until on_drained is called.
+        """
+        self.pending.extend(messages)
+        self.wakeup.set()
+        return len(self.pending) < self.max_in_flight
+
+    def resubmit(self, messages):
+        """Put messages that were held back in front of the backlog, in their order"""
+        self.pending.extendleft(reversed(messages))
+        self.wakeup.set()
+
+    async def _delivery_loop(self):
+        while True:
+            if not self.pending:
+                if self.on_drained is not None:
+                    on_drained, self.on_drained = self.on_drained, None
+                    on_drained()
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            if self.pending[0].get('type') == 'encrypted_message':
+                run = []
+                while self.pending and self.pending[0].get('type') == 'encrypted_message':
+                    message = self.pending.popleft()
+                    if not self._held(message):
+                        run.append(message)
+                if run:
+                    await self._open_run(run)
+                continue
+
+            try:
+                self.handle_control(self.pending.popleft())
+            except Exception as e:
+                self.on_error(f"❌ Error procesando mensaje: {e}")
+
+    def _held(self, message):
+        if self.hold is None:
+            return False
+        try:
+            return self.hold(message)
+        except Exception as e:
+            self.on_error(f"❌ Error procesando mensaje: {e}")
+            return True
+
+    async def _open_run(self, run):
+        futures = []
+        key_jobs = {}  # {(sender, key_id): future of the batch that unwraps the key}
+        for start in range(0, len(run), self.batch_size):
+            batch = run[start:start + self.batch_size]
+            # Keys still being unwrapped by earlier batches must be ready first
+            waits = set()
+            wrapped = []
+            for message in batch:
+                key = (message.get('from'), message.get('key_id'))
+                if message.get('encrypted_key') or message.get('encrypted_keys'):
+                    wrapped.append(key)
+                elif key in key_jobs and key not in wrapped:
+                    waits.add(key_jobs[key])
+            future = self.executor.submit(self._open_batch, batch, waits)
+            for key in wrapped:
+                key_jobs[key] = future
+            futures.append((batch, future))
+
+        for batch, future in futures:
+            for message, (error, opened) in zip(batch, await asyncio.wrap_future(future)):
+                try:
+                    if error is not None:
+                        raise error
+                    self.deliver(message, opened)
+                except Exception as e:
+                    self.on_error(f"❌ Error procesando mensaje: {e}")
+
+    def _open_batch(self, batch, key_jobs):
+        for key_job in key_jobs:
+            # Submitted earlier, so it is already running or done: no deadlock
+            key_job.exception()
+
+        results = []
+        for message in batch:
+            try:
+                results.append((None, self.open_message(message)))
+            except Exception as e:
+                results.append((e, None))
+        return results
+
+    def close(self):
+        self.task.cancel()
+        self.pending.clear()
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
@@ -1,119 +1,981 @@
 # server.py - Secure relay server
-import socket
-import threading
-import json
+import asyncio
+import logging
+import os
 import time
+from collections import deque
+from protocol import FrameDecoder, encode_message, MAX_FRAME_SIZE
+from message_store import OfflineMessageStore
+from key_directory import KeyDirectory
+from cipher_suites import SUITES, SUITE_RSA, suite_for_pem
+from session_tickets import CHALLENGE_SIZE, SessionTickets, resume_proof_data
+from admission import AdmissionControl
+from metrics import registry, timed, SIZE_BUCKETS
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Envelope fields forwarded untouched; the server never interprets them
+RELAYED_FIELDS = ('version', 'key_id', 'nonce', 'encrypted_key', 'encrypted_keys',
+                  'encrypted_content', 'signature', 'room', 'to',
+                  'file_id', 'index', 'final', 'chunk_size', 'chunks', 'encrypted_metadata',
+                  'next', 'resume')
+
+# File transfer messages: relayed to one user, never stored for offline users
+# (the sender resumes the transfer instead)
+FILE_MESSAGE_TYPES = ('file_offer', 'file_chunk', 'file_ack')
+
+# What to do with a client whose write queue is full
+SLOW_CONSUMER_DROP = 'drop'    # Disconnect the slow client
+SLOW_CONSUMER_PAUSE = 'pause'  # Stop reading from senders until it drains
+# With the pause policy the queue may grow up to this many times
+# max_queued_bytes while senders stop; beyond it the client is dropped
+HARD_QUEUE_FACTOR = 2
+
+# Most usernames or fingerprints answered by one key_lookup
+MAX_KEY_LOOKUP = 1024
+
+MAX_USERNAME_LENGTH = 64
+
+# Per-message lines are DEBUG: with the default INFO level they cost one check
+logger = logging.getLogger('secure_chat.server')
+
+# Hot-path metrics, looked up once
+RECV_BYTES = registry.counter('server.recv_bytes')
+RECV_READS = registry.counter('server.recv_reads')
+RECV_HANDLE = registry.histogram('server.recv_handle')  # Parse and dispatch of one read
+MESSAGES_RECEIVED = registry.counter('server.messages_received')
+MESSAGES_RELAYED = registry.counter('server.messages_relayed')
+DELIVERIES = registry.counter('server.deliveries')
+MESSAGES_STORED = registry.counter('server.messages_stored')
+RELAY_FANOUT = registry.histogram('server.relay_fanout', SIZE_BUCKETS)
+SEND_BYTES = registry.counter('server.send_bytes')
+SLOW_CONSUMER_DROPS = registry.counter('server.slow_consumer_drops')
+SLOW_CONSUMER_PAUSES = registry.counter('server.slow_consumer_pauses')
+FORWARDED = registry.counter('server.cluster_forwarded')
+WRITES = registry.counter('server.writes')
+WRITE_BATCH = registry.histogram('server.write_batch_frames', SIZE_BUCKETS)
+KEY_LOOKUPS = registry.counter('server.key_lookups')
+KEY_LOOKUP_SIZE = registry.histogram('server.key_lookup_size', SIZE_BUCKETS)
+RESUMPTIONS = registry.counter('server.resumptions')
+RESUME_FAILURES = registry.counter('server.resume_failures')
+# Admission control
+REJECTED_CONNECTIONS = registry.counter('server.rejected_connections')
+REJECTED_REGISTRATIONS = registry.counter('server.rejected_registrations')
+REGISTRATION_TIMEOUTS = registry.counter('server.registration_timeouts')
+PROTOCOL_ERRORS = registry.counter('server.protocol_errors')  # Oversized or malformed frames
+THROTTLED = registry.counter('server.throttled')  # Reads paused by a rate limit
+THROTTLE_DELAY = registry.histogram('server.throttle_delay')
+
+class ClientConnection(asyncio.BufferedProtocol):
+    """A client connection with its own bounded write queue"""
+    def __init__(self, server):
+        self.server = server
+        # Frames are read straight into its buffer, which never grows past one frame
+        self.decoder = FrameDecoder(max_frame_size=server.admission.max_frame_size or MAX_FRAME_SIZE)
+        self.transport = None
+        self.address = None
+        self.ip = None
+        self.admitted = False  # Counted by the server's admission control
+        self.buckets = ()  # Token buckets charged for every frame (IP, then user)
+        self.registration_handle = None  # Closes the connection if it never registers
+        self.throttle_handle = None  # Resumes reading once the buckets refill
+        self.username = None
+        self.rooms = set()  # Rooms this client has joined
+        self.write_queue = deque()
+        self.queued_bytes = 0
+        self.can_write = True
+        self.closed = False
+        self.paused_sources = set()  # Senders paused until this queue drains
+        self.pause_count = 0  # Number of recipients this connection is paused on
+        self.drained = asyncio.Event()  # Set while nothing is waiting to be written
+        self.replaying = False  # Offline messages are still being delivered
+        # The client acknowledges replayed batches once it has opened them
+        # (offline_ack); without it a batch is deleted as soon as it is sent
+        self.offline_acks = False
+        self.replay_sent = 0  # Last seq replayed, waiting for its acknowledgement
+        self.replay_acked = asyncio.Event()
+        self.resume_challenge = None  # Nonce a resuming client must sign
+        self.flush_handle = None  # Scheduled coalesced flush
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        transport.set_write_buffer_limits(high=self.server.write_buffer_limit)
+        self.drained.set()
+        admission = self.server.admission
+        self.ip = self.address[0] if isinstance(self.address, tuple) else self.address
+        if not admission.admit(self.ip, time.monotonic()):
+            REJECTED_CONNECTIONS.inc()
+            logger.warning("⛔ Conexión rechazada (límite de conexiones): %s", self.address)
+            transport.write(encode_message({'type': 'error', 'message': "Servidor lleno, intenta más tarde"}))
+            transport.close()
+            return
+        self.admitted = True
+        bucket = admission.ip_bucket(self.ip)
+        if bucket is not None:
+            self.buckets = (bucket,)
+        if admission.registration_timeout:
+            self.registration_handle = asyncio.get_running_loop().call_later(
+                admission.registration_timeout, self.registration_expired)
+        logger.debug("🔌 Nueva conexión desde %s", self.address)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        start = time.perf_counter()
+        RECV_BYTES.inc(nbytes)
+        RECV_READS.inc()
+        self.decoder.buffer_updated(nbytes)
+        self.handle_frames()
+        RECV_HANDLE.observe(time.perf_counter() - start)
+
+    def handle_frames(self):
+        """Handle the frames received so far, until the client runs out of tokens
+
+        Frames left in the decoder once a rate limit is hit are handled when
+        the throttle ends; meanwhile the transport is not read at all.
+        """
+        now = time.monotonic()
+        try:
+            for message_data in self.decoder.messages():
+                MESSAGES_RECEIVED.inc()
+                if self.username is None:
+                    self.server.register_client(self, message_data)
+                else:
+                    self.server.handle_message(self, message_data)
+                if self.closed or self.charge(now):
+                    break
+        except Exception as e:
+            PROTOCOL_ERRORS.inc()
+            logger.error("❌ Error con cliente %s: %s", self.address, e)
+            self.transport.close()
+
+    def charge(self, now):
+        """Charge one frame to the client's buckets; True if it is now throttled"""
+        delay = 0.0
+        for bucket in self.buckets:
+            if not bucket.take(now) and bucket.delay() > delay:
+                delay = bucket.delay()
+        if not delay:
+            return False
+        THROTTLED.inc()
+        THROTTLE_DELAY.observe(delay)
+        logger.debug("🐢 %s limitado %.3fs", self.username or self.address, delay)
+        self.pause()
+        self.throttle_handle = asyncio.get_running_loop().call_later(delay, self.end_throttle)
+        return True
+
+    def end_throttle(self):
+        self.throttle_handle = None
+        self.resume()
+        if not self.closed:
+            self.handle_frames()
+
+    def registration_expired(self):
+        self.registration_handle = None
+        if self.username is None and not self.closed:
+            REGISTRATION_TIMEOUTS.inc()
+            logger.warning("⌛ Conexión sin registro cerrada: %s", self.address)
+            self.transport.close()
+
+    def registered(self, user_bucket):
+        """Called once the connection belongs to a user"""
+        if self.registration_handle is not None:
+            self.registration_handle.cancel()
+            self.registration_handle = None
+        if user_bucket is not None:
+            self.buckets = self.buckets + (user_bucket,)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        for handle in (self.registration_handle, self.throttle_handle):
+            if handle is not None:
+                handle.cancel()
+        self.registration_handle = self.throttle_handle = None
+        if self.admitted:
+            self.admitted = False
+            self.server.admission.release(self.ip)
+        self.write_queue.clear()
+        self.queued_bytes = 0
+        self.drained.set()
+        self.replay_acked.set()
+        self.release_sources()
+        self.server.unregister_client(self)
+
+    def pause_writing(self):
+        # Called by the transport when its buffer is above the high-water mark
+        self.can_write = False
+        self.drained.clear()
+
+    def resume_writing(self):
+        self.can_write = True
+        self.flush()
+
+    @timed('server.send')
+    def send(self, data, source=None):
+        """Queue data for this client, applying the slow consumer policy"""
+        if self.closed:
+            return False
+
+        limit = self.server.max_queued_bytes
+        if self.write_queue and self.queued_bytes + len(data) > limit:
+            # Frames without a sender to pause (cluster forwards, notices) and
+            # frames a paused sender had already read still count: past the
+            # hard limit the client is dropped whatever the policy
+            pausable = (self.server.slow_consumer_policy == SLOW_CONSUMER_PAUSE and
+                        source is not None and source is not self and not source.closed)
+            if not pausable or self.queued_bytes + len(data) > limit * HARD_QUEUE_FACTOR:
+                logger.warning("⚠️  Cliente lento desconectado: %s", self.username)
+                SLOW_CONSUMER_DROPS.inc()
+                self.transport.abort()
+                return False
+            if source not in self.paused_sources:
+                self.paused_sources.add(source)
+                source.pause()
+                SLOW_CONSUMER_PAUSES.inc()
+
+        SEND_BYTES.inc(len(data))
+        self.write_queue.append(data)
+        self.queued_bytes += len(data)
+        self.drained.clear()
+        if self.queued_bytes >= self.server.flush_threshold:
+            self.flush()
+        elif self.flush_handle is None:
+            # Frames queued until then (e.g. the rest of a burst) share one write
+            loop = asyncio.get_running_loop()
+            if self.server.flush_interval:
+                self.flush_handle = loop.call_later(self.server.flush_interval, self.flush)
+            else:
+                self.flush_handle = loop.call_soon(self.flush)
+        return True
+
+    def flush(self):
+        """Hand queued frames to the transport as vectored writes while it accepts more"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.transport.is_closing():
+            self.write_queue.clear()
+            self.queued_bytes = 0
+            return
+        while self.can_write and self.write_queue:
+            batch = []
+            batch_bytes = 0
+            while self.write_queue and batch_bytes < self.server.write_buffer_limit:
+                data = self.write_queue.popleft()
+                batch.append(data)
+                batch_bytes += len(data)
+            self.queued_bytes -= batch_bytes
+            # One syscall for the whole batch (sendmsg where the event loop supports it)
+            self.transport.writelines(batch)
+            WRITES.inc()
+            WRITE_BATCH.observe(len(batch))
+
+        if self.can_write and not self.write_queue:
+            self.drained.set()
+        else:
+            self.drained.clear()
+
+        if self.paused_sources and self.queued_bytes <= self.server.max_queued_bytes // 2:
+            self.release_sources()
+
+    def release_sources(self):
+        for source in self.paused_sources:
+            source.resume()
+        self.paused_sources.clear()
+
+    def pause(self):
+        self.pause_count += 1
+        if self.pause_count == 1 and not self.closed:
+            self.transport.pause_reading()
+
+    def resume(self):
+        self.pause_count -= 1
+        if self.pause_count == 0 and not self.closed:
+            self.transport.resume_reading()
 
 class SecureChatServer:
-    def __init__(self, host='localhost', port=8888):
+    def __init__(self, host='localhost', port=8888, max_queued_bytes=1 << 20,
+                 slow_consumer_policy=SLOW_CONSUMER_DROP, backlog=1024, store_dir=None,
+                 cluster=None, reuse_port=False, flush_interval=0.0, flush_threshold=64 * 1024,
+                 directory_file=None, suites=None, ticket_key=None, resume_grace=30.0,
+                 limits=None):
         self.host = host
         self.port = port
-        self.clients = {}  # {username: socket}
-        self.public_keys = {}  # {username: public_key_pem}
-        
+        self.clients = {}  # {username: ClientConnection} connected to this node
+        self.public_keys = {}  # {username: public_key_pem} of every online user
+        self.rooms = {}  # {room: set of usernames} routing index
+        # Cluster mode: a bus to the other nodes (cluster.LocalBus or SocketBus).
+        # The presence directory (public_keys, rooms, locations) is replicated
+        # on every node through it, and frames for users on other nodes are
+        # forwarded still encrypted.
+        self.cluster = cluster
+        self.locations = {}  # {username: node_id} for users connected to other nodes
+        self.reuse_port = reuse_port  # Several processes accepting on one port (SO_REUSEPORT)
+        self.max_queued_bytes = max_queued_bytes  # Per-connection write queue bound
+        self.write_buffer_limit = 64 * 1024  # Transport buffer before pausing writes
+        # Write coalescing: frames queued for a client are flushed together at the
+        # end of the current loop iteration, or after flush_interval seconds
+        # (Nagle-style: a little latency for fewer, larger writes during bursts),
+        # or as soon as flush_threshold bytes are waiting
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.slow_consumer_policy = slow_consumer_policy
+        self.backlog = backlog
+        # Encrypted frames for offline users; disabled without a directory
+        self.store = OfflineMessageStore(store_dir) if store_dir else None
+        self.store_sync_wanted = asyncio.Event()  # Appends the fsync policy wants on disk now
+        # Versioned keys of every user that registered, online or not
+        # (in memory only without a file)
+        self.directory = KeyDirectory(directory_file or ':memory:')
+        # Cipher suites accepted for identity keys, in order of preference
+        self.suites = list(suites) if suites else list(SUITES)
+        # Session resumption: a ticket restores a registration in one round trip,
+        # and the rooms of a dropped client are kept for resume_grace seconds
+        # (messages meanwhile go to the offline store and are replayed on resume)
+        self.tickets = SessionTickets(ticket_key)
+        self.resume_grace = resume_grace
+        self.lingering = {}  # {username: (TimerHandle, dropped ClientConnection)}
+        # Connection caps, registration timeout, frame size and per-user / per-IP
+        # rate limits (admission.DEFAULT_LIMITS, overridden by limits)
+        self.admission = AdmissionControl(limits)
+
+        registry.gauge('server.connections', lambda: len(self.clients))
+        registry.gauge('server.rooms', lambda: len(self.rooms))
+        registry.gauge('server.queued_bytes',
+                       lambda: sum(connection.queued_bytes for connection in list(self.clients.values())))
+        registry.gauge('server.open_connections', lambda: self.admission.connections)
+        for name, value in self.admission.limits.items():
+            registry.gauge(f'server.limits.{name}', lambda value=value: value)
+
     def start(self):
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind((self.host, self.port))
-        server.listen(2)  # Only 2 clients for Alice and Bob
-        
-        print(f"🔒 Servidor seguro iniciado en {self.host}:{self.port}")
-        print("💡 El servidor NO puede leer mensajes - solo actúa como relay")
-        
-        while len(self.clients) < 2:
-            client_socket, address = server.accept()
-            print(f"🔌 Nueva conexión desde {address}")
-            
-            client_thread = threading.Thread(
-                target=self.handle_client, 
-                args=(client_socket, address)
-            )
-            client_thread.start()
-    
-    def handle_client(self, client_socket, address):
+        raise_file_limit()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: ClientConnection(self),
+            self.host, self.port,
+            reuse_address=True,
+            reuse_port=self.reuse_port,
+            backlog=self.backlog
+        )
+        if self.cluster:
+            await self.cluster.start(self)
+
+        logger.info("🔒 Servidor seguro iniciado en %s:%s", self.host, self.port)
+        logger.info("💡 El servidor NO puede leer mensajes - solo actúa como relay")
+
+        if self.store:
+            maintenance = asyncio.create_task(self.maintain_store())
+
         try:
-            # Receive registration information
-            data = client_socket.recv(4096).decode('utf-8')
-            register_data = json.loads(data)
-            
-            username = register_data['username']
-            public_key_pem = register_data['public_key']
-            
-            # Store client and public key
-            self.clients[username] = client_socket
-            self.public_keys[username] = public_key_pem
-            
-            print(f"✅ Usuario registrado: {username}")
-            
-            # Send registration confirmation
-            response = {
-                'type': 'registration_success',
-                'message': f'Bienvenido {username}!'
-            }
-            client_socket.send(json.dumps(response).encode('utf-8'))
-            
-            # If 2 users, start key exchange
-            if len(self.clients) == 2:
-                self.initiate_key_exchange()
-            
-            # Listen for messages
-            while True:
-                data = client_socket.recv(4096).decode('utf-8')
-                if not data:
-                    break
-                    
-                message_data = json.loads(data)
-                self.relay_message(username, message_data)
-                
-        except Exception as e:
-            print(f"❌ Error con cliente {address}: {e}")
+            async with server:
+                await server.serve_forever()
         finally:
-            client_socket.close()
-            # Remove disconnected client
-            for user, sock in list(self.clients.items()):
-                if sock == client_socket:
-                    del self.clients[user]
-                    if user in self.public_keys:
-                        del self.public_keys[user]
-                    print(f"🔌 Cliente {user} desconectado")
+            if self.cluster:
+                await self.cluster.close()
+            if self.store:
+                maintenance.cancel()
+                self.store.close()
+            self.directory.close()
+
+    async def maintain_store(self):
+        """Sync the offline store and compact it periodically, never blocking the loop
+
+        The fsyncs run in the executor; compaction runs in bounded steps
+        with the other connections served in between.
+        """
+        last_compaction = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self.store_sync_wanted.wait(), self.store.fsync_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.store_sync_wanted.clear()
+            try:
+                await self.run_store_job(self.store.sync_job())
+                if time.monotonic() - last_compaction >= 60:
+                    for job in self.store.compact_steps():
+                        await self.run_store_job(job)
+                    last_compaction = time.monotonic()
+            except OSError as e:
+                logger.error("❌ Error escribiendo el almacén de mensajes: %s", e)
+
+    async def run_store_job(self, job):
+        if job is None:
+            await asyncio.sleep(0)  # Let the connections run between two steps
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, job)
+
+    def store_message(self, username, frame):
+        """Keep a frame for a user who is not connected; its fsync runs in maintain_store"""
+        self.store.append(username, frame)
+        MESSAGES_STORED.inc()
+        if self.store.needs_sync():
+            self.store_sync_wanted.set()
+
+    def register_client(self, connection, register_data):
+        if register_data.get('type') == 'resume':
+            self.resume_client(connection, register_data)
+            return
+        if register_data.get('type') != 'register':
+            raise ValueError("Se esperaba un mensaje de registro")
+        username = register_data.get('username')
+        if not isinstance(username, str) or not username.strip() or len(username) > MAX_USERNAME_LENGTH:
+            raise ValueError("Nombre de usuario inválido")
+        public_key_pem = register_data['public_key']
+        suite = register_data.get('suite', SUITE_RSA)  # Clients from before suites existed
+        if suite not in self.suites or suite_for_pem(public_key_pem).name != suite:
+            # Not registered: the client may register again with another suite
+            connection.send(encode_message({
+                'type': 'error',
+                'message': f"Suite de cifrado no soportada: {suite}",
+                'suites': self.suites
+            }))
+            return
+
+        # A full registration starts over: memberships kept from an earlier session are dropped
+        previous = self.clients.get(username)
+        if previous is not None and previous is not connection and self.public_keys.get(username) != public_key_pem:
+            # Only the same identity key may take over a connected username
+            REJECTED_REGISTRATIONS.inc()
+            logger.warning("⛔ Registro rechazado: %s ya está conectado con otra llave", username)
+            self.send_error(connection, f"El usuario {username} ya está conectado")
+            connection.flush()
+            connection.transport.close()
+            return
+        if previous is not None and previous is not connection:
+            self.unregister_client(previous)
+            previous.transport.close()
+        if username in self.lingering:
+            self.end_session(username)
+
+        entry = self.add_client(connection, username, public_key_pem)
+        connection.offline_acks = bool(register_data.get('offline_acks'))
+        logger.info("✅ Usuario registrado: %s (%s)", username, suite)
+
+        # Send registration confirmation
+        response = {
+            'type': 'registration_success',
+            'message': f'Bienvenido {username}!',
+            'suite': suite,
+            'suites': self.suites,
+            'ticket': self.tickets.issue(username, entry.fingerprint, suite)
+        }
+        connection.send(encode_message(response))
+
+        # If 2 users, start key exchange
+        if len(self.clients) == 2:
+            self.initiate_key_exchange()
+
+        self.start_replay(connection)
+
+    def add_client(self, connection, username, public_key_pem):
+        """Make connection the one of username; returns its directory entry"""
+        if username in self.locations:
+            # Moved here from another node: forget its memberships there
+            self.remove_remote_user(username)
+        connection.username = username
+        connection.registered(self.admission.user_bucket(username, time.monotonic()))
+        self.clients[username] = connection
+        self.public_keys[username] = public_key_pem
+        entry = self.directory.publish(username, public_key_pem)
+        if self.cluster:
+            self.cluster.publish({'type': 'presence', 'username': username,
+                                  'public_key': public_key_pem, 'online': True})
+        return entry
+
+    def resume_client(self, connection, resume_data):
+        """Restore a registration from a session ticket, with its rooms and pending messages
+
+        A valid ticket is first answered with a resume_challenge: the
+        client resumes by sending the ticket again with a signature of the
+        challenge by the identity key the ticket names, so a stolen ticket
+        is useless. Then comes 'resumed', one room_members per room (members
+        that joined while the client was away included) and the stored
+        messages. An unusable ticket or a bad signature gets an error with
+        resume_failed, and the client registers from scratch.
+        """
+        ticket = resume_data.get('ticket')
+        fields = self.tickets.open(ticket)
+        entry = None
+        if fields is not None and fields['suite'] in self.suites:
+            entry = self.directory.lookup_fingerprint(fields['fingerprint'])
+        if entry is not None and entry.username == fields['username']:
+            challenge, connection.resume_challenge = connection.resume_challenge, None
+            signature = resume_data.get('signature')
+            if challenge is None or signature is None:
+                connection.resume_challenge = os.urandom(CHALLENGE_SIZE)
+                connection.send(encode_message({'type': 'resume_challenge',
+                                                'nonce': connection.resume_challenge}))
+                return
+            if not self.verify_resume(entry, challenge, ticket, signature):
+                logger.warning("⛔ Reanudación rechazada: %s no firmó con su llave", entry.username)
+                entry = None
+        else:
+            entry = None
+        if entry is None:
+            RESUME_FAILURES.inc()
+            connection.send(encode_message({
+                'type': 'error',
+                'message': "Sesión no reanudable, registrando de nuevo",
+                'resume_failed': True
+            }))
+            return
+
+        username = entry.username
+        previous = self.clients.get(username)
+        if previous is not None and previous is not connection:
+            # Reconnected before the old connection was noticed dead: take over its rooms
+            del self.clients[username]
+            connection.rooms, previous.rooms = previous.rooms, set()
+            previous.transport.close()
+        elif username in self.lingering:
+            handle, dropped = self.lingering.pop(username)
+            handle.cancel()
+            connection.rooms, dropped.rooms = dropped.rooms, set()
+
+        self.add_client(connection, username, entry.public_key)
+        connection.offline_acks = bool(resume_data.get('offline_acks'))
+        RESUMPTIONS.inc()
+        logger.info("🔄 Sesión reanudada: %s", username)
+        connection.send(encode_message({
+            'type': 'resumed',
+            'message': f'Bienvenido de nuevo {username}!',
+            'suite': fields['suite'],
+            'suites': self.suites,
+            'ticket': self.tickets.issue(username, entry.fingerprint, fields['suite'])
+        }))
+
+        rooms = resume_data.get('rooms') or []
+        if not isinstance(rooms, list):
+            rooms = []
+        for room in list(connection.rooms):
+            if room not in rooms:
+                self.leave_room(connection, room)
+        for room in rooms:
+            if room in connection.rooms:
+                self.send_room_members(connection, room)
+            else:
+                self.join_room(connection, room)
+
+        self.start_replay(connection)
+
+    def verify_resume(self, entry, challenge, ticket, signature):
+        """True if signature is the challenge signed by the directory key of the ticket's user"""
+        if not isinstance(signature, bytes):
+            return False
+        public_key_pem = entry.public_key.encode('utf-8')
+        suite = suite_for_pem(public_key_pem)
+        try:
+            suite.verify(suite.load_public_key(public_key_pem), signature, resume_proof_data(challenge, ticket))
+            return True
+        except Exception:
+            return False
+
+    def start_replay(self, connection):
+        username = connection.username
+        if self.store:
+            self.store.register(username)
+            if self.store.has_pending(username):
+                connection.replaying = True
+                asyncio.get_running_loop().create_task(self.replay_offline(connection))
+
+    async def replay_offline(self, connection):
+        """Stream stored messages to a client that just came back online
+
+        Messages relayed to the client during the replay are appended to the
+        store too, so everything is delivered in order. Clients that
+        acknowledge get an offline_batch after every batch, and the batch is
+        only deleted (and the next one sent) once they answer offline_ack:
+        nothing is lost if they disconnect before opening it.
+        """
+        username = connection.username
+        delivered = 0
+        try:
+            while not connection.closed:
+                last_seq, frames = self.store.read_pending(username)
+                if not frames:
+                    connection.replaying = False
                     break
-    
+                # One bulk write per batch, paced by the client's reads
+                connection.send(b''.join(frames))
+                delivered += len(frames)
+                if connection.offline_acks:
+                    connection.replay_sent = last_seq
+                    connection.replay_acked.clear()
+                    connection.send(encode_message({'type': 'offline_batch', 'seq': last_seq}))
+                    await connection.replay_acked.wait()
+                else:
+                    self.store.ack(username, last_seq)
+                    await connection.drained.wait()
+        except Exception as e:
+            logger.error("❌ Error entregando mensajes pendientes a %s: %s", username, e)
+            connection.transport.close()
+        if delivered:
+            logger.info("📬 %d mensajes pendientes entregados a %s", delivered, username)
+
+    def ack_offline(self, connection, seq):
+        """The client opened the replayed messages up to seq: delete them"""
+        if not connection.replaying or not isinstance(seq, int) or not connection.replay_sent:
+            return
+        seq = min(seq, connection.replay_sent)  # Never past what it was sent
+        self.store.ack(connection.username, seq)
+        if seq == connection.replay_sent:
+            connection.replay_sent = 0
+            connection.replay_acked.set()
+
+    def unregister_client(self, connection):
+        # Remove disconnected client
+        user = connection.username
+        if user is not None and self.clients.get(user) is connection:
+            del self.clients[user]
+            if connection.rooms and self.resume_grace > 0:
+                # Still a member (and online to the cluster) until the grace period ends
+                handle = asyncio.get_running_loop().call_later(self.resume_grace, self.end_session, user)
+                self.lingering[user] = (handle, connection)
+                logger.info("🔌 Cliente %s desconectado (sesión reservada %gs)", user, self.resume_grace)
+                return
+            self.end_session(user, connection)
+            logger.info("🔌 Cliente %s desconectado", user)
+
+    def end_session(self, username, connection=None):
+        """Leave the rooms of a user that is gone and announce it offline"""
+        lingering = self.lingering.pop(username, None)
+        if lingering is not None:
+            handle, connection = lingering
+            handle.cancel()
+            logger.info("⌛ Sesión de %s expirada", username)
+        for room in list(connection.rooms if connection is not None else ()):
+            self.leave_room(connection, room)
+        self.public_keys.pop(username, None)
+        self.admission.forget_user(username)
+        self.directory.set_online(username, False)
+        if self.cluster:
+            self.cluster.publish({'type': 'presence', 'username': username, 'online': False})
+
     def initiate_key_exchange(self):
         """Facilitate public key exchange between Alice and Bob"""
         usernames = list(self.clients.keys())
         user1, user2 = usernames[0], usernames[1]
-        
+
         # Send user2's public key to user1
         key_exchange_msg1 = {
             'type': 'key_exchange',
             'from': user2,
             'public_key': self.public_keys[user2]
         }
-        self.clients[user1].send(json.dumps(key_exchange_msg1).encode('utf-8'))
-        
+        self.clients[user1].send(encode_message(key_exchange_msg1))
+
         # Send user1's public key to user2
         key_exchange_msg2 = {
             'type': 'key_exchange',
             'from': user1,
             'public_key': self.public_keys[user1]
         }
-        self.clients[user2].send(json.dumps(key_exchange_msg2).encode('utf-8'))
-        
-        print("🔑 Intercambio de llaves públicas completado")
-    
+        self.clients[user2].send(encode_message(key_exchange_msg2))
+
+        logger.info("🔑 Intercambio de llaves públicas completado")
+
+    def handle_message(self, connection, message_data):
+        """Dispatch a message from a registered client"""
+        msg_type = message_data.get('type')
+        if msg_type == 'encrypted_message':
+            self.relay_message(connection.username, message_data)
+        elif msg_type == 'join_room':
+            self.join_room(connection, message_data['room'])
+        elif msg_type == 'leave_room':
+            self.leave_room(connection, message_data['room'])
+        elif msg_type == 'key_request':
+            self.send_public_key(connection, message_data['username'])
+        elif msg_type == 'key_lookup':
+            self.lookup_keys(connection, message_data)
+        elif msg_type == 'offline_ack':
+            self.ack_offline(connection, message_data.get('seq'))
+        elif msg_type in FILE_MESSAGE_TYPES:
+            if message_data.get('to') is None:
+                self.send_error(connection, "Las transferencias de archivos requieren un destinatario")
+            else:
+                self.relay_message(connection.username, message_data)
+        else:
+            self.send_error(connection, f"Tipo de mensaje no soportado: {msg_type}")
+
+    def send_error(self, connection, text):
+        connection.send(encode_message({'type': 'error', 'message': text}))
+
+    def join_room(self, connection, room):
+        """Add a client to a room and exchange keys with its members"""
+        if not isinstance(room, str) or not room:
+            self.send_error(connection, "Nombre de sala inválido")
+            return
+
+        username = connection.username
+        members = self.rooms.setdefault(room, set())
+        if username in members:
+            return
+
+        # The new member gets every member's key, members get the new key once
+        self.send_room_members(connection, room)
+        self.add_member(room, username)
+        connection.rooms.add(room)
+        if self.cluster:
+            self.cluster.publish({'type': 'room_update', 'room': room, 'username': username, 'joined': True})
+        logger.info("🚪 %s se unió a la sala %s (%d miembros)", username, room, len(members))
+
+    def send_room_members(self, connection, room):
+        members = self.rooms.get(room, ())
+        connection.send(encode_message({
+            'type': 'room_members',
+            'room': room,
+            'members': {member: self.public_keys[member] for member in members
+                        if member != connection.username}
+        }))
+
+    def leave_room(self, connection, room):
+        username = connection.username
+        if not self.remove_member(room, username):
+            return
+        connection.rooms.discard(room)
+        if self.cluster:
+            self.cluster.publish({'type': 'room_update', 'room': room, 'username': username, 'joined': False})
+        logger.info("🚪 %s salió de la sala %s", username, room)
+
+    def add_member(self, room, username):
+        """Update the routing index and notify the members connected to this node
+
+        Every node notifies its own clients, also for joins on other nodes,
+        so each member hears about each change exactly once.
+        """
+        members = self.rooms.setdefault(room, set())
+        self.broadcast([member for member in members if member in self.clients], {
+            'type': 'member_joined',
+            'room': room,
+            'username': username,
+            'public_key': self.public_keys[username]
+        })
+        members.add(username)
+
+    def remove_member(self, room, username):
+        members = self.rooms.get(room)
+        if not members or username not in members:
+            return False
+        members.discard(username)
+        if members:
+            self.broadcast([member for member in members if member in self.clients],
+                           {'type': 'member_left', 'room': room, 'username': username})
+        else:
+            del self.rooms[room]
+        return True
+
+    def send_public_key(self, connection, username):
+        """Answer a key request for a direct message (also for offline users)"""
+        entry = self.directory.lookup(username)
+        if entry is None:
+            self.send_error(connection, f"Usuario desconocido: {username}")
+            return
+        connection.send(encode_message({
+            'type': 'key_exchange',
+            'from': username,
+            'public_key': entry.public_key,
+            'requested': True
+        }))
+
+    def lookup_keys(self, connection, message_data):
+        """Answer a bulk directory lookup with one frame
+
+        Keys the client already has (same version in 'known') are confirmed
+        without resending the PEM.
+        """
+        usernames = message_data.get('usernames') or []
+        fingerprints = message_data.get('fingerprints') or []
+        known = message_data.get('known') or {}
+        if (not isinstance(usernames, list) or not isinstance(fingerprints, list)
+                or not isinstance(known, dict) or len(usernames) + len(fingerprints) > MAX_KEY_LOOKUP
+                or not all(isinstance(name, str) for name in usernames + fingerprints)):
+            self.send_error(connection, f"Consulta de llaves inválida (máximo {MAX_KEY_LOOKUP})")
+            return
+
+        keys = []
+        missing = []
+        for username in usernames:
+            entry = self.directory.lookup(username)
+            if entry is None:
+                missing.append(username)
+            else:
+                keys.append(entry.to_message(with_key=known.get(username) != entry.version))
+        for fingerprint in fingerprints:
+            entry = self.directory.lookup_fingerprint(fingerprint)
+            if entry is None:
+                missing.append(fingerprint)
+            else:
+                keys.append(entry.to_message())
+        connection.send(encode_message({'type': 'key_directory', 'keys': keys, 'missing': missing}))
+        KEY_LOOKUPS.inc()
+        KEY_LOOKUP_SIZE.observe(len(usernames) + len(fingerprints))
+
+    def broadcast(self, recipients, message, source=None):
+        """Serialize a message once and send the same frame to every recipient"""
+        frame = encode_message(message)
+        delivered = []
+        remote = {}  # {node_id: [usernames]} for users connected to other nodes
+        for username in recipients:
+            connection = self.clients.get(username)
+            if connection is None and username in self.locations:
+                remote.setdefault(self.locations[username], []).append(username)
+                continue
+            if connection is None or connection.replaying:
+                # Offline (or catching up): keep the still-encrypted frame
+                if self.store and message['type'] == 'encrypted_message' and self.store.knows(username):
+                    self.store_message(username, frame)
+                    logger.debug("📥 Mensaje guardado para %s (ENCRIPTADO)", username)
+                continue
+            try:
+                if connection.send(frame, source):
+                    delivered.append(username)
+            except Exception as e:
+                logger.error("❌ Error enviando mensaje a %s: %s", username, e)
+
+        # One copy of the (still encrypted) frame per node, whatever the fan-out there
+        for node_id, usernames in remote.items():
+            self.cluster.send(node_id, {'type': 'forward', 'recipients': usernames, 'frame': frame})
+            FORWARDED.inc()
+            delivered.extend(usernames)
+        return delivered
+
+    def route(self, sender, message_data):
+        """Return the recipients of a message in O(recipients)"""
+        room = message_data.get('room')
+        if room is not None:
+            members = self.rooms.get(room)
+            if not members or sender not in members:
+                raise ValueError(f"{sender} no pertenece a la sala {room}")
+            return [member for member in members if member != sender]
+
+        recipient = message_data.get('to')
+        if recipient is not None:
+            return [recipient] if recipient != sender else []
+
+        # Legacy two-party chat: everyone else
+        return [username for username in self.clients if username != sender]
+
+    @timed('server.relay')
     def relay_message(self, sender, message_data):
         """Relay encrypted messages (server cannot read them)"""
-        for username, client_socket in self.clients.items():
-            if username != sender:
-                try:
-                    relay_msg = {
-                        'type': 'encrypted_message',
-                        'from': sender,
-                        'encrypted_content': message_data['encrypted_content'],
-                        'signature': message_data['signature'],
-                        'timestamp': time.time()
-                    }
-                    client_socket.send(json.dumps(relay_msg).encode('utf-8'))
-                    print(f"📨 Mensaje relay: {sender} -> {username} (ENCRIPTADO)")
-                except Exception as e:
-                    print(f"❌ Error enviando mensaje a {username}: {e}")
\ No newline at end of file
+        try:
+            recipients = self.route(sender, message_data)
+        except ValueError as e:
+            self.send_error(self.clients[sender], str(e))
+            return
+
+        relay_msg = {
+            'type': message_data['type'],
+            'from': sender,
+            'timestamp': time.time()
+        }
+        for field in RELAYED_FIELDS:
+            if field in message_data:
+                relay_msg[field] = message_data[field]
+
+        delivered = self.broadcast(recipients, relay_msg, self.clients.get(sender))
+        MESSAGES_RELAYED.inc()
+        RELAY_FANOUT.observe(len(recipients))
+        DELIVERIES.inc(len(delivered))
+        if logger.isEnabledFor(logging.DEBUG):
+            for username in delivered:
+                logger.debug("📨 Mensaje relay: %s -> %s (ENCRIPTADO)", sender, username)
+
+    def on_peer_up(self, node_id):
+        """A node joined the cluster: tell it who is connected here"""
+        for username, connection in list(self.clients.items()):
+            self.cluster.send(node_id, {'type': 'presence', 'username': username,
+                                        'public_key': self.public_keys[username], 'online': True})
+            for room in connection.rooms:
+                self.cluster.send(node_id, {'type': 'room_update', 'room': room,
+                                            'username': username, 'joined': True})
+
+    def on_peer_down(self, node_id):
+        """A node left the cluster: its users are offline until it comes back"""
+        for username in [user for user, node in self.locations.items() if node == node_id]:
+            self.remove_remote_user(username)
+
+    def remove_remote_user(self, username):
+        for room in [room for room, members in self.rooms.items() if username in members]:
+            self.remove_member(room, username)
+        del self.locations[username]
+        self.public_keys.pop(username, None)
+        self.directory.set_online(username, False)
+
+    def on_bus_message(self, node_id, message):
+        """Apply a directory update or deliver a frame forwarded by another node"""
+        msg_type = message.get('type')
+        if msg_type == 'forward':
+            frame = message['frame']
+            for username in message['recipients']:
+                connection = self.clients.get(username)
+                if connection is not None and not connection.replaying:
+                    connection.send(frame)
+                elif self.store and self.store.knows(username):
+                    # Left (or still catching up) while the frame was in flight
+                    self.store_message(username, frame)
+        elif msg_type == 'presence':
+            username = message['username']
+            if message['online']:
+                if username in self.clients:
+                    return  # Connected here too; the local connection wins
+                if self.locations.get(username, node_id) != node_id:
+                    self.remove_remote_user(username)
+                self.locations[username] = node_id
+                self.public_keys[username] = message['public_key']
+                self.directory.publish(username, message['public_key'])
+                if self.store:
+                    # Users of any node get their messages kept while offline
+                    self.store.register(username)
+                    self.forward_pending(username, node_id)
+            elif self.locations.get(username) == node_id:
+                self.remove_remote_user(username)
+        elif msg_type == 'room_update':
+            username = message['username']
+            if self.locations.get(username) != node_id:
+                return
+            if message['joined']:
+                if username not in self.rooms.get(message['room'], ()):
+                    self.add_member(message['room'], username)
+            else:
+                self.remove_member(message['room'], username)
+        else:
+            logger.warning("⚠️  Mensaje de nodo no soportado: %s", msg_type)
+
+    def forward_pending(self, username, node_id):
+        """Hand messages stored on this node to the node the user connected to
+
+        Sent before anything relayed later over the same link, so the
+        recipient sees them in order.
+        """
+        delivered = 0
+        while self.store.has_pending(username):
+            last_seq, frames = self.store.read_pending(username)
+            self.cluster.send(node_id, {'type': 'forward', 'recipients': [username], 'frame': b''.join(frames)})
+            self.store.ack(username, last_seq)
+            delivered += len(frames)
+        if delivered:
+            logger.info("📬 %d mensajes pendientes reenviados a %s en %s", delivered, username, node_id)
+
+def raise_file_limit():
+    """Raise the open file limit so the server can hold many connections"""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
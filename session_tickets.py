@@ -0,0 +1,53 @@
+# session_tickets.py - Opaque tickets for resuming a registration without re-sending the key
+import json
+import os
+import time
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+TICKET_LIFETIME = 24 * 3600
+TICKET_ASSOCIATED_DATA = b'secure-chat session ticket'
+NONCE_SIZE = 12
+CHALLENGE_SIZE = 32
+
+def resume_proof_data(challenge, ticket):
+    """What a client signs with its identity key to resume: the server's challenge and the ticket"""
+    return b'secure-chat resume' + challenge + ticket
+
+class SessionTickets:
+    """Issues and opens tickets sealed with a server-side AES-256-GCM key
+
+    A ticket holds what a registration established (username, key
+    fingerprint and suite), so the server keeps no per-ticket state and any
+    node holding the same key accepts it. The key itself is looked up again
+    in the key directory. A ticket alone is not enough to resume: the
+    client also signs a fresh challenge with that key (resume_proof_data). Without a configured key a random one is used:
+    tickets then stop working when the process restarts, and clients fall
+    back to a full registration.
+    """
+    def __init__(self, key=None, lifetime=TICKET_LIFETIME):
+        self.aead = AESGCM(key if key is not None else AESGCM.generate_key(bit_length=256))
+        self.lifetime = lifetime
+
+    def issue(self, username, fingerprint, suite):
+        body = json.dumps({
+            'username': username,
+            'fingerprint': fingerprint,
+            'suite': suite,
+            'expires': time.time() + self.lifetime,
+        }).encode('utf-8')
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.aead.encrypt(nonce, body, TICKET_ASSOCIATED_DATA)
+
+    def open(self, ticket):
+        """Fields of a valid ticket, or None if it is forged, corrupted or expired"""
+        if not isinstance(ticket, bytes) or len(ticket) <= NONCE_SIZE:
+            return None
+        try:
+            body = self.aead.decrypt(ticket[:NONCE_SIZE], ticket[NONCE_SIZE:], TICKET_ASSOCIATED_DATA)
+        except InvalidTag:
+            return None
+        fields = json.loads(body)
+        if fields['expires'] < time.time():
+            return None
+        return fields
@@ -0,0 +1,145 @@
+# conftest.py - A relay server on a free port and client sessions on a shared network loop
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import UNTHROTTLED
+from client import NetworkLoop, SecureChatClient
+from server import SecureChatServer
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def wait_for(condition, timeout=15.0, message='condition'):
+    """Poll condition from the test thread until it holds"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError(f"timed out waiting for {message}")
+        time.sleep(0.02)
+
+class ServerThread:
+    """A SecureChatServer serving on its own event loop thread"""
+    def __init__(self, **kwargs):
+        kwargs.setdefault('limits', UNTHROTTLED)
+        self.server = SecureChatServer(port=free_port(), **kwargs)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.task = self.call(lambda: self.loop.create_task(self.server.serve()))
+        wait_for(self.accepting, message='server')
+
+    @property
+    def port(self):
+        return self.server.port
+
+    def accepting(self):
+        try:
+            socket.create_connection(('localhost', self.port), 1).close()
+            return True
+        except OSError:
+            return False
+
+    def call(self, function, *args):
+        """Run function on the server loop and return its result"""
+        async def run():
+            return function(*args)
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result(10)
+
+    async def _shutdown(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+class Session:
+    """A client session driven from the test thread, with the events it published"""
+    def __init__(self, network, client):
+        self.network = network
+        self.client = client
+        self.events = []
+        network.run(self._subscribe())
+
+    async def _subscribe(self):
+        stream = self.client.messages()
+        self.reader = asyncio.get_running_loop().create_task(self._read(stream))
+
+    async def _read(self, stream):
+        async for event in stream:
+            self.events.append(event)
+
+    def run(self, coroutine, timeout=30):
+        return self.network.run(coroutine, timeout)
+
+    def call(self, function, *args):
+        """Run function on the session's loop and return its result"""
+        async def run():
+            return function(*args)
+        return self.run(run())
+
+    def received(self):
+        return [event for event in self.events if event['type'] == 'message']
+
+    def notices(self):
+        return [event['text'] for event in self.events if event['type'] == 'notice']
+
+    def drop(self):
+        """Abort the connection under the session, as a network failure would"""
+        self.call(lambda: self.client.protocol.transport.abort())
+
+@pytest.fixture
+def network():
+    network = NetworkLoop().start()
+    yield network
+    network.stop()
+
+@pytest.fixture
+def server_factory(tmp_path):
+    servers = []
+    def start(**kwargs):
+        kwargs.setdefault('store_dir', str(tmp_path / 'store'))
+        server = ServerThread(**kwargs)
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.stop()
+
+@pytest.fixture
+def server(server_factory):
+    return server_factory()
+
+@pytest.fixture
+def connect(network, server, tmp_path):
+    """connect(username, **client options) -> a registered Session (not connected with start=False)"""
+    sessions = []
+    def connect(username, start=True, **kwargs):
+        kwargs.setdefault('key_dir', str(tmp_path / 'keys'))
+        kwargs.setdefault('download_dir', str(tmp_path / username / 'downloads'))
+        kwargs.setdefault('transfer_dir', str(tmp_path / username / 'transfers'))
+        kwargs.setdefault('history_dir', None)
+        kwargs.setdefault('receive_workers', 2)
+        session = Session(network, SecureChatClient(username, loop=network.loop, **kwargs))
+        sessions.append(session)
+        if start:
+            session.run(session.client.connect(port=server.port))
+        return session
+    yield connect
+    for session in sessions:
+        if session.client.connected:
+            session.run(session.client.disconnect())
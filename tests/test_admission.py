@@ -0,0 +1,75 @@
+import pytest
+from admission import AdmissionControl, TokenBucket, SWEEP_INTERVAL
+
+LIMITS = {'max_connections': 5, 'max_connections_per_ip': 2,
+          'user_rate': 10.0, 'user_burst': 20, 'ip_rate': 100.0, 'ip_burst': 200}
+
+def drain(bucket, now, frames):
+    for _ in range(frames):
+        bucket.take(now)
+
+def test_token_bucket_rate_and_burst():
+    bucket = TokenBucket(10.0, 20, now=0.0)
+    assert all(bucket.take(0.0) for _ in range(20))
+    assert not bucket.take(0.0)  # In debt: the sender waits
+    assert bucket.delay() == pytest.approx(0.1)
+    assert bucket.take(0.2)  # Refilled at the rate
+    assert bucket.full_at() == pytest.approx(0.2 + 20 / 10.0)
+    bucket.take(100.0, amount=0)
+    assert bucket.tokens == 20  # Never above the burst
+
+def test_connection_caps():
+    admission = AdmissionControl(LIMITS)
+    assert admission.admit('10.0.0.1', 0.0) and admission.admit('10.0.0.1', 0.0)
+    assert not admission.admit('10.0.0.1', 0.0)  # Per IP
+    assert admission.admit('10.0.0.2', 0.0) and admission.admit('10.0.0.2', 0.0)
+    assert admission.admit('10.0.0.3', 0.0)
+    assert not admission.admit('10.0.0.4', 0.0)  # Whole node
+    assert admission.connections == 5
+    admission.release('10.0.0.1')
+    assert admission.admit('10.0.0.1', 0.0)
+
+def test_unknown_limits_are_refused():
+    with pytest.raises(ValueError):
+        AdmissionControl({'user_rat': 1.0})
+
+def test_reconnecting_does_not_refill_the_ip_bucket():
+    admission = AdmissionControl(LIMITS)
+    assert admission.admit('10.0.0.1', 0.0)
+    bucket = admission.ip_bucket('10.0.0.1')
+    drain(bucket, 0.0, 300)
+    admission.release('10.0.0.1')
+
+    assert admission.admit('10.0.0.1', 1.0)
+    assert admission.ip_bucket('10.0.0.1') is bucket
+    assert bucket.delay() > 0  # Still in debt
+    admission.release('10.0.0.1')
+
+    # Swept only once it would be full anyway
+    admission.sweep(bucket.full_at() - 0.1)
+    assert '10.0.0.1' in admission.addresses
+    admission.sweep(bucket.full_at())
+    assert '10.0.0.1' not in admission.addresses
+
+def test_reconnecting_does_not_refill_the_user_bucket():
+    admission = AdmissionControl(LIMITS)
+    bucket = admission.user_bucket('alice', 0.0)
+    drain(bucket, 0.0, 40)
+    admission.forget_user('alice')
+
+    assert admission.user_bucket('alice', 0.5) is bucket
+    admission.forget_user('alice')
+    admission.sweep(1.0)
+    assert admission.user_bucket('alice', 1.0) is bucket  # Not full yet
+    admission.forget_user('alice')
+
+    full_at = bucket.full_at()
+    assert admission.admit('10.0.0.1', full_at + SWEEP_INTERVAL)  # Sweeps lazily
+    assert 'alice' not in admission.users
+    assert admission.user_bucket('alice', full_at + SWEEP_INTERVAL) is not bucket
+
+def test_connected_users_are_never_swept():
+    admission = AdmissionControl(LIMITS)
+    bucket = admission.user_bucket('alice', 0.0)
+    admission.sweep(1000.0)
+    assert admission.user_bucket('alice', 1000.0) is bucket
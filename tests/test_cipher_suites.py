@@ -0,0 +1,76 @@
+import os
+import pytest
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from conftest import wait_for
+from cipher_suites import SUITES, SUITE_RSA, SUITE_X25519, suite_for_key, suite_for_pem
+
+@pytest.mark.parametrize('name', list(SUITES))
+def test_wrap_and_unwrap_round_trip(name):
+    suite = SUITES[name]
+    private_key = suite.generate_private_key()
+    key = os.urandom(32)
+    wrapped = suite.wrap_key(private_key.public_key(), key)
+    assert wrapped != suite.wrap_key(private_key.public_key(), key)  # Randomized
+    assert suite.unwrap_key(private_key, wrapped) == key
+
+    # Only the recipient's key opens it, and not once it was altered
+    with pytest.raises((ValueError, InvalidTag)):
+        suite.unwrap_key(suite.generate_private_key(), wrapped)
+    tampered = bytearray(wrapped)
+    tampered[-1] ^= 1
+    with pytest.raises((ValueError, InvalidTag)):
+        suite.unwrap_key(private_key, bytes(tampered))
+
+@pytest.mark.parametrize('name', list(SUITES))
+def test_keys_and_signatures_round_trip(name):
+    suite = SUITES[name]
+    private_key = suite.generate_private_key()
+    public_pem = suite.public_bytes(private_key.public_key())
+    public_key = suite.load_public_key(public_pem)
+    assert suite_for_pem(public_pem) is suite and suite_for_key(public_key) is suite
+
+    signature = suite.sign(private_key, b'hola')
+    suite.verify(public_key, signature, b'hola')
+    with pytest.raises(InvalidSignature):
+        suite.verify(public_key, signature, b'adios')
+
+    restored = suite.load_private_key(suite.private_bytes(private_key, 'clave'), 'clave')
+    assert suite.unwrap_key(restored, suite.wrap_key(public_key, b'k' * 32)) == b'k' * 32
+
+    other = next(candidate for candidate in SUITES.values() if candidate is not suite)
+    with pytest.raises(ValueError):
+        other.load_public_key(public_pem)
+
+def test_rooms_mix_suites(connect):
+    alice = connect('alice', suite=SUITE_RSA)
+    bob = connect('bob', suite=SUITE_X25519)
+    carol = connect('carol', suite=SUITE_RSA)
+    for session in (alice, bob, carol):
+        session.run(session.client.join_room('dev'))
+    wait_for(lambda: alice.client.rooms.get('dev') == {'bob', 'carol'}, message='the members')
+
+    # Each member gets the session key wrapped with its own suite
+    assert alice.run(alice.client.send('hola a todos', room='dev'))
+    assert bob.run(bob.client.send('hola desde x25519', room='dev'))
+    wait_for(lambda: len(carol.received()) == 2, message='both messages')
+    wait_for(lambda: len(alice.received()) == 1 and len(bob.received()) == 1, message='the replies')
+    assert [event['text'] for event in carol.received()] == ['hola a todos', 'hola desde x25519']
+    assert all(event['signature_valid'] for session in (alice, bob, carol) for event in session.received())
+
+def test_a_refused_suite_is_renegotiated(connect, server_factory):
+    rsa_only = server_factory(suites=[SUITE_RSA])
+    alice = connect('alice', start=False, suite=SUITE_X25519)
+    alice.run(alice.client.connect(port=rsa_only.port))
+
+    assert alice.client.registered.is_set()
+    assert alice.client.crypto.suite.name == SUITE_RSA
+    assert f"🔄 Cambiando a la suite {SUITE_RSA}" in alice.notices()
+    public_key = rsa_only.call(lambda: rsa_only.server.public_keys['alice'])
+    assert suite_for_pem(public_key).name == SUITE_RSA
+
+    # A client of the other suite can talk to it
+    bob = connect('bob', start=False, suite=SUITE_RSA)
+    bob.run(bob.client.connect(port=rsa_only.port))
+    assert bob.run(bob.client.send('hola alice', to='alice')) is not None
+    wait_for(lambda: len(alice.received()) == 1, message='the message')
+    assert alice.received()[0]['text'] == 'hola alice'
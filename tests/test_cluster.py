@@ -0,0 +1,188 @@
+import asyncio
+import os
+import pytest
+import cluster
+from cluster import SocketBus, TAG_SIZE
+from protocol import encode_message
+
+SECRET = os.urandom(32)
+
+class Node:
+    """Stands in for a SecureChatServer: records what the bus hands it"""
+    def __init__(self):
+        self.peers = []
+        self.messages = []
+
+    def on_peer_up(self, node_id):
+        self.peers.append(node_id)
+
+    def on_peer_down(self, node_id):
+        self.peers.remove(node_id)
+
+    def on_bus_message(self, node_id, message):
+        self.messages.append((node_id, message))
+
+async def until(condition, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+@pytest.fixture(autouse=True)
+def fast_reconnect(monkeypatch):
+    monkeypatch.setattr(cluster, 'RECONNECT_INTERVAL', 0.05)
+
+def address(tmp_path, name):
+    return f"unix:{tmp_path / name}.sock"
+
+def test_secret_is_required(tmp_path):
+    with pytest.raises(ValueError):
+        SocketBus('a', address(tmp_path, 'a'))
+
+def test_authenticated_link_delivers_in_order(tmp_path):
+    async def main():
+        a, b = Node(), Node()
+        bus_a = SocketBus('a', address(tmp_path, 'a'), [address(tmp_path, 'b')], SECRET)
+        bus_b = SocketBus('b', address(tmp_path, 'b'), [address(tmp_path, 'a')], SECRET)
+        await bus_a.start(a)
+        await bus_b.start(b)
+        await until(lambda: a.peers == ['b'] and b.peers == ['a'])
+        for i in range(100):
+            bus_a.send('b', {'type': 'presence', 'username': f"user{i}", 'online': True})
+        bus_b.publish({'type': 'room_update', 'room': 'dev', 'username': 'bob', 'joined': True})
+        await until(lambda: len(b.messages) == 100 and len(a.messages) == 1)
+        assert [message['username'] for _, message in b.messages] == [f"user{i}" for i in range(100)]
+        assert a.messages[0][0] == 'b'
+        await bus_a.close()
+        await bus_b.close()
+    asyncio.run(main())
+
+def test_node_without_the_secret_is_refused(tmp_path):
+    async def main():
+        a, b = Node(), Node()
+        bus_a = SocketBus('a', address(tmp_path, 'a'), [], SECRET)
+        intruder = SocketBus('b', address(tmp_path, 'b'), [address(tmp_path, 'a')], os.urandom(32))
+        await bus_a.start(a)
+        await intruder.start(b)
+        await asyncio.sleep(0.3)
+        # a's proof does not match the intruder's secret: it never sends anything
+        assert b.peers == [] and intruder.links == {}
+        await intruder.close()
+
+        # Raw frames without a valid tag close the link before reaching the server
+        kind, path = cluster.parse_address(address(tmp_path, 'a'))
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(encode_message({'type': 'node_hello', 'node': 'x', 'nonce': os.urandom(16)}))
+        writer.write(encode_message({'type': 'presence', 'username': 'mallory', 'online': True}) + b'\0' * TAG_SIZE)
+        await asyncio.wait_for(reader.read(), 5)  # The hello, then EOF
+        writer.close()
+        assert a.messages == []
+        await bus_a.close()
+    asyncio.run(main())
+
+def test_protocol_errors_do_not_stop_reconnecting(tmp_path):
+    async def main():
+        attempts = []
+        async def garbage(reader, writer):
+            attempts.append(1)
+            writer.write(b'\xff' * 64)  # An oversized frame header
+            writer.close()
+        kind, path = cluster.parse_address(address(tmp_path, 'b'))
+        listener = await asyncio.start_unix_server(garbage, path=path)
+        a = Node()
+        bus_a = SocketBus('a', address(tmp_path, 'a'), [address(tmp_path, 'b')], SECRET)
+        await bus_a.start(a)
+        await until(lambda: len(attempts) >= 3)
+        listener.close()
+        await listener.wait_closed()
+        os.remove(path)
+
+        # The real peer comes up at that address: the link is established
+        b = Node()
+        bus_b = SocketBus('b', address(tmp_path, 'b'), [], SECRET)
+        await bus_b.start(b)
+        await until(lambda: a.peers == ['b'])
+        await bus_a.close()
+        await bus_b.close()
+    asyncio.run(main())
+
+def test_peer_that_does_not_read_is_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(cluster, 'MAX_LINK_BUFFER', 1024)
+    async def main():
+        hellos = []
+        async def stalled(reader, writer):
+            # Completes the handshake, then never reads again
+            _, msg_type, body = await cluster._read_frame(reader)
+            hello = cluster.decode_body(msg_type, body)
+            hellos.append(hello)
+            nonce = os.urandom(cluster.NONCE_SIZE)
+            writer.write(encode_message({'type': 'node_hello', 'node': 'b', 'nonce': nonce,
+                                         'proof': cluster._hello_proof(SECRET, hello['node'], 'b', hello['nonce'], nonce)}))
+            await asyncio.sleep(3600)
+        kind, path = cluster.parse_address(address(tmp_path, 'b'))
+        listener = await asyncio.start_unix_server(stalled, path=path)
+        a = Node()
+        bus_a = SocketBus('a', address(tmp_path, 'a'), [address(tmp_path, 'b')], SECRET)
+        await bus_a.start(a)
+        await until(lambda: a.peers == ['b'])
+        link = bus_a.links['b']
+        for _ in range(1000):
+            bus_a.send('b', {'type': 'presence', 'username': 'x' * 65536, 'online': True})
+            if link.writer.is_closing():
+                break
+            await asyncio.sleep(0)
+        assert link.writer.is_closing()
+        assert link.writer.transport.get_write_buffer_size() == 0  # Buffer released
+        await until(lambda: len(hellos) >= 2)  # Reconnected afterwards
+        await bus_a.close()
+        listener.close()
+    asyncio.run(main())
+
+def test_rewritten_node_id_is_refused(tmp_path):
+    async def main():
+        async def relay(reader, writer):
+            # A man in the middle: claims the connector is node z, then relays as is
+            upstream_reader, upstream_writer = await asyncio.open_unix_connection(
+                cluster.parse_address(address(tmp_path, 'b'))[1])
+            _, msg_type, body = await cluster._read_frame(reader)
+            hello = cluster.decode_body(msg_type, body)
+            hello['node'] = 'z'
+            upstream_writer.write(encode_message(hello))
+            async def pipe(source, destination):
+                while data := await source.read(65536):
+                    destination.write(data)
+                destination.close()
+            await asyncio.gather(pipe(reader, upstream_writer), pipe(upstream_reader, writer))
+        kind, path = cluster.parse_address(address(tmp_path, 'mitm'))
+        listener = await asyncio.start_unix_server(relay, path=path)
+        a, b = Node(), Node()
+        bus_a = SocketBus('a', address(tmp_path, 'a'), [address(tmp_path, 'mitm')], SECRET)
+        bus_b = SocketBus('b', address(tmp_path, 'b'), [], SECRET)
+        await bus_b.start(b)
+        await bus_a.start(a)
+        await asyncio.sleep(0.3)
+        assert a.peers == [] and b.messages == []
+        await bus_a.close()
+        await bus_b.close()
+        listener.close()
+    asyncio.run(main())
+
+def test_handshake_is_small_and_bounded_in_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(cluster, 'HANDSHAKE_TIMEOUT', 0.2)
+    async def main():
+        bus_a = SocketBus('a', address(tmp_path, 'a'), [], SECRET)
+        await bus_a.start(Node())
+        path = cluster.parse_address(address(tmp_path, 'a'))[1]
+
+        # A hello far larger than a node id and a nonce
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(encode_message({'type': 'node_hello', 'node': 'x' * 4096, 'nonce': os.urandom(16)}))
+        assert await asyncio.wait_for(reader.read(), 5) == b''
+        writer.close()
+
+        # No hello at all
+        reader, writer = await asyncio.open_unix_connection(path)
+        assert await asyncio.wait_for(reader.read(), 5) == b''
+        writer.close()
+        await bus_a.close()
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+import asyncio
+import hashlib
+import os
+import threading
+import file_transfer
+from conftest import wait_for
+
+CHUNKS = 256  # file_transfer.CHUNK_SIZE chunks
+
+def sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def test_transfer_resumes_after_reconnection(connect, tmp_path):
+    alice = connect('alice')
+    bob = connect('bob')
+    path = tmp_path / 'big.bin'
+    path.write_bytes(os.urandom(CHUNKS * 64 * 1024))
+
+    async def send_and_drop():
+        # Dropped from the loop itself, as soon as part of the file is acknowledged
+        await alice.client.send_file(str(path), 'bob')
+        while True:
+            transfer = next(iter(alice.client.transfers.outgoing.values()), None)
+            if transfer is not None and transfer.acked >= 16:
+                break
+            await asyncio.sleep(0.001)
+        alice.client.protocol.transport.abort()
+        return transfer.acked
+    acked = alice.run(send_and_drop())
+    assert acked < CHUNKS
+
+    received = tmp_path / 'bob' / 'downloads' / 'big.bin'
+    wait_for(received.exists, message='the resumed transfer')
+    assert sha256(received) == sha256(path)
+    assert not os.path.exists(str(received) + '.part')
+    assert any(text.startswith("📤 Reanudando envío de big.bin") for text in alice.notices())
+    wait_for(lambda: not os.listdir(tmp_path / 'alice' / 'transfers' / 'outgoing'), message='the upload state')
+    assert not any("Sin conexión" in text for text in alice.notices())
+
+def test_disk_and_key_work_stays_off_the_loop(connect, tmp_path, monkeypatch):
+    threads = set()
+    def recording(function):
+        def wrapper(*args, **kwargs):
+            threads.add(threading.current_thread().name)
+            return function(*args, **kwargs)
+        return wrapper
+    monkeypatch.setattr(file_transfer.IncomingTransfer, 'write_chunk',
+                        recording(file_transfer.IncomingTransfer.write_chunk))
+    monkeypatch.setattr(file_transfer.FileTransferManager, '_prepare_incoming',
+                        recording(file_transfer.FileTransferManager._prepare_incoming))
+    monkeypatch.setattr(file_transfer.FileTransferManager, '_prepare_offer',
+                        recording(file_transfer.FileTransferManager._prepare_offer))
+
+    alice = connect('alice')
+    connect('bob')
+    path = tmp_path / 'small.bin'
+    path.write_bytes(os.urandom(20 * 64 * 1024 + 1))
+    alice.run(alice.client.send_file(str(path), 'bob'))
+
+    received = tmp_path / 'bob' / 'downloads' / 'small.bin'
+    wait_for(received.exists, message='the transfer')
+    assert sha256(received) == sha256(path)
+    assert threads and 'chat-network' not in threads
+
+def test_acks_only_count_from_the_recipient(connect, tmp_path):
+    alice = connect('alice')
+    connect('bob')
+    path = tmp_path / 'doc.bin'
+    path.write_bytes(os.urandom(4 * 64 * 1024))
+    transfer = alice.client.transfers._new_outgoing(str(path), 'bob', os.stat(path))
+    alice.client.transfers.outgoing[transfer.file_id] = transfer
+    # Another user who learned the file id cannot move the window
+    forged = {'type': 'file_ack', 'from': 'mallory', 'file_id': transfer.file_id, 'next': 4}
+    alice.call(alice.client.transfers.on_ack, forged)
+    assert transfer.acked == 0 and not transfer.running
+    alice.call(alice.client.transfers.on_ack, dict(forged, **{'from': 'bob'}))
+    assert transfer.acked == 4
+
+class Uploads:
+    """Stands in for the FileTransferManager (and its client) of one upload"""
+    def __init__(self, drop_at):
+        self.client = self
+        self.connected = True
+        self.drop_at = drop_at  # The connection drops while this chunk is sent
+        self.sent = []
+        self.held = threading.Event()
+        self.release = threading.Event()  # Holds the upload thread on its way out
+        self.finished = threading.Event()
+        self.transfer = None
+
+    def online(self):
+        if self.held.is_set() and not self.release.is_set():
+            self.release.wait(5)
+            return False
+        return self.connected
+
+    def notice(self, text):
+        pass
+
+    def send_from_thread(self, message):
+        self.sent.append(message['index'])
+        if message['index'] == self.drop_at and not self.held.is_set():
+            self.held.set()
+        else:
+            self.transfer.on_ack(message['index'] + 1, False)
+
+    def save_outgoing(self, transfer, acked):
+        pass
+
+    def finish_outgoing(self, transfer):
+        self.finished.set()
+
+def test_resume_while_the_previous_thread_exits(tmp_path):
+    chunks = 20
+    path = tmp_path / 'doc.bin'
+    path.write_bytes(os.urandom(chunks * 16))
+    uploads = Uploads(drop_at=5)
+    state = {'file_id': os.urandom(16), 'path': str(path), 'to': 'bob', 'size': chunks * 16,
+             'chunks': chunks, 'chunk_size': 16, 'acked': 0}
+    transfer = uploads.transfer = file_transfer.OutgoingTransfer(uploads, state, os.urandom(32))
+    transfer.on_ack(0, True)
+
+    # The connection drops and comes back before the thread has noticed it:
+    # the resume arrives while that thread is on its way out
+    assert uploads.held.wait(5)
+    sent = len(uploads.sent)
+    transfer.on_ack(5, True)
+    uploads.release.set()
+
+    assert uploads.finished.wait(5)
+    assert uploads.sent[sent:] == list(range(5, chunks))
@@ -0,0 +1,40 @@
+import os
+import history_store
+from history_store import HistoryStore
+
+KEY = os.urandom(32)
+
+def test_pages_survive_a_restart(tmp_path):
+    store = HistoryStore(str(tmp_path), KEY, segment_entries=4)
+    for i in range(10):
+        store.append('#dev', {'text': f"m{i}", 'timestamp': float(i)})
+    store.close()
+
+    store = HistoryStore(str(tmp_path), KEY, segment_entries=4)
+    assert store.count('#dev') == 10
+    page = store.page('#dev', limit=3)
+    assert [record['text'] for record in page] == ['m7', 'm8', 'm9']
+    older = store.page('#dev', before=page[0]['seq'], limit=3)
+    assert [record['seq'] for record in older] == [5, 6, 7]
+    assert store.seq_at('#dev', 4.5) == 6
+    store.close()
+
+def test_failed_write_is_reported_and_leaves_no_gap(tmp_path, monkeypatch):
+    errors = []
+    store = HistoryStore(str(tmp_path), KEY, on_error=errors.append)
+    store.append('#dev', {'text': 'uno', 'timestamp': 1.0})
+    store.flush()
+
+    append = history_store.Conversation.append
+    def failing(conversation, records, segment_entries):
+        raise OSError("disco lleno")
+    monkeypatch.setattr(history_store.Conversation, 'append', failing)
+    store.append('#dev', {'text': 'perdido', 'timestamp': 2.0})
+    store.flush()
+    assert [str(e) for e in errors] == ["disco lleno"]
+
+    monkeypatch.setattr(history_store.Conversation, 'append', append)
+    store.append('#dev', {'text': 'dos', 'timestamp': 3.0})
+    store.flush()
+    assert [(record['seq'], record['text']) for record in store.page('#dev')] == [(1, 'uno'), (2, 'dos')]
+    store.close()
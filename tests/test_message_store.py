@@ -0,0 +1,137 @@
+import threading
+import time
+import message_store
+from message_store import OfflineMessageStore, FSYNC_ALWAYS, FSYNC_NEVER
+
+def open_store(path, **kwargs):
+    kwargs.setdefault('fsync_policy', FSYNC_NEVER)
+    return OfflineMessageStore(str(path), **kwargs)
+
+def replay(store, recipient):
+    """Every pending frame, read batch by batch as the server does"""
+    frames = []
+    while store.has_pending(recipient):
+        last_seq, batch = store.read_pending(recipient, max_bytes=64)
+        frames.extend(batch)
+        store.ack(recipient, last_seq)
+    return frames
+
+def test_replay_in_order_and_ack(tmp_path):
+    store = open_store(tmp_path)
+    store.register('bob')
+    for i in range(10):
+        store.append('bob', b'frame %d' % i)
+    store.append('carol', b'other')
+
+    last_seq, frames = store.read_pending('bob', max_bytes=45)
+    assert frames == [b'frame 0', b'frame 1']
+    # Read but not acknowledged: still pending
+    assert store.pending_count('bob') == 10
+    store.ack('bob', last_seq)
+    assert store.pending_count('bob') == 8
+    assert replay(store, 'bob') == [b'frame %d' % i for i in range(2, 10)]
+    assert not store.has_pending('bob')
+    assert store.pending_count('carol') == 1
+    store.close()
+
+def test_unacknowledged_messages_survive_a_restart(tmp_path):
+    store = open_store(tmp_path)
+    store.register('bob')
+    for i in range(5):
+        store.append('bob', b'frame %d' % i)
+    store.ack('bob', 2)
+    store.close()
+
+    store = open_store(tmp_path)
+    assert replay(store, 'bob') == [b'frame 2', b'frame 3', b'frame 4']
+    # New messages continue the sequence
+    assert store.append('bob', b'frame 5') == 6
+    store.close()
+
+def test_compaction_keeps_live_messages(tmp_path):
+    store = open_store(tmp_path, segment_size=256)
+    store.register('bob')
+    store.register('carol')
+    for i in range(20):
+        store.append('bob', b'bob %02d' % i)
+        store.append('carol', b'carol %02d' % i)
+    segments = len(store.segments)
+    assert segments > 2
+    replay(store, 'carol')  # Most of every segment is now dead
+    store.ack('bob', 15)
+
+    store.compact()
+    assert len(store.segments) < segments
+    assert store.total_bytes() < 40 * 64
+    assert replay(store, 'bob') == [b'bob %02d' % i for i in range(15, 20)]
+
+    store.compact()
+    assert len(store.segments) == 1  # Only the active segment is left
+    store.close()
+
+    store = open_store(tmp_path, segment_size=256)
+    assert not store.has_pending('bob') and not store.has_pending('carol')
+    store.close()
+
+def test_retention_and_recipient_limit(tmp_path):
+    store = open_store(tmp_path, retention_seconds=60, max_pending_per_recipient=3)
+    store.register('bob')
+    store.append('bob', b'old', timestamp=time.time() - 120)
+    for i in range(4):
+        store.append('bob', b'new %d' % i)
+    # The oldest messages go first when a recipient has too many
+    assert store.pending_count('bob') == 3
+    store.compact()
+    assert replay(store, 'bob') == [b'new 1', b'new 2', b'new 3']
+
+    store.append('bob', b'expired', timestamp=time.time() - 120)
+    store.compact()
+    assert not store.has_pending('bob')
+    store.close()
+
+def test_appends_leave_the_fsync_to_a_sync_job(tmp_path, monkeypatch):
+    fsyncs = []
+    monkeypatch.setattr(message_store.os, 'fsync', lambda fd: fsyncs.append(threading.current_thread()))
+    store = open_store(tmp_path, fsync_policy=FSYNC_ALWAYS)
+    store.register('bob')
+    store.append('bob', b'frame')
+    assert fsyncs == [] and store.needs_sync()
+
+    job = store.sync_job()
+    assert not store.needs_sync()
+    worker = threading.Thread(target=job)
+    worker.start()
+    worker.join()
+    assert fsyncs and all(thread is worker for thread in fsyncs)
+    assert store.sync_job() is None  # Nothing left to do
+    store.close()
+
+def test_compaction_steps_interleave_with_appends_and_acks(tmp_path):
+    store = open_store(tmp_path, segment_size=512)
+    store.register('bob')
+    store.register('carol')
+    for i in range(40):
+        store.append('bob', b'bob %02d' % i)
+        store.append('carol', b'carol %02d' % i)
+    replay(store, 'carol')
+    segments = len(store.segments)
+
+    # Between two steps the loop keeps appending and delivering
+    steps = 0
+    for job in store.compact_steps(step_bytes=64):
+        if job is not None:
+            job()
+            continue
+        steps += 1
+        store.append('bob', b'bob %02d' % (40 + steps))
+        last_seq, frames = store.read_pending('bob', max_bytes=1)
+        store.ack('bob', last_seq)
+    assert steps > 2
+    assert len(store.segments) < segments
+    assert replay(store, 'bob') == ([b'bob %02d' % i for i in range(steps, 40)] +
+                                    [b'bob %02d' % (40 + i) for i in range(1, steps + 1)])
+    store.close()
+
+    store = open_store(tmp_path, segment_size=512)
+    assert not store.has_pending('bob') and not store.has_pending('carol')
+    store.close()
@@ -0,0 +1,47 @@
+import pytest
+from conftest import wait_for
+
+MESSAGES = 20
+
+def store_offline_messages(connect, server):
+    """bob registers and leaves; alice and carol write to him meanwhile"""
+    bob = connect('bob')
+    bob.run(bob.client.disconnect())
+    senders = [connect('alice'), connect('carol')]
+    for sender in senders:
+        sender.call(sender.client.request_keys, ['bob'])
+        wait_for(lambda: 'bob' in sender.client.crypto.peer_public_keys, message="bob's key")
+    for i in range(MESSAGES):
+        sender = senders[i % 2]
+        sender.run(sender.client.send(f"mensaje {i}", to='bob'))
+    wait_for(lambda: server.call(server.server.store.pending_count, 'bob') == MESSAGES,
+             message='the stored messages')
+
+def assert_replayed(bob):
+    wait_for(lambda: len(bob.received()) == MESSAGES, message='the replayed messages')
+    received = bob.received()
+    assert [event['text'] for event in received] == [f"mensaje {i}" for i in range(MESSAGES)]
+    assert all(event['signature_valid'] is True for event in received)
+    assert [event['from'] for event in received[:2]] == ['alice', 'carol']
+
+@pytest.mark.parametrize('receive_workers', [0, 2])
+def test_replay_waits_for_the_senders_keys(connect, server, receive_workers):
+    store_offline_messages(connect, server)
+    # A fresh session knows no keys yet: the replayed messages wait for the directory
+    bob = connect('bob', receive_workers=receive_workers)
+    assert_replayed(bob)
+    wait_for(lambda: not server.call(server.server.store.has_pending, 'bob'), message='the acknowledgement')
+    assert not bob.client.held_messages and not bob.client.awaited_senders
+
+def test_replayed_messages_are_kept_until_acknowledged(connect, server):
+    store_offline_messages(connect, server)
+    bob = connect('bob', start=False)
+    bob.client.ack_offline = lambda marker: None  # Gone before acknowledging
+    bob.run(bob.client.connect(port=server.port))
+    assert_replayed(bob)
+    assert server.call(server.server.store.pending_count, 'bob') == MESSAGES
+    bob.run(bob.client.disconnect())
+
+    bob = connect('bob')
+    assert_replayed(bob)
+    wait_for(lambda: not server.call(server.server.store.has_pending, 'bob'), message='the acknowledgement')
@@ -0,0 +1,117 @@
+import socket
+import pytest
+import protocol
+from protocol import (FRAME_HEADER, FrameDecoder, MESSAGE_TYPES, ProtocolError,
+                      decode_body, encode_message)
+
+MESSAGE = {
+    'type': 'encrypted_message',
+    'from': 'alice',
+    'to': None,
+    'private': True,
+    'resend': False,
+    'seq': -(2 ** 63),
+    'count': 2 ** 63 - 1,
+    'timestamp': 1712345678.25,
+    'text': 'hola ñandú 🔐',
+    'encrypted_content': bytes(range(256)),
+    'recipients': ['bob', 'carol', 3, [b'', {}]],
+    'keys': {'bob': b'\x00\x01', 'carol': {'nested': [None, 1.5]}},
+    'empty': '',
+}
+
+def frame_fields(frame):
+    body_length, msg_type = FRAME_HEADER.unpack_from(frame)
+    return msg_type, frame[FRAME_HEADER.size:], body_length
+
+def test_every_value_type_round_trips():
+    frame = encode_message(MESSAGE)
+    msg_type, body, body_length = frame_fields(frame)
+    assert msg_type == MESSAGE_TYPES['encrypted_message']
+    assert body_length == len(body)
+    assert decode_body(msg_type, body) == MESSAGE
+
+def test_tuples_and_buffers_encode_as_lists_and_bytes():
+    frame = encode_message({'type': 'forward', 'recipients': ('bob',), 'frame': memoryview(b'abc'),
+                            'raw': bytearray(b'xy')})
+    msg_type, body, _ = frame_fields(frame)
+    assert decode_body(msg_type, body) == {'type': 'forward', 'recipients': ['bob'], 'frame': b'abc', 'raw': b'xy'}
+
+def test_decoder_handles_split_and_coalesced_frames():
+    messages = [{'type': 'presence', 'username': f"user{i}", 'online': i % 2 == 0} for i in range(50)]
+    stream = b''.join(encode_message(message) for message in messages)
+
+    decoder = FrameDecoder(buffer_size=64)
+    received = []
+    for i in range(len(stream)):  # One byte at a time
+        received.extend(decoder.feed(stream[i:i + 1]))
+    assert received == messages
+
+    decoder = FrameDecoder(buffer_size=64)
+    assert list(decoder.feed(stream)) == messages  # All at once
+
+def test_decoder_grows_for_frames_larger_than_its_buffer():
+    message = {'type': 'file_chunk', 'index': 7, 'encrypted_content': b'\xab' * 300000}
+    small = {'type': 'file_ack', 'next': 8}
+    stream = encode_message(small) + encode_message(message) + encode_message(small)
+    decoder = FrameDecoder(buffer_size=1024)
+    received = []
+    for start in range(0, len(stream), 4096):
+        received.extend(decoder.feed(stream[start:start + 4096]))
+    assert received == [small, message, small]
+
+def test_decoder_reads_from_a_socket():
+    left, right = socket.socketpair()
+    with left, right:
+        message = {'type': 'register', 'username': 'alice', 'public_key': 'x' * 5000}
+        left.sendall(encode_message(message) * 3)
+        left.close()
+        decoder = FrameDecoder(buffer_size=1024)
+        received = []
+        while decoder.recv_from(right):
+            received.extend(decoder.messages())
+        assert received == [message] * 3
+
+def test_frames_are_views_into_the_buffer():
+    decoder = FrameDecoder()
+    frame = encode_message({'type': 'file_ack', 'next': 2})
+    space = decoder.get_buffer()
+    space[:len(frame)] = frame
+    decoder.buffer_updated(len(frame))
+    (msg_type, body), = decoder.frames()
+    assert isinstance(body, memoryview)
+    assert decode_body(msg_type, body) == {'type': 'file_ack', 'next': 2}
+
+def body_of(message):
+    return encode_message(message)[FRAME_HEADER.size:]
+
+def test_malformed_bodies_raise_protocol_errors():
+    body = body_of({'type': 'error', 'message': 'hola', 'list': [1, 2]})
+    with pytest.raises(ProtocolError, match='Unknown message type'):
+        decode_body(250, body)
+    with pytest.raises(ProtocolError, match='Trailing data'):
+        decode_body(MESSAGE_TYPES['error'], body + b'\x00')
+    for cut in range(len(body)):
+        with pytest.raises(ProtocolError):
+            decode_body(MESSAGE_TYPES['error'], body[:cut] if cut else b'')
+    bad_tag = body_of({'type': 'error', 'value': None})[:-1] + b'\x7f'
+    with pytest.raises(ProtocolError, match='Unknown value tag'):
+        decode_body(MESSAGE_TYPES['error'], bad_tag)
+    bad_utf8 = body_of({'type': 'error', 'value': 'ab'})[:-2] + b'\xff\xfe'
+    with pytest.raises(ProtocolError):
+        decode_body(MESSAGE_TYPES['error'], bad_utf8)
+
+def test_oversized_frames_are_refused(monkeypatch):
+    decoder = FrameDecoder(max_frame_size=1024)
+    with pytest.raises(ProtocolError, match='too large'):
+        list(decoder.feed(FRAME_HEADER.pack(1025, MESSAGE_TYPES['file_chunk'])))
+
+    monkeypatch.setattr(protocol, 'MAX_FRAME_SIZE', 1024)
+    with pytest.raises(ProtocolError, match='too large'):
+        encode_message({'type': 'file_chunk', 'encrypted_content': b'x' * 2048})
+
+def test_unencodable_values_are_refused():
+    with pytest.raises(TypeError):
+        encode_message({'type': 'error', 'message': object()})
+    with pytest.raises(KeyError):
+        encode_message({'type': 'not_a_type'})
@@ -0,0 +1,109 @@
+import threading
+import pytest
+from cryptography.exceptions import InvalidTag
+import crypto_utils
+from crypto_utils import CryptoManager
+from cipher_suites import SUITE_RSA, SUITE_X25519
+
+def pair(suite=SUITE_X25519):
+    """alice and bob, each with the other's public key"""
+    alice, bob = CryptoManager(), CryptoManager()
+    alice.generate_keypair(suite)
+    bob.generate_keypair(suite)
+    alice.load_peer_public_key(bob.get_public_key_pem(), 'bob')
+    bob.load_peer_public_key(alice.get_public_key_pem(), 'alice')
+    return alice, bob
+
+def send(alice, text, room=None):
+    if room is None:
+        payload = alice.encrypt_session_message(text, ['bob'], ('dm', 'bob'))
+    else:
+        payload = alice.encrypt_session_message(text, ['bob'], ('room', room))
+    payload['from'] = 'alice'
+    return payload
+
+def test_rekeys_after_the_message_limit(monkeypatch):
+    monkeypatch.setattr(crypto_utils, 'SESSION_KEY_MAX_MESSAGES', 3)
+    alice, bob = pair()
+    payloads = [send(alice, f"mensaje {i}") for i in range(7)]
+
+    # The key is wrapped only in the first message of each key
+    assert ['encrypted_keys' in payload for payload in payloads] == [True, False, False] * 2 + [True]
+    key_ids = [payload['key_id'] for payload in payloads]
+    assert len(set(key_ids)) == 3 and key_ids[0] == key_ids[2] != key_ids[3]
+    assert [bob.decrypt_session_message(payload, 'bob') for payload in payloads] == [
+        f"mensaje {i}" for i in range(7)]
+
+def test_rekeys_after_the_byte_limit(monkeypatch):
+    monkeypatch.setattr(crypto_utils, 'SESSION_KEY_MAX_BYTES', 10)
+    alice, bob = pair()
+    first, second, third = (send(alice, text) for text in ('12345', '67890', 'x'))
+    assert first['key_id'] == second['key_id'] != third['key_id']
+    assert 'encrypted_keys' in third
+    assert bob.decrypt_session_message(third, 'bob') == 'x'
+
+def test_key_ids_are_per_sender_and_per_conversation():
+    alice, bob = pair()
+    direct = send(alice, 'hola')
+    room = send(alice, 'hola sala', room='dev')
+    assert direct['key_id'] != room['key_id']  # One key per conversation
+    assert bob.decrypt_session_message(direct, 'bob') == 'hola'
+
+    # Another sender reusing alice's key_id does not get her key
+    forged = send(alice, 'otra vez')
+    forged['from'] = 'mallory'
+    with pytest.raises(ValueError):
+        bob.decrypt_session_message(forged, 'bob')
+
+    # Nor does a message of hers under another key_id, and a message is accepted once
+    later = send(alice, 'adios')
+    with pytest.raises(ValueError):
+        bob.decrypt_session_message(dict(later, key_id=room['key_id']), 'bob')
+    tampered = bytearray(later['encrypted_content'])
+    tampered[0] ^= 1
+    with pytest.raises(InvalidTag):
+        bob.decrypt_session_message(dict(later, encrypted_content=bytes(tampered)), 'bob')
+    assert bob.decrypt_session_message(later, 'bob') == 'adios'
+    with pytest.raises(ValueError):
+        bob.decrypt_session_message(later, 'bob')
+
+def test_legacy_v1_messages_still_decrypt(connect):
+    alice, bob = pair(SUITE_RSA)
+    encrypted = alice.encrypt_message('mensaje antiguo')
+    assert bob.decrypt_message(encrypted) == 'mensaje antiguo'
+
+    # As the client opens it: no version field, signed by the sender
+    carol = connect('carol', suite=SUITE_RSA)
+    carol.client.crypto.add_peer_public_key('alice', alice.get_public_key_pem())
+    alice.load_peer_public_key(carol.client.crypto.get_public_key_pem())
+    message = {'type': 'encrypted_message', 'from': 'alice',
+               'encrypted_content': alice.encrypt_message('hola carol'),
+               'signature': alice.sign_message('hola carol')}
+    assert carol.call(carol.client.open_message, message) == ('hola carol', True, None)
+
+    # The v1 format only exists for RSA keys
+    x25519, _ = pair(SUITE_X25519)
+    with pytest.raises(ValueError):
+        x25519.encrypt_message('hola')
+
+def test_peer_session_keys_are_shared_between_workers():
+    alice, bob = pair()
+    first, second = send(alice, 'uno'), send(alice, 'dos')
+    wrapped = first['encrypted_keys']['bob']
+
+    # Two workers unwrapping the same key end up with one SessionKey, so the
+    # replay check sees every message under it
+    keys = []
+    workers = [threading.Thread(target=lambda: keys.append(bob.unwrap_session_key('alice', first['key_id'], wrapped)))
+               for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert all(key is keys[0] for key in keys)
+    assert bob.decrypt_session_message(second, 'bob') == 'dos'
+    with pytest.raises(ValueError):
+        bob.decrypt_session_message(first, 'bob')  # Older than 'dos'
+
+    bob.remove_peer_public_key('alice')
+    assert not bob.peer_session_keys
@@ -0,0 +1,85 @@
+import os
+import pytest
+import client as client_module
+from conftest import wait_for
+from metrics import registry
+from session_tickets import SessionTickets
+
+def test_tickets_expire_and_cannot_be_tampered_with():
+    tickets = SessionTickets(os.urandom(32))
+    ticket = tickets.issue('bob', 'AA:BB', 'rsa2048')
+    assert tickets.open(ticket)['username'] == 'bob'
+
+    tampered = bytearray(ticket)
+    tampered[-1] ^= 1
+    assert tickets.open(bytes(tampered)) is None
+    assert tickets.open(ticket[:8]) is None
+    assert tickets.open('no es un ticket') is None
+    assert SessionTickets(os.urandom(32)).open(ticket) is None  # Another node's key
+
+    expired = SessionTickets(os.urandom(32), lifetime=-1)
+    assert expired.open(expired.issue('bob', 'AA:BB', 'rsa2048')) is None
+
+def test_resume_restores_rooms_and_the_offline_cursor(connect, server):
+    alice = connect('alice')
+    bob = connect('bob')
+    for session in (alice, bob):
+        session.run(session.client.join_room('dev'))
+    wait_for(lambda: 'bob' in alice.client.rooms.get('dev', ()), message='bob in the room')
+
+    # Bob stays away long enough for messages to be stored for him
+    bob.call(setattr, bob.client, 'reconnect_delay', 2.0)
+    bob.drop()
+    wait_for(lambda: not server.call(lambda: 'bob' in server.server.clients), message='the drop')
+    for i in range(5):
+        assert alice.run(alice.client.send(f"mientras tanto {i}", room='dev'))
+    wait_for(lambda: server.call(server.server.store.pending_count, 'bob') == 5, message='stored messages')
+
+    wait_for(lambda: len(bob.received()) == 5, message='the replay')
+    assert [event['text'] for event in bob.received()] == [f"mientras tanto {i}" for i in range(5)]
+    assert {'type': 'registered', 'resumed': True} in bob.events
+    assert server.call(lambda: server.server.clients['bob'].rooms) == {'dev'}
+    wait_for(lambda: server.call(server.server.store.pending_count, 'bob') == 0, message='the acknowledgement')
+
+    # Still a member: later messages arrive live, once
+    alice.run(alice.client.send('ya de vuelta', room='dev'))
+    wait_for(lambda: len(bob.received()) == 6, message='a live message')
+    assert bob.received()[-1]['text'] == 'ya de vuelta'
+
+def test_a_stolen_ticket_does_not_take_over_a_session(connect, server, tmp_path):
+    bob = connect('bob')
+    connection = server.call(lambda: server.server.clients['bob'])
+    failures = registry.counter('server.resume_failures').value
+
+    # Bob's ticket, presented by someone without bob's identity key
+    thief = connect('bob', start=False, key_dir=str(tmp_path / 'thief'))
+    thief.client.ticket = bob.client.ticket
+    with pytest.raises(ConnectionError):
+        thief.run(thief.client.connect(port=server.port, timeout=2))
+
+    assert registry.counter('server.resume_failures').value == failures + 1
+    assert server.call(lambda: server.server.clients['bob']) is connection
+    assert bob.client.registered.is_set()
+
+def test_reconnection_backs_off_exponentially(connect, monkeypatch):
+    bob = connect('bob')
+    delays = []
+    class Jitter:
+        @staticmethod
+        def uniform(low, high):
+            delays.append(high)
+            return 0
+    monkeypatch.setattr(client_module, 'random', Jitter)
+
+    attempts = []
+    async def refused():
+        attempts.append(1)
+        if len(attempts) < 8:
+            raise ConnectionRefusedError("servidor caído")
+    monkeypatch.setattr(bob.client, 'open_connection', refused)
+    bob.run(bob.client.reconnect())
+
+    assert delays == [0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 30.0, 30.0]
+    assert sum("Reconexión fallida" in text for text in bob.notices()) == 7
+    bob.call(bob.client.on_registered, True)
+    assert bob.client.reconnect_delay == client_module.RECONNECT_INITIAL_DELAY
@@ -0,0 +1,125 @@
+import time
+import pytest
+from conftest import wait_for
+from crypto_utils import CryptoManager
+from metrics import registry
+from protocol import encode_message
+
+def forge(recipient, sender, text):
+    """A direct message from a key the directory does not have, claiming to come from sender"""
+    crypto = CryptoManager()
+    crypto.generate_keypair()
+    crypto.add_peer_public_key(recipient.client.username, recipient.client.crypto.get_public_key_pem())
+    message = crypto.encrypt_session_message(text, [recipient.client.username], ('dm', recipient.client.username))
+    message.update({
+        'type': 'encrypted_message',
+        'from': sender,
+        'to': recipient.client.username,
+        'timestamp': time.time(),
+        'signature': crypto.sign_message(text),
+    })
+    return message
+
+def inject(session, message):
+    """Hand a message to a session as if the server had relayed it"""
+    session.call(lambda: session.client.receive_batch(session.client.protocol, [message]))
+
+@pytest.mark.parametrize('receive_workers', [0, 2])
+def test_each_sender_is_verified_with_its_own_key(connect, receive_workers):
+    alice = connect('alice')
+    bob = connect('bob', receive_workers=receive_workers)
+    wait_for(lambda: bob.client.peer_username == 'alice', message='the two-party key exchange')
+    carol = connect('carol')
+
+    # Bob has never seen carol's key: her message waits for the directory
+    assert 'carol' not in bob.client.crypto.peer_public_keys
+    assert carol.run(carol.client.send('hola bob', to='bob')) is False  # Sent once bob's key arrives
+    alice.run(alice.client.send('hola desde alice'))
+    wait_for(lambda: len(bob.received()) == 2, message='both messages')
+
+    by_sender = {event['from']: event for event in bob.received()}
+    assert by_sender['carol']['text'] == 'hola bob'
+    assert by_sender['carol']['signature_valid'] is True
+    assert by_sender['carol']['private'] is True
+    assert by_sender['alice']['signature_valid'] is True
+    assert not bob.client.held_messages
+
+@pytest.mark.parametrize('receive_workers', [0, 2])
+def test_signatures_never_fall_back_to_another_key(connect, receive_workers):
+    connect('alice')
+    bob = connect('bob', receive_workers=receive_workers)
+    wait_for(lambda: bob.client.peer_username == 'alice', message='the two-party key exchange')
+    connect('carol')
+
+    # Claims to come from carol, signed by another key: checked against carol's
+    inject(bob, forge(bob, 'carol', 'soy carol'))
+    # From a user the directory does not know: cannot be checked at all
+    inject(bob, forge(bob, 'mallory', 'hola'))
+    wait_for(lambda: len(bob.received()) == 2, message='both messages')
+
+    by_sender = {event['from']: event for event in bob.received()}
+    assert by_sender['carol']['signature_valid'] is False
+    assert by_sender['mallory']['signature_valid'] is None
+    assert 'mallory' in bob.client.unknown_senders
+
+def test_unknown_senders_are_resolved_through_the_directory_cache(connect):
+    connect('alice')  # Keeps bob and carol out of the two-party key exchange
+    bob = connect('bob')
+    carol = connect('carol')
+    carol.run(carol.client.send('primero', to='bob'))
+    wait_for(lambda: len(bob.received()) == 1, message='the first message')
+    assert bob.client.directory.get('carol') is not None  # Looked up once
+    lookups = registry.counter('client.key_lookups').value
+
+    # The key is gone from the session but still cached: no round trip
+    bob.call(bob.client.crypto.peer_public_keys.pop, 'carol')
+    carol.run(carol.client.send('segundo', to='bob'))
+    wait_for(lambda: len(bob.received()) == 2, message='the second message')
+    assert registry.counter('client.key_lookups').value == lookups
+    assert [event['signature_valid'] for event in bob.received()] == [True, True]
+
+def test_crypto_manager_leaves_output_to_the_client(capsys):
+    alice, bob = CryptoManager(), CryptoManager()
+    alice.generate_keypair()
+    bob.generate_keypair()
+    alice.load_peer_public_key(bob.get_public_key_pem(), 'bob')
+    assert capsys.readouterr().out == ''
+
+def test_verified_keys_are_kept_per_user(connect, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    alice = connect('alice')
+    bob = connect('bob')
+    wait_for(lambda: bob.client.peer_username == 'alice', message='the two-party key exchange')
+    assert bob.run(bob.client.verify('alice'))
+    assert (tmp_path / 'keys' / 'bob_verified_keys.db').exists()
+    assert not (tmp_path / 'verified_keys.db').exists()
+    assert alice.client.key_cache.get_cached_fingerprint('alice') is None
+    assert bob.client.key_cache.get_cached_fingerprint('alice') == alice.client.crypto.get_public_key_fingerprint()
+
+def test_direct_messages_rekey_when_the_peer_restarts(connect):
+    alice = connect('alice')
+    bob = connect('bob')
+    wait_for(lambda: bob.client.peer_username == 'alice', message='the two-party key exchange')
+    assert alice.run(alice.client.send('antes', to='bob'))
+    wait_for(lambda: len(bob.received()) == 1, message='the first message')
+
+    # Bob starts over with the same identity key and none of his session keys
+    bob.run(bob.client.disconnect())
+    bob = connect('bob')
+    wait_for(lambda: bob.client.peer_username == 'alice', message='the new key exchange')
+    wait_for(lambda: ('dm', 'bob') not in alice.client.crypto.session_keys, message='the stale session key')
+    assert alice.run(alice.client.send('después', to='bob'))
+    wait_for(lambda: len(bob.received()) == 1, message='the message after the restart')
+    assert bob.received()[0]['text'] == 'después'
+    assert not any('Error procesando' in text for text in bob.notices())
+
+def test_key_lookups_only_accept_names(connect, server):
+    alice = connect('alice')
+    connect('bob')
+    for names in ([['bob']], [{'bob': 1}], ['bob', 7]):
+        alice.call(alice.client.write, encode_message({'type': 'key_lookup', 'usernames': names,
+                                                       'known': {'bob': 1}}))
+    wait_for(lambda: sum("Consulta de llaves inválida" in text for text in alice.notices()) == 3,
+             message='the errors')
+    # Answered with an error: the connection carries on
+    assert server.call(lambda: 'alice' in server.server.clients) and alice.client.connected
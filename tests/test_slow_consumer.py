@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+from admission import UNTHROTTLED
+from server import (ClientConnection, SecureChatServer, HARD_QUEUE_FACTOR,
+                    SLOW_CONSUMER_DROP, SLOW_CONSUMER_PAUSE)
+
+FRAME = b'x' * 100
+
+class Transport:
+    """Records what the connection does with its socket"""
+    def __init__(self):
+        self.aborted = False
+        self.reading = True
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 40000)
+
+    def set_write_buffer_limits(self, high):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    def is_closing(self):
+        return self.aborted
+
+    def abort(self):
+        self.aborted = True
+
+    close = abort
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+def stalled_client(server):
+    """A connection whose socket accepts nothing more"""
+    connection = ClientConnection(server)
+    connection.connection_made(Transport())
+    connection.pause_writing()
+    return connection
+
+def run(policy, scenario):
+    async def main():
+        server = SecureChatServer(port=0, max_queued_bytes=1000, slow_consumer_policy=policy,
+                                  limits=UNTHROTTLED)
+        return scenario(server, stalled_client(server), stalled_client(server))
+    return asyncio.run(main())
+
+def test_drop_policy_disconnects_at_the_limit():
+    def scenario(server, slow, sender):
+        sent = 0
+        while slow.send(FRAME, sender):
+            sent += 1
+        return sent, slow, sender
+    sent, slow, sender = run(SLOW_CONSUMER_DROP, scenario)
+    assert sent == 10 and slow.transport.aborted
+    assert sender.transport.reading and not sender.transport.aborted
+
+def test_pause_policy_pauses_the_sender_up_to_a_hard_limit():
+    def scenario(server, slow, sender):
+        for _ in range(10):
+            assert slow.send(FRAME, sender)
+        assert sender.transport.reading
+        assert slow.send(FRAME, sender)  # Over the limit: the sender stops
+        assert not sender.transport.reading and not slow.transport.aborted
+
+        # Frames the sender had already read still arrive, but not without end
+        sent = 11
+        while slow.send(FRAME, sender):
+            sent += 1
+        assert sent == 10 * HARD_QUEUE_FACTOR and slow.transport.aborted
+        return sender
+    sender = run(SLOW_CONSUMER_PAUSE, scenario)
+    assert not sender.transport.aborted
+
+@pytest.mark.parametrize('source', [None, 'self'])
+def test_pause_policy_drops_when_there_is_no_sender_to_pause(source):
+    def scenario(server, slow, sender):
+        origin = slow if source == 'self' else None
+        sent = 0
+        while slow.send(FRAME, origin):
+            sent += 1
+        return sent, slow
+    sent, slow = run(SLOW_CONSUMER_PAUSE, scenario)
+    assert sent == 10 and slow.transport.aborted
+
+def test_draining_resumes_the_paused_sender():
+    def scenario(server, slow, sender):
+        for _ in range(11):
+            slow.send(FRAME, sender)
+        assert not sender.transport.reading
+        slow.resume_writing()
+        return sender, slow
+    sender, slow = run(SLOW_CONSUMER_PAUSE, scenario)
+    assert sender.transport.reading and slow.queued_bytes == 0
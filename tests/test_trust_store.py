@@ -0,0 +1,51 @@
+import pickle
+import sqlite3
+import pytest
+from trust_store import KeyCache
+
+def test_errors_are_reported_not_printed(tmp_path, capsys):
+    legacy = tmp_path / 'verified_keys.pkl'
+    legacy.write_bytes(b'no es un pickle')
+    errors = []
+    cache = KeyCache(str(tmp_path / 'bob_verified_keys.db'), legacy_file=str(legacy), on_error=errors.append)
+    cache.mark_verified('alice', 'AA:BB')
+    assert cache.is_verified('alice', 'AA:BB')
+    assert len(errors) == 1
+    cache.clear_cache()
+    cache.close()
+
+    # A cache that cannot be written raises for the caller to report
+    (tmp_path / 'readonly.db').mkdir()
+    with pytest.raises(sqlite3.Error):
+        KeyCache(str(tmp_path / 'readonly.db'), legacy_file=None).mark_verified('alice', 'AA:BB')
+    assert capsys.readouterr().out == ''
+
+def test_every_new_cache_imports_the_legacy_pickle(tmp_path):
+    legacy = tmp_path / 'verified_keys.pkl'
+    legacy.write_bytes(pickle.dumps({'alice': 'AA:BB', 'carol': 'CC:DD'}))
+    bob = KeyCache(str(tmp_path / 'bob_verified_keys.db'), legacy_file=str(legacy))
+    assert bob.items() == [('alice', 'AA:BB'), ('carol', 'CC:DD')]
+    bob.mark_verified('alice', 'EE:FF')
+    bob.close()
+
+    # Left in place: the next user starts with the same pins
+    assert legacy.exists()
+    dave = KeyCache(str(tmp_path / 'dave_verified_keys.db'), legacy_file=str(legacy))
+    assert dave.items() == [('alice', 'AA:BB'), ('carol', 'CC:DD')]
+    dave.close()
+
+    # Imported only when the cache is created: later pins are not overwritten
+    bob = KeyCache(str(tmp_path / 'bob_verified_keys.db'), legacy_file=str(legacy))
+    assert bob.get_cached_fingerprint('alice') == 'EE:FF'
+    bob.close()
+
+def test_a_legacy_pickle_that_is_not_a_dict_is_rejected(tmp_path):
+    errors = []
+    # A list, and an object whose class the unpickler refuses to import
+    for name, data in (('list', pickle.dumps([('alice', 'AA:BB')])), ('object', pickle.dumps(KeyError('x')))):
+        legacy = tmp_path / f'{name}.pkl'
+        legacy.write_bytes(data)
+        cache = KeyCache(str(tmp_path / f'{name}.db'), legacy_file=str(legacy), on_error=errors.append)
+        assert cache.items() == []
+        cache.close()
+    assert isinstance(errors[0], ValueError) and isinstance(errors[1], pickle.UnpicklingError)
@@ -0,0 +1,149 @@
+# trust_store.py - Verified identities stored in SQLite
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+LEGACY_CACHE_FILE = "verified_keys.pkl"
+SHARED_CACHE_FILE = "verified_keys.db"  # Before the cache was per user
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS verified_keys (
+    username TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    verified_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS verified_keys_fingerprint ON verified_keys (fingerprint);
+"""
+
+class _DictOnlyUnpickler(pickle.Unpickler):
+    """Reads the legacy cache (a dict of strings) without importing anything"""
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Objeto no permitido en el cache: {module}.{name}")
+
+class KeyCache:
+    """Username -> fingerprint pins of verified identities
+
+    Each verification is a single-row upsert in a WAL-mode SQLite database,
+    indexed by username and by fingerprint. The database is opened on
+    first use, so startup cost does not depend on the number of contacts.
+    """
+    def __init__(self, cache_file="verified_keys.db", legacy_file=LEGACY_CACHE_FILE, shared_file=None,
+                 on_error=None):
+        self.cache_file = cache_file
+        self.legacy_file = legacy_file
+        self.shared_file = shared_file  # Older cache whose pins a new cache starts with
+        self.connection = None
+        self.lock = threading.Lock()  # Used from the UI and receive threads
+        self.on_error = on_error  # Called with the exception of a failed import
+
+    def _db(self):
+        """Open the database on first use"""
+        if self.connection is None:
+            directory = os.path.dirname(self.cache_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            created = not os.path.exists(self.cache_file)
+            connection = sqlite3.connect(self.cache_file, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self.connection = connection
+            if created:
+                self.import_shared_cache()
+                self.migrate_legacy_cache()
+        return self.connection
+
+    def import_shared_cache(self):
+        """Start with the pins of the cache every user shared (left in place for the others)"""
+        if (not self.shared_file or not os.path.exists(self.shared_file) or
+                os.path.abspath(self.shared_file) == os.path.abspath(self.cache_file)):
+            return
+        try:
+            shared = sqlite3.connect(self.shared_file)
+            try:
+                rows = shared.execute("SELECT username, fingerprint, verified_at FROM verified_keys").fetchall()
+            finally:
+                shared.close()
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO verified_keys (username, fingerprint, verified_at) VALUES (?, ?, ?)",
+                    rows
+                )
+        except sqlite3.Error as e:
+            self.report(e)
+
+    def migrate_legacy_cache(self):
+        """Start with the pins of the old pickle cache (left in place for the other users)"""
+        if not self.legacy_file or not os.path.exists(self.legacy_file):
+            return
+        try:
+            with open(self.legacy_file, 'rb') as f:
+                legacy_keys = _DictOnlyUnpickler(f).load()
+            if not isinstance(legacy_keys, dict):
+                raise ValueError("formato inesperado")
+            now = time.time()
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO verified_keys (username, fingerprint, verified_at) VALUES (?, ?, ?)",
+                    [(str(username), str(fingerprint), now) for username, fingerprint in legacy_keys.items()]
+                )
+        except Exception as e:
+            self.report(e)
+
+    def report(self, error):
+        if self.on_error is not None:
+            self.on_error(error)
+
+    def is_verified(self, username, fingerprint):
+        """Check if a username-fingerprint pair is verified"""
+        return self.get_cached_fingerprint(username) == fingerprint
+
+    def mark_verified(self, username, fingerprint):
+        """Mark a username-fingerprint pair as verified (raises sqlite3.Error)"""
+        with self.lock:
+            connection = self._db()
+            with connection:
+                connection.execute(
+                    "INSERT INTO verified_keys (username, fingerprint, verified_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT (username) DO UPDATE SET fingerprint = excluded.fingerprint, "
+                    "verified_at = excluded.verified_at",
+                    (username, fingerprint, time.time())
+                )
+
+    def get_cached_fingerprint(self, username):
+        """Get cached fingerprint for a username"""
+        with self.lock:
+            row = self._db().execute(
+                "SELECT fingerprint FROM verified_keys WHERE username = ?", (username,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_username(self, fingerprint):
+        """Get the verified username pinned to a fingerprint"""
+        with self.lock:
+            row = self._db().execute(
+                "SELECT username FROM verified_keys WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def items(self):
+        """All verified (username, fingerprint) pairs"""
+        with self.lock:
+            return self._db().execute(
+                "SELECT username, fingerprint FROM verified_keys ORDER BY username"
+            ).fetchall()
+
+    def clear_cache(self):
+        """Clear all cached keys"""
+        with self.lock:
+            connection = self._db()
+            with connection:
+                connection.execute("DELETE FROM verified_keys")
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None